@@ -2,79 +2,234 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+import threading
+from typing import Optional
 
 import telebot  # type: ignore
-from flask import Flask, request
+from flask import Blueprint, Flask, Response, abort, jsonify, request
 
+import metrics
 import models
+from cluster import UpdateQueue
+from dedup import UpdateDeduplicator
 from dialogue_management import DialogueManager
+from ingestion import UpdateDispatcher, get_update_user_id
 
 logging.basicConfig(level=logging.DEBUG)
 
 logger = logging.getLogger(__name__)
 
 
-TOKEN = os.environ["TOKEN"]
 BASE_URL = os.environ.get("BASE_URL")
 MONGO_URL = os.environ.get("MONGODB_URI")
 TELEBOT_URL = "telegram/"
+# if positive, the webhook only enqueues the updates, and this number of threads processes them
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 4))
+# in the cluster mode, the webhook puts the updates into a Mongo queue, and the `main.py --worker` processes handle them
+CLUSTER_MODE = bool(os.environ.get("CLUSTER_MODE"))
 
-bot = telebot.TeleBot(TOKEN)
+ALL_CONTENT_TYPES = [
+    "document",
+    "text",
+    "photo",
+    "audio",
+    "video",
+    "location",
+    "contact",
+    "sticker",
+]
+
+
+def get_token() -> str:
+    return os.environ["TOKEN"]
+
+
+class BotContext:
+    """
+    The clients of one process: the database, the bot and everything built on top of them.
+    Neither the Mongo client nor the background threads survive a fork, so each process creates its own context
+    on the first use (see `get_context`); importing this module or creating the Flask app does not connect anywhere.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        # the handlers run in the calling thread, so that the update dispatcher and the cluster workers
+        # know when an update has been handled and keep the updates of each user in order
+        self.bot = telebot.TeleBot(get_token(), threaded=False)
+        self.bot.register_message_handler(
+            process_message, func=lambda message: True, content_types=ALL_CONTENT_TYPES
+        )
+        self.db: models.Database = models.Database.setup(mongo_url=MONGO_URL)
+        self.dm = DialogueManager(bot=self.bot, db=self.db)
+        self.dispatcher: Optional[UpdateDispatcher] = (
+            UpdateDispatcher(
+                handle=lambda update: self.bot.process_new_updates([update]),
+                n_workers=WEBHOOK_WORKERS,
+            )
+            if WEBHOOK_WORKERS > 0 and not CLUSTER_MODE
+            else None
+        )
+        # the handled messages are shared between the processes through the database (unless it is in-memory)
+        self.dedup = UpdateDeduplicator(
+            collection=None if self.db.is_mock else self.db.processed_updates
+        )
+
+
+_context: Optional[BotContext] = None
+_context_lock = threading.Lock()
+
+
+def _forget_context_after_fork() -> None:
+    global _context, _context_lock
+    _context = None
+    # the lock might have been held by another thread of the parent at the moment of the fork
+    _context_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_context_after_fork)
+
+
+def get_context() -> BotContext:
+    global _context
+    if _context is None or _context.pid != os.getpid():
+        with _context_lock:
+            if _context is None or _context.pid != os.getpid():
+                _context = BotContext()
+    return _context
+
+
+def get_db() -> models.Database:
+    return get_context().db
 
-server = Flask(__name__, template_folder="web_app/templates")
 
-DB: models.Database = models.Database.setup(mongo_url=MONGO_URL)
+def get_bot() -> telebot.TeleBot:
+    return get_context().bot
 
-DM: DialogueManager = DialogueManager(bot=bot, db=DB)
 
-PROCESSED_MESSAGES = set()
+def get_dm() -> DialogueManager:
+    return get_context().dm
 
 
-@server.route("/" + TELEBOT_URL)
+def set_webhook() -> None:
+    if BASE_URL is None:
+        raise RuntimeError("BASE_URL is not set, so the webhook cannot be set")
+    bot = get_bot()
+    with metrics.telegram_call("remove_webhook"):
+        bot.remove_webhook()
+    with metrics.telegram_call("set_webhook"):
+        bot.set_webhook(url=BASE_URL + TELEBOT_URL + get_token())
+
+
+bot_views = Blueprint("bot", __name__)
+
+
+@bot_views.route("/" + TELEBOT_URL)
 def web_hook():
-    bot.remove_webhook()
-    bot.set_webhook(url=BASE_URL + TELEBOT_URL + TOKEN)
+    set_webhook()
     return "!", 200
 
 
-@server.route("/wakeup/")
+@bot_views.route("/wakeup/")
 def wake_up():
-    web_hook()
+    set_webhook()
     return "Маам, ну ещё пять минуточек!", 200
 
 
-@server.route("/" + TELEBOT_URL + TOKEN, methods=["POST"])
-def get_message():
-    bot.process_new_updates(
-        [telebot.types.Update.de_json(request.stream.read().decode("utf-8"))]
-    )
+@bot_views.route("/" + TELEBOT_URL + "<token>", methods=["POST"])
+def get_message(token: str):
+    if token != get_token():
+        abort(404)
+    context = get_context()
+    payload = request.stream.read().decode("utf-8")
+    update = telebot.types.Update.de_json(payload)
+    if CLUSTER_MODE:
+        UpdateQueue(context.db).enqueue(
+            update_id=update.update_id,
+            user_id=get_update_user_id(update),
+            payload=payload,
+        )
+    elif context.dispatcher is None:
+        context.bot.process_new_updates([update])
+    else:
+        context.dispatcher.submit(update)
     return "!", 200
 
 
-ALL_CONTENT_TYPES = [
-    "document",
-    "text",
-    "photo",
-    "audio",
-    "video",
-    "location",
-    "contact",
-    "sticker",
-]
+@bot_views.route("/health/")
+def health():
+    context = get_context()
+    return jsonify(
+        {
+            "pid": context.pid,
+            "updates": (
+                context.dispatcher.stats if context.dispatcher is not None else None
+            ),
+            "cluster_queue_depth": (
+                UpdateQueue(context.db).depth() if CLUSTER_MODE else None
+            ),
+            "outbox_depth": context.dm.outbox.depth,
+            "message_log": context.db.message_log.stats,
+            "project_cache": context.db.project_cache.stats,
+        }
+    )
+
+
+@bot_views.route("/metrics")
+def export_metrics():
+    context = get_context()
+    # the queue sizes are read at the moment of the export
+    metrics.QUEUE_DEPTH.labels("message_log").set(context.db.message_log.depth)
+    metrics.QUEUE_DEPTH.labels("outbox").set(context.dm.outbox.depth)
+    if context.dispatcher is not None:
+        metrics.QUEUE_DEPTH.labels("updates").set(context.dispatcher.depth)
+    return Response(
+        metrics.REGISTRY.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
 
 
-@bot.message_handler(func=lambda message: True, content_types=ALL_CONTENT_TYPES)
 def process_message(msg: telebot.types.Message):
-    if msg.message_id in PROCESSED_MESSAGES:
+    context = get_context()
+    key = context.dedup.message_key(msg.chat.id, msg.message_id)
+    if context.dedup.is_handled(key):
         return
-    PROCESSED_MESSAGES.add(msg.message_id)
-    bot.send_chat_action(msg.chat.id, "typing")
+    _process_new_message(context, msg)
+    # a message is marked only once it is handled, so that a failed or interrupted one is handled again
+    context.dedup.mark_handled(key)
+
+
+def _process_new_message(context: BotContext, msg: telebot.types.Message):
+    with metrics.telegram_call("send_chat_action"):
+        context.bot.send_chat_action(msg.chat.id, "typing")
 
     if msg.chat.type != "private":
-        bot.reply_to(
-            msg,
-            "Я работаю только в приватных чатах. Удалите меня отсюда и напишите мне в личку!",
-        )
+        with metrics.telegram_call("reply_to"):
+            context.bot.reply_to(
+                msg,
+                "Я работаю только в приватных чатах. Удалите меня отсюда и напишите мне в личку!",
+            )
         return
 
-    DM.respond(msg)
+    context.dm.respond(msg)
+
+
+def create_app() -> Flask:
+    """
+    Build the web application: the Telegram webhook and the website.
+    The secret key (for the sessions and the login cookies) should be the same in all the processes
+    and across the restarts, so it is taken from the SECRET_KEY environment variable.
+    """
+    from web_app.views import init_views
+
+    server = Flask(__name__, template_folder="web_app/templates")
+    secret_key = os.environ.get("SECRET_KEY")
+    if secret_key is None:
+        logger.warning(
+            "SECRET_KEY is not set, so the sessions will not survive a restart and will not be shared by the processes"
+        )
+        server.secret_key = os.urandom(32)
+    else:
+        server.secret_key = secret_key
+    server.register_blueprint(bot_views)
+    init_views(server)
+    return server
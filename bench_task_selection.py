@@ -0,0 +1,212 @@
+"""
+Benchmarks of the task selection, each on several project sizes, to see how they scale:
+- finding the tasks with some work for a user who has touched all the tasks of a project:
+  the old approach (loading all unsolved inputs, pending translations and labels as models)
+  against Database.get_task_ids_with_work_for_user;
+- picking a task from the in-memory TaskScheduler against a linear scan of all the tasks,
+  checking that the time of a pick does not grow with the number of tasks.
+
+By default, it runs on mongomock; set BENCH_MONGODB_URI to a scratch database to measure a real server
+(the benchmark drops its collections!).
+"""
+
+import argparse
+import os
+import random
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import mongomock
+
+import models
+from task_scheduler import TaskScheduler
+
+USER_ID = 1
+COLLECTIONS = [
+    "trans_projects",
+    "trans_tasks",
+    "trans_inputs",
+    "trans_results",
+    "trans_labels",
+    "counters",
+]
+INPUTS_PER_TASK = 20
+PICKS_PER_SIZE = 2_000
+# the largest project may make a pick at most this many times slower than the smallest one
+MAX_PICK_SLOWDOWN = 5
+
+
+def legacy_task_ids_with_work_for_user(
+    db: models.Database, project_id: int, user_id: int
+) -> Set[int]:
+    unsolved_inputs = [
+        models.TransInput.model_construct(**obj)
+        for obj in db.trans_inputs.find({"solved": False, "project_id": project_id})
+    ]
+    pending_translations = [
+        models.TransResult.model_construct(**obj)
+        for obj in db.trans_results.find(
+            {"status": models.TransStatus.UNCHECKED, "project_id": project_id}
+        )
+    ]
+    user_labels = [
+        models.TransLabel.model_construct(**obj)
+        for obj in db.trans_labels.find({"user_id": user_id, "project_id": project_id})
+    ]
+    labeled = {lab.translation_id for lab in user_labels}
+    to_label = {
+        t.input_id
+        for t in pending_translations
+        if t.user_id != user_id and t.translation_id not in labeled
+    }
+    with_pending = {t.input_id for t in pending_translations}
+    return {
+        inp.task_id
+        for inp in unsolved_inputs
+        if inp.input_id in to_label or inp.input_id not in with_pending
+    }
+
+
+def fill_project(db: models.Database, n_inputs: int) -> int:
+    project = db.create_project(title=f"Benchmark {n_inputs}")
+    rng = random.Random(n_inputs)
+    for _ in range(n_inputs // INPUTS_PER_TASK):
+        task = db.create_task(project=project)
+        inputs = [
+            db.create_input(project=project, task=task, source="x" * 100)
+            for _ in range(INPUTS_PER_TASK)
+        ]
+        for inp in inputs:
+            inp.solved = rng.random() < 0.3
+        db.add_inputs(inputs)
+        # most inputs have a pending translation, some of them by the user
+        translations = [
+            db.create_translation(
+                user_id=rng.choice([models.NO_USER, USER_ID, 2]),
+                trans_input=inp,
+                text="y" * 100,
+            )
+            for inp in inputs
+            if not inp.solved and rng.random() < 0.8
+        ]
+        if translations:
+            db.add_translations(translations)
+        labels = [
+            db.create_label(user_id=USER_ID, trans_result=tr)
+            for tr in translations
+            if rng.random() < 0.5
+        ]
+        for label in labels:
+            label.label_id = db.sequences.next_id("label_id")
+        if labels:
+            db.trans_labels.insert_many([label.model_dump() for label in labels])
+    return project.project_id
+
+
+def measure(func: Callable[[], Set[int]]):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def legacy_pick_least_completions(
+    tasks: Dict[int, Tuple[int, int]], user_tasks: Set[int]
+) -> Optional[int]:
+    candidates = [
+        (completions, task_id)
+        for task_id, (completions, _) in tasks.items()
+        if task_id not in user_tasks
+    ]
+    return min(candidates)[1] if candidates else None
+
+
+def bench_scheduler(sizes: List[int]) -> None:
+    print(f"{'tasks':>8} {'method':>24} {'legacy, us':>11} {'new, us':>8}")
+    per_pick: Dict[str, List[float]] = {}
+    for n_tasks in sizes:
+        rng = random.Random(n_tasks)
+        tasks = {
+            task_id: (rng.randrange(5), rng.randrange(100))
+            for task_id in range(n_tasks)
+        }
+        scheduler = TaskScheduler()
+        scheduler.load(
+            0,
+            [(task_id, c, score, None) for task_id, (c, score) in tasks.items()],
+        )
+        # the user has already touched half of the tasks
+        user_tasks = {task_id for task_id in tasks if rng.random() < 0.5}
+
+        start = time.perf_counter()
+        for _ in range(PICKS_PER_SIZE // 100):
+            legacy_pick_least_completions(tasks, user_tasks)
+        legacy_time = (time.perf_counter() - start) / (PICKS_PER_SIZE // 100)
+
+        for method in [
+            "pick_least_completions",
+            "pick_least_complete",
+            "pick_most_complete",
+            "pick_random",
+        ]:
+            start = time.perf_counter()
+            for _ in range(PICKS_PER_SIZE):
+                task_id = scheduler.pick(0, method, lambda t: t not in user_tasks)
+                assert task_id is not None and task_id not in user_tasks
+            new_time = (time.perf_counter() - start) / PICKS_PER_SIZE
+            per_pick.setdefault(method, []).append(new_time)
+            print(
+                f"{n_tasks:>8} {method:>24} {legacy_time * 1e6:>11.1f} {new_time * 1e6:>8.1f}"
+            )
+
+    for method, times in per_pick.items():
+        slowdown = times[-1] / times[0]
+        print(
+            f"{method}: {sizes[-1] / sizes[0]:.0f}x more tasks, {slowdown:.1f}x slower"
+        )
+        assert slowdown < MAX_PICK_SLOWDOWN, f"{method} does not scale"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 5_000, 20_000])
+    parser.add_argument(
+        "--scheduler-sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    args = parser.parse_args()
+
+    bench_scheduler(args.scheduler_sizes)
+    print()
+
+    mongo_url = os.environ.get("BENCH_MONGODB_URI")
+    print(
+        f"{'inputs':>8} {'legacy, s':>10} {'legacy, MB':>11} {'new, s':>8} {'new, MB':>8}"
+    )
+    for n_inputs in args.sizes:
+        if mongo_url is not None:
+            db = models.Database.setup(mongo_url=mongo_url)
+            for name in COLLECTIONS:
+                db.mongo_db.get_collection(name).delete_many({})
+        else:
+            # without the indexes, because mongomock checks unique indexes by a full scan on each insert
+            db = models.Database(mongo_db=mongomock.MongoClient().db)
+        project_id = fill_project(db, n_inputs)
+
+        old, old_time, old_mem = measure(
+            lambda: legacy_task_ids_with_work_for_user(db, project_id, USER_ID)
+        )
+        new, new_time, new_mem = measure(
+            lambda: db.get_task_ids_with_work_for_user(project_id, USER_ID)
+        )
+        assert old == new
+        print(
+            f"{n_inputs:>8} {old_time:>10.3f} {old_mem / 2**20:>11.1f} {new_time:>8.3f} {new_mem / 2**20:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Set
+
+from pymongo import ASCENDING, ReturnDocument  # type: ignore
+from pymongo.errors import DuplicateKeyError  # type: ignore
+
+import models
+from models import queries
+
+logger = logging.getLogger(__name__)
+
+# the updates are split into this many partitions by the hashed user id; each partition has one owner at a time
+N_PARTITIONS = 64
+# a worker that has not renewed its leases for this long is considered dead
+LEASE_SECONDS = 30
+# an update that has failed this many times is dropped, so that it does not block the updates of its user forever
+MAX_ATTEMPTS = 3
+
+
+def partition_for(user_id: Optional[int], update_id: int) -> int:
+    """A stable (unlike `hash`) assignment of the users to the partitions"""
+    key = user_id if user_id is not None else update_id
+    return zlib.crc32(str(key).encode("utf-8")) % N_PARTITIONS
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class UpdateQueue:
+    """
+    A Mongo-backed queue of the incoming Telegram updates, shared by all the processes of the cluster.
+    Each document is {"_id": update_id, "partition", "payload" (the raw JSON of the update), "enqueued_at"}.
+    """
+
+    def __init__(self, db: models.Database):
+        self.collection = db.update_queue
+
+    def enqueue(self, update_id: int, user_id: Optional[int], payload: str) -> None:
+        try:
+            self.collection.insert_one(
+                {
+                    "_id": update_id,
+                    "partition": partition_for(user_id, update_id),
+                    "payload": payload,
+                    "enqueued_at": time.time(),
+                }
+            )
+        except DuplicateKeyError:
+            # Telegram has redelivered an update that we already have
+            pass
+
+    @queries("update_queue", "partition")
+    def peek(self, partitions: List[int], limit: int = 100) -> List[Dict]:
+        """The oldest pending updates of the partitions; within a partition, they come in the order of arrival"""
+        if not partitions:
+            return []
+        return list(
+            self.collection.find({"partition": {"$in": partitions}})
+            .sort([("partition", ASCENDING), ("_id", ASCENDING)])
+            .limit(limit)
+        )
+
+    def remove(self, update_id: int) -> None:
+        self.collection.delete_one({"_id": update_id})
+
+    def record_failure(self, update_id: int) -> int:
+        """Count a failed attempt to process the update, and return the number of the attempts so far"""
+        doc = self.collection.find_one_and_update(
+            {"_id": update_id},
+            {"$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["attempts"] if doc is not None else MAX_ATTEMPTS
+
+    def depth(self) -> int:
+        return self.collection.estimated_document_count()
+
+
+class PartitionLeases:
+    """
+    Assigns the partitions to the live workers through renewable leases stored in Mongo.
+    Each worker keeps a fair share of the partitions; when a worker dies, its leases expire
+    and the others take its partitions over, and when a worker joins, the others release their extra partitions.
+    """
+
+    def __init__(
+        self,
+        db: models.Database,
+        worker_id: str,
+        lease_seconds: float = LEASE_SECONDS,
+    ):
+        self.leases = db.partition_leases
+        self.workers = db.cluster_workers
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.owned: Set[int] = set()
+        # the leases are renewed both by the main loop and by the heartbeat thread
+        self._lock = threading.RLock()
+
+    @queries("cluster_workers", "heartbeat")
+    def count_live_workers(self, now: float) -> int:
+        return self.workers.count_documents(
+            {"heartbeat": {"$gt": now - self.lease_seconds}}
+        )
+
+    def renew(self) -> Set[int]:
+        """Prolong the own leases, forget the ones that have been lost, and return the owned partitions"""
+        with self._lock:
+            now = time.time()
+            self.workers.update_one(
+                {"_id": self.worker_id}, {"$set": {"heartbeat": now}}, upsert=True
+            )
+            self.owned = {
+                partition
+                for partition in self.owned
+                if self.leases.update_one(
+                    {"_id": partition, "owner": self.worker_id},
+                    {"$set": {"expires_at": now + self.lease_seconds}},
+                ).matched_count
+            }
+            return set(self.owned)
+
+    def rebalance(self) -> Set[int]:
+        """Renew the own leases, release or take the partitions to keep a fair share, and return the owned ones"""
+        with self._lock:
+            self.renew()
+            now = time.time()
+            expires_at = now + self.lease_seconds
+            fair_share = math.ceil(N_PARTITIONS / max(1, self.count_live_workers(now)))
+
+            # giving away the extra partitions, so that the new workers can take them
+            for partition in sorted(self.owned)[fair_share:]:
+                self.release(partition)
+
+            # taking the free partitions and the partitions of the dead workers
+            if len(self.owned) < fair_share:
+                for partition in range(N_PARTITIONS):
+                    if len(self.owned) >= fair_share:
+                        break
+                    if partition in self.owned:
+                        continue
+                    if self._try_acquire(partition, now=now, expires_at=expires_at):
+                        logger.info(
+                            f"Worker {self.worker_id} took the partition {partition}"
+                        )
+                        self.owned.add(partition)
+            return set(self.owned)
+
+    def _try_acquire(self, partition: int, now: float, expires_at: float) -> bool:
+        try:
+            result = self.leases.update_one(
+                {
+                    "_id": partition,
+                    "$or": [{"owner": None}, {"expires_at": {"$lt": now}}],
+                },
+                {"$set": {"owner": self.worker_id, "expires_at": expires_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # the lease exists and belongs to a live worker, so the upsert has failed
+            return False
+        return result.matched_count > 0 or result.upserted_id is not None
+
+    def release(self, partition: int) -> None:
+        with self._lock:
+            self.leases.update_one(
+                {"_id": partition, "owner": self.worker_id},
+                {"$set": {"owner": None, "expires_at": None}},
+            )
+            self.owned.discard(partition)
+
+    def release_all(self) -> None:
+        with self._lock:
+            for partition in list(self.owned):
+                self.release(partition)
+            self.workers.delete_one({"_id": self.worker_id})
+
+    def still_owns(self, partition: int) -> bool:
+        return partition in self.owned
+
+
+class ClusterWorker:
+    """
+    A worker process of the cluster: it processes the queued updates of the partitions it owns.
+    All the updates of a user are in the same partition, and a partition is processed by a single worker
+    in the order of arrival, so the dialogue of each user stays sequential.
+    The `handle` should process the update before returning (e.g. with a TeleBot with threaded=False):
+    an update is removed from the queue only after it has been handled.
+    While the worker is alive, a heartbeat thread keeps its leases, even if a single update takes long to handle.
+    """
+
+    def __init__(
+        self,
+        db: models.Database,
+        handle: Callable[[str], None],
+        worker_id: Optional[str] = None,
+        lease_seconds: float = LEASE_SECONDS,
+        poll_seconds: float = 0.5,
+    ):
+        self.queue = UpdateQueue(db)
+        self.leases = PartitionLeases(
+            db, worker_id=worker_id or default_worker_id(), lease_seconds=lease_seconds
+        )
+        # processes the raw JSON of an update
+        self.handle = handle
+        self.poll_seconds = poll_seconds
+        self.n_processed = 0
+
+    def run_once(self) -> int:
+        """Rebalance the partitions and process a batch of the pending updates; return how many were processed"""
+        partitions = sorted(self.leases.rebalance())
+        started = time.time()
+        n_processed = 0
+        # after a failure, the later updates of the partition wait for the next batch, to keep their order
+        failed_partitions: Set[int] = set()
+        for doc in self.queue.peek(partitions):
+            partition = doc["partition"]
+            # the lease might have been lost (e.g. the worker has been paused), and another worker may own it now
+            if partition in failed_partitions or not self.leases.still_owns(partition):
+                continue
+            # rebalancing from time to time, so that the new workers get their share
+            if time.time() - started > self.leases.lease_seconds / 3:
+                break
+            try:
+                self.handle(doc["payload"])
+            except Exception:
+                logger.exception(f"Error when processing the update {doc['_id']}")
+                if self.queue.record_failure(doc["_id"]) < MAX_ATTEMPTS:
+                    failed_partitions.add(partition)
+                    continue
+                logger.error(
+                    f"Dropping the update {doc['_id']} after {MAX_ATTEMPTS} attempts"
+                )
+            self.queue.remove(doc["_id"])
+            n_processed += 1
+        self.n_processed += n_processed
+        return n_processed
+
+    def _keep_leases(self, stop: threading.Event) -> None:
+        while not stop.wait(self.leases.lease_seconds / 3):
+            try:
+                self.leases.renew()
+            except Exception:
+                logger.exception("Could not renew the partition leases")
+
+    def run_forever(self) -> None:
+        logger.info(f"Starting the cluster worker {self.leases.worker_id}")
+        stop = threading.Event()
+        threading.Thread(
+            target=self._keep_leases,
+            args=(stop,),
+            name="cluster-heartbeat",
+            daemon=True,
+        ).start()
+        try:
+            while True:
+                if self.run_once() == 0:
+                    time.sleep(self.poll_seconds)
+        finally:
+            stop.set()
+            self.leases.release_all()
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Hashable, Optional
+
+from pymongo.collection import Collection  # type: ignore
+from pymongo.errors import DuplicateKeyError  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Telegram stops redelivering an update long before that
+DEDUP_TTL_SECONDS = 60 * 60 * 24
+
+
+class UpdateDeduplicator:
+    """
+    Remembers which incoming updates have already been handled, to ignore their redeliveries.
+    The updates of one user are handled one at a time (see `ingestion` and `cluster`),
+    so checking a key before the handling and marking it afterwards does not race with a redelivery.
+    The recent keys are kept in a bounded in-memory LRU with a TTL. If a Mongo collection is given,
+    the keys are also inserted there (as `_id`, with a TTL index on `created_at`),
+    so that several processes and restarts agree on what has been handled.
+    """
+
+    def __init__(
+        self,
+        collection: Optional[Collection] = None,
+        max_size: int = 10_000,
+        ttl_seconds: float = DEDUP_TTL_SECONDS,
+    ):
+        self.collection = collection
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # key -> expiration time, from the least to the most recently seen
+        self._recent: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def message_key(chat_id: int, message_id: int) -> str:
+        # message ids are unique only within a chat
+        return f"{chat_id}:{message_id}"
+
+    def _seen_locally(self, key: Hashable, now: float) -> bool:
+        expires_at = self._recent.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self._recent[key]
+            return False
+        self._recent.move_to_end(key)
+        return True
+
+    def _remember(self, key: Hashable, now: float) -> None:
+        self._recent[key] = now + self.ttl_seconds
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_size:
+            self._recent.popitem(last=False)
+
+    def is_handled(self, key: Hashable) -> bool:
+        """Whether the key has been marked as handled, by this or (through the collection) by another process"""
+        now = time.monotonic()
+        with self._lock:
+            if self._seen_locally(key, now):
+                return True
+        if self.collection is None:
+            return False
+        try:
+            found = self.collection.find_one({"_id": key}) is not None
+        except Exception:
+            # if the database is unavailable, handling a redelivery twice is better than losing the update
+            logger.exception(f"Could not check the update {key}")
+            return False
+        if found:
+            logger.info(f"The update {key} has already been handled by another process")
+            with self._lock:
+                self._remember(key, now)
+        return found
+
+    def mark_handled(self, key: Hashable) -> None:
+        """
+        Remember the key once its update has been handled. It is not marked before that:
+        if a process dies while handling an update, the process that takes it over must not skip it.
+        """
+        with self._lock:
+            self._remember(key, time.monotonic())
+        if self.collection is None:
+            return
+        try:
+            self.collection.insert_one({"_id": key, "created_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            pass
+        except Exception:
+            logger.exception(f"Could not record the update {key}")
@@ -1,16 +1,20 @@
 import logging
 import os
-import random
+import threading
 import time
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Union
+from typing import Callable, Dict, List, Optional, Union
 
 import sentry_sdk
 import telebot  # type: ignore
 from telebot.apihelper import ApiTelegramException  # type: ignore
 
+import metrics
 import models
+import query_log
+import reminders
+from outbox import Outbox
 import tasking
 import texts
 from states import States
@@ -21,6 +25,8 @@ logger = logging.getLogger(__name__)
 
 
 CALL_KEY = os.environ.get("CALL_KEY")
+# if there is no task to suggest to a user, we try again after a day
+REMINDER_RETRY_SECONDS = 60 * 60 * 24
 
 
 def render_markup(suggests=None, max_columns=3, initial_ratio=2):
@@ -60,43 +66,125 @@ class DialogueManager:
     def __init__(self, db: models.Database, bot: Union[telebot.TeleBot, FakeBot]):
         self.db: models.Database = db
         self.bot: Union[telebot.TeleBot, FakeBot] = bot
+        self.outbox = Outbox(bot=bot)
+        # the replies to the message being handled by the current thread, sent once its changes are saved
+        self._local = threading.local()
+        self.campaigns = reminders.ReminderCampaigns(
+            db=db,
+            remind=self.remind_user,
+            notify=lambda user_id, text: self.send_text_to_user(
+                user_id, text, bulk=True
+            ),
+        )
 
     def send_text_to_user(
-        self, user_id, text, reply_markup=None, suggests=None, parse_mode="html"
+        self,
+        user_id,
+        text,
+        reply_markup=None,
+        suggests=None,
+        parse_mode="html",
+        bulk=False,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        throttled=False,
     ):
+        """
+        Send a message to the user. The replies are sent immediately,
+        while the bulk messages are queued and sent in the background within the rate limits.
+        The throttled messages are sent from the calling thread, waiting for the rate limits.
+        """
         if reply_markup is None:
             reply_markup = render_markup(suggests or [])
         logger.info("Response is:" + text)
-        result = self.bot.send_message(
-            user_id, text, reply_markup=reply_markup, parse_mode=parse_mode
-        )
+
+        def log_message(result):
+            self.db.message_log.log(
+                {
+                    "user_id": user_id,
+                    "from_user": False,
+                    "text": text,
+                    "timestamp": datetime.utcnow(),
+                    "message_id": result.message_id,
+                }
+            )
+
         # For some reason, markdown is malformed with urls
-        self.db.mongo_messages.insert_one(
-            {
-                "user_id": user_id,
-                "from_user": False,
-                "text": text,
-                "timestamp": datetime.utcnow(),
-                "message_id": result.message_id,
-            }
-        )
-        time.sleep(0.3)
+        if bulk:
+            self.outbox.enqueue(
+                user_id,
+                text,
+                on_sent=log_message,
+                on_error=on_error,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode,
+            )
+            return
+        send = self.outbox.send_throttled if throttled else self.outbox.send_now
+
+        def deliver():
+            result = send(
+                user_id, text, reply_markup=reply_markup, parse_mode=parse_mode
+            )
+            log_message(result)
+
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.append(deliver)
+        else:
+            deliver()
 
     def respond(self, msg: telebot.types.Message):
+        # the branch of the dialogue that has handled the message, for the metrics
+        trace = {"branch": "unknown"}
+        started = time.perf_counter()
+        # the replies wait until the changes are written, so that the user never sees a reply whose state is lost
+        self._local.pending = []
+        try:
+            # all the entities are loaded once per message, and the changes are written together at the end
+            with query_log.track() as db_stats, self.db.session():
+                self._respond(msg, trace=trace)
+            self._send_pending()
+        except Exception:
+            metrics.DIALOGUE_ERRORS.labels(trace["branch"]).inc()
+            raise
+        finally:
+            self._local.pending = None
+            metrics.DIALOGUE_SECONDS.labels(trace["branch"]).observe(
+                time.perf_counter() - started
+            )
+        metrics.DIALOGUE_DB_QUERIES.labels(trace["branch"]).observe(db_stats.n_queries)
+        metrics.DIALOGUE_DB_DOCUMENTS.labels(trace["branch"]).observe(
+            db_stats.n_documents
+        )
+        logger.debug(f"The branch {trace['branch']} has made {db_stats.summary()}")
+
+    def _send_pending(self) -> None:
+        pending, self._local.pending = self._local.pending, None
+        for deliver in pending:
+            try:
+                deliver()
+            except Exception as e:
+                # the message has been handled and its changes are saved, so it is not retried because of a reply
+                sentry_sdk.capture_exception(e)
+                logger.exception("Could not send a reply")
+
+    def _respond(self, msg: telebot.types.Message, trace: Dict[str, str]):
         text = msg.text
+        if msg.from_user is None:
+            logger.warning(f"Ignoring the message {msg.message_id} without a sender")
+            return
         user_id = msg.from_user.id
         username = msg.from_user.username or "Anonymous"
 
-        user: models.UserState = models.find_user(
-            self.db.mongo_users, user=msg.from_user
-        )
+        user = self.db.get_or_create_user(msg.from_user)
 
         user.last_activity_time = time.time()
         user.n_last_reminders = 0
         user.is_blocked = False
+        user.schedule_next_reminder()
         self.db.save_user(user)
 
-        self.db.mongo_messages.insert_one(
+        self.db.message_log.log(
             {
                 "user_id": user_id,
                 "from_user": True,
@@ -112,6 +200,7 @@ class DialogueManager:
         default_markup = render_markup(suggested_suggests)
 
         if not text:
+            trace["branch"] = "no_text"
             self.send_text_to_user(
                 user_id,
                 "<i>Я пока не поддерживаю стикеры, фото и т.п.\nПожалуйста, пользуйтесь текстом и смайликами \U0001F642</i>",  # noqa
@@ -119,6 +208,7 @@ class DialogueManager:
             )
             print("class: no text detected")
         elif text in {"/start", "/help"}:
+            trace["branch"] = "/help"
             resp = "\n\n".join([texts.HELP, texts.MENU])
             self.send_text_to_user(
                 user_id, resp, reply_markup=default_markup, parse_mode="html"
@@ -126,6 +216,7 @@ class DialogueManager:
 
         # The setup scenario (here we enter only!)
         elif text in {"/setup"}:
+            trace["branch"] = "/setup"
             response, suggests = tasking.do_ask_setup(user=user)
             self.db.save_user(user)
             self.send_text_to_user(
@@ -133,6 +224,7 @@ class DialogueManager:
             )
 
         elif text in {"/stats"}:
+            trace["branch"] = "/stats"
             response, suggests = tasking.do_get_project_status(user=user, db=self.db)
             self.db.save_user(user)
             self.send_text_to_user(
@@ -140,6 +232,7 @@ class DialogueManager:
             )
 
         elif text in {"/guidelines"}:
+            trace["branch"] = "/guidelines"
             response, suggests = tasking.do_tell_guidelines(user=user, db=self.db)
             self.db.save_user(user)
             self.send_text_to_user(
@@ -147,6 +240,7 @@ class DialogueManager:
             )
 
         elif text in {"/resume"}:
+            trace["branch"] = "/resume"
             # repeat the last message in the current task, without changing the state
             response, suggests = tasking.do_resume_task(user=user, db=self.db)
             self.db.save_user(user)
@@ -154,6 +248,7 @@ class DialogueManager:
                 user.user_id, response, suggests=suggests, parse_mode="html"
             )
         elif text in {"/skip"}:
+            trace["branch"] = "/skip"
             response, suggests = tasking.do_skip_input(user=user, db=self.db)
             self.db.save_user(user)
             self.send_text_to_user(
@@ -161,19 +256,19 @@ class DialogueManager:
             )
 
         elif text == CALL_KEY and CALL_KEY is not None:
+            trace["branch"] = "call_key"
             response = "Начинаю обход юзеров..."
             suggests = suggested_suggests
             self.send_text_to_user(
                 user.user_id, response, suggests=suggests, parse_mode="html"
             )
-            self.run_reminders()
-            response = "Обход юзеров завершён!"
-            suggests = suggested_suggests
-            self.send_text_to_user(
-                user.user_id, response, suggests=suggests, parse_mode="html"
+            # the progress and the result are reported by the campaign runner
+            self._local.pending.append(
+                lambda: self.campaigns.start_in_background(requested_by=user.user_id)
             )
 
         elif text == "/projects":
+            trace["branch"] = "/projects"
             active_projects = self.db.get_projects(active=True)
             if len(active_projects) == 0:
                 response = "Активных проектов в настоящий момент не найдено. Напишите @cointegrated, если вы хотите начать новый проект."
@@ -208,6 +303,7 @@ class DialogueManager:
                 )
 
         elif user.state_id == States.SUGGEST_CHOOSE_PROJECT and text.isnumeric():
+            trace["branch"] = "SUGGEST_CHOOSE_PROJECT"
             active_projects = self.db.get_projects(active=True)
             id2project = {
                 str(i + 1): project for i, project in enumerate(active_projects)
@@ -243,6 +339,7 @@ class DialogueManager:
                 and text in {texts.RESP_YES}
             )
         ):
+            trace["branch"] = "/task"
             if user.curr_proj_id is None:
                 response = "Вы не выбрали проект. Нажмите /projects, чтобы выбрать его из списка."
                 self.send_text_to_user(
@@ -280,11 +377,13 @@ class DialogueManager:
                     )
 
         elif user.state_id == States.SUGGEST_ONE_MORE_TASK and text in {texts.RESP_NO}:
+            trace["branch"] = "SUGGEST_ONE_MORE_TASK"
             resp, suggests = tasking.do_not_assing_new_task(user=user, db=self.db)
             self.db.save_user(user)
             self.send_text_to_user(user_id, resp, suggests=suggests)
 
         elif user.state_id == States.SUGGEST_TASK and text in {texts.RESP_TAKE_TASK}:
+            trace["branch"] = "SUGGEST_TASK"
             task = (
                 self.db.get_task(user.curr_task_id)
                 if user.curr_task_id is not None
@@ -297,11 +396,16 @@ class DialogueManager:
                 user.curr_task_id = None
                 user.state_id = None
                 self.db.save_user(user)
+            elif not self.db.claim_task(
+                task=task, user_id=user_id
+            ) and self.db.has_free_tasks(project_id=task.project_id):
+                # another user has taken the task in the meantime; if there is nothing else, we let them share it
+                self.send_text_to_user(
+                    user_id, texts.RESP_TASK_TAKEN, suggests=[texts.RESP_SKIP_TASK]
+                )
             else:
-                task.locked = True
-                self.db.save_task(task)
                 user.pbar_num = 0
-                user.pbar_den = len(self.db.get_unsolved_inputs_for_task(task=task))
+                user.pbar_den = self.db.count_unsolved_inputs_for_task(task=task)
                 resp, suggests = tasking.do_assign_input(
                     user=user, db=self.db, task=task
                 )
@@ -312,6 +416,7 @@ class DialogueManager:
             user.state_id == States.ASK_COHERENCE
             and text in texts.COHERENCE_RESPONSES_MAP
         ):
+            trace["branch"] = "ASK_COHERENCE"
             resp, suggests = tasking.do_save_coherence_and_continue(
                 user=user, db=self.db, user_text=text
             )
@@ -319,6 +424,7 @@ class DialogueManager:
             self.send_text_to_user(user_id, resp, suggests=suggests)
 
         elif user.state_id == States.ASK_XSTS and text in texts.XSTS_RESPONSES:
+            trace["branch"] = "ASK_XSTS"
             resp, suggests = tasking.do_save_xsts_and_continue(
                 user=user, db=self.db, user_text=text
             )
@@ -331,6 +437,7 @@ class DialogueManager:
             user.state_id == States.ASK_COHERENCE
             and text not in texts.COHERENCE_RESPONSES
         ):
+            trace["branch"] = "ASK_COHERENCE_again"
             assert (
                 user.curr_sent_id is not None
                 and user.curr_result_id is not None
@@ -350,6 +457,7 @@ class DialogueManager:
             )
             self.send_text_to_user(user_id, resp, suggests=suggests)
         elif user.state_id == States.ASK_XSTS and text not in texts.XSTS_RESPONSES:
+            trace["branch"] = "ASK_XSTS_again"
             assert (
                 user.curr_sent_id is not None
                 and user.curr_result_id is not None
@@ -372,6 +480,7 @@ class DialogueManager:
         # Free-form inputs; the intent depends only on the state
         # accepting any text as translation!
         elif user.state_id == States.ASK_TRANSLATION:
+            trace["branch"] = "ASK_TRANSLATION"
             resp, suggests = tasking.do_save_translation_and_ask_for_next(
                 user=user, db=self.db, user_text=text
             )
@@ -379,6 +488,7 @@ class DialogueManager:
             self.send_text_to_user(user_id, resp, suggests=suggests)
 
         elif user.state_id == States.SETUP_ASK_SRC_LANG:
+            trace["branch"] = "SETUP_ASK_SRC_LANG"
             langs = [lang.strip() for lang in text.strip().split(",")]
             langs = [lang for lang in langs if lang]
             user.src_langs = langs
@@ -389,6 +499,7 @@ class DialogueManager:
             )
 
         elif user.state_id == States.SETUP_ASK_TGT_LANG:
+            trace["branch"] = "SETUP_ASK_TGT_LANG"
             langs = [lang.strip() for lang in text.strip().split(",")]
             langs = [lang for lang in langs if lang]
             user.tgt_langs = langs
@@ -399,6 +510,7 @@ class DialogueManager:
             )
 
         elif user.state_id == States.SETUP_ASK_CONTACT_INFO:
+            trace["branch"] = "SETUP_ASK_CONTACT_INFO"
             user.contact = text
             response, suggests = tasking.do_ask_setup(user=user)
             self.db.save_user(user)
@@ -408,6 +520,7 @@ class DialogueManager:
 
         # The last resort: non-contextual fallback
         else:
+            trace["branch"] = "fallback"
             self.send_text_to_user(
                 user_id,
                 texts.FALLBACK,
@@ -415,77 +528,67 @@ class DialogueManager:
             )
 
     def run_reminders(self):
-        self.db.cleanup_locked_tasks()
-        for user in self.db.get_all_users():
-            if user.is_blocked:
-                user.curr_task_id = None
-                user.curr_sent_id = None
-                user.curr_label_id = None
-                user.curr_result_id = None
-                self.db.save_user(user)
-                continue
-
-            # the user seems to be dead, not bothering them
-            if user.n_last_reminders > 10:
-                continue
+        self.campaigns.run()
 
-            # pinging the user at most once per 3 days
-            lag = time.time() - max(
-                user.last_activity_time or 0, user.last_reminder_time or 0
-            )
-            if lag < 60 * 60 * 24 * 3:
-                continue
+    def remind_user(self, user: models.UserState) -> str:
+        """Send a reminder to a user who is due for it, and return the outcome"""
+        # now just doing as if the user has pressed "resume"
+        response, suggests = tasking.do_resume_task(user=user, db=self.db)
 
-            # even if it's time for a reminder, skip it 80% of times, just to diversify the message times
-            if random.random() < 0.8:
-                continue
-
-            # now just doing as if the user has pressed "resume"
-            response, suggests = tasking.do_resume_task(user=user, db=self.db)
-
-            # if there is no current task, suggest a new one:
-            if response.startswith(texts.NO_CURRENT_TASK):
-                task = self.db.get_new_task(user=user)
-                # if there is no task for a user, do nothing!
-                if task is None:
-                    continue
+        # if there is no current task, suggest a new one:
+        if response.startswith(texts.NO_CURRENT_TASK):
+            task = self.db.get_new_task(user=user)
+            # if there is no task for a user, do nothing, but check again later
+            if task is None:
+                user.next_reminder_at = time.time() + REMINDER_RETRY_SECONDS
+                self.db.save_user(user)
+                return reminders.SKIPPED
 
-                response = f"Я бы хотел вам предложить новое задание: #{task.task_id}."
-                if task.prompt:
-                    response += "\n" + task.prompt
-                response += (
-                    "\nГотовы к выполнению этого задания или хотите попробовать другое?"
-                )
-                suggests = [texts.RESP_TAKE_TASK, texts.RESP_SKIP_TASK]
-                user.curr_proj_id = task.project_id
-                user.curr_task_id = task.task_id
-                user.state_id = States.SUGGEST_TASK
+            response = f"Я бы хотел вам предложить новое задание: #{task.task_id}."
+            if task.prompt:
+                response += "\n" + task.prompt
+            response += (
+                "\nГотовы к выполнению этого задания или хотите попробовать другое?"
+            )
+            suggests = [texts.RESP_TAKE_TASK, texts.RESP_SKIP_TASK]
+            user.curr_proj_id = task.project_id
+            user.curr_task_id = task.task_id
+            user.state_id = States.SUGGEST_TASK
 
-            response = f"Добрый день! Проект ещё не завершён, и я хотел бы вас попросить, когда у вас будет время, пройтись по ещё некоторым переводам.\n\n{response}"
+        response = f"Добрый день! Проект ещё не завершён, и я хотел бы вас попросить, когда у вас будет время, пройтись по ещё некоторым переводам.\n\n{response}"
 
-            user.n_last_reminders = (user.n_last_reminders or 0) + 1
-            user.last_reminder_time = time.time()
+        user.n_last_reminders = (user.n_last_reminders or 0) + 1
+        user.last_reminder_time = time.time()
+        user.schedule_next_reminder()
 
-            self.db.save_user(user)
-            try:
-                self.send_text_to_user(
-                    user.user_id, response, suggests=suggests, parse_mode="html"
+        self.db.save_user(user)
+        try:
+            self.send_text_to_user(
+                user.user_id,
+                response,
+                suggests=suggests,
+                parse_mode="html",
+                throttled=True,
+            )
+        except Exception as e:
+            self.handle_push_error(user, e)
+            return reminders.BLOCKED if user.is_blocked else reminders.FAILED
+        return reminders.SENT
+
+    def handle_push_error(self, user: models.UserState, e: Exception) -> None:
+        sentry_sdk.capture_exception(e)
+        logger.info(f"Error when pushing a message: {e}")
+        if isinstance(e, ApiTelegramException):
+            description = e.result_json.get("description", "") if e.result_json else ""
+            if description and (
+                "blocked" in description or "user is deactivated" in description
+            ):
+                user.is_blocked = True
+                user.block_log = str(e)
+                user.schedule_next_reminder()
+                self.db.save_user(user)
+                # the user will not answer, so their task should not wait for the lease to expire
+                self.db.release_user_tasks(user_id=user.user_id)
+                logger.info(
+                    f"Unsubscribing the user {user.user_id} after an unsuccessful Telegram push ({description})"
                 )
-            except Exception as e:
-                sentry_sdk.capture_exception(e)
-                logger.info(f"Error when pushing a message: {e}")
-                if isinstance(e, ApiTelegramException):
-                    description = (
-                        e.result_json.get("description", "") if e.result_json else ""
-                    )
-                    if description and (
-                        "blocked" in description or "user is deactivated" in description
-                    ):
-                        user.is_blocked = True
-                        user.block_log = str(e)
-                        self.db.save_user(user)
-                        logger.info(
-                            f"Unsubscribing the user {user.user_id} after an unsuccessful Telegram push ({description})"
-                        )
-
-            time.sleep(5)  # 5 seconds between each user, to avoid overload
@@ -0,0 +1,47 @@
+import logging
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, DefaultDict, List, Type
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TranslationSaved:
+    """A new translation has been submitted for an input"""
+
+    translation: Any  # models.TransResult
+
+
+@dataclass
+class LabelFinalized:
+    """A label got its verdict, and the translation has been updated (and maybe accepted or rejected)"""
+
+    label: Any  # models.TransLabel
+    translation: Any  # models.TransResult
+    old_status: int
+
+    @property
+    def status_changed(self) -> bool:
+        return self.translation.status != self.old_status
+
+
+Handler = Callable[[Any], None]
+
+
+class EventBus:
+    """A synchronous in-process publisher of the domain events"""
+
+    def __init__(self):
+        self.handlers: DefaultDict[Type, List[Handler]] = defaultdict(list)
+
+    def subscribe(self, event_type: Type, handler: Handler) -> None:
+        self.handlers[event_type].append(handler)
+
+    def publish(self, event: Any) -> None:
+        for handler in self.handlers[type(event)]:
+            try:
+                handler(event)
+            except Exception:
+                # the derived data can be repaired later, so a failed handler should not break the dialogue
+                logger.exception(f"Error when handling the event {event}")
@@ -0,0 +1,34 @@
+# The settings of `gunicorn wsgi:app`; see https://docs.gunicorn.org/en/stable/settings.html
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# Without the cluster mode, each worker process handles the updates it receives by itself,
+# so the messages of one user could be handled by two processes at once and out of order.
+# So only one worker is started then; in the cluster mode, the webhook workers only enqueue the updates.
+workers = (
+    int(os.environ.get("WEB_CONCURRENCY", 2)) if os.environ.get("CLUSTER_MODE") else 1
+)
+# the updates are processed by the background threads of each worker (see WEBHOOK_WORKERS)
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# the app is imported once in the master process, and the workers are forked from it, which makes them start faster
+preload_app = True
+timeout = 60
+
+
+def when_ready(server):
+    if workers == 1 and int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        server.log.warning(
+            "WEB_CONCURRENCY is ignored: without CLUSTER_MODE, one worker keeps the messages of each user in order"
+        )
+    # once for the whole server, not for each worker
+    if os.environ.get("BASE_URL"):
+        from app import set_webhook
+
+        set_webhook()
+
+
+def post_fork(server, worker):
+    # each worker gets a scheduler, and the leader lease lets only one of them run the jobs
+    from main import start_scheduler
+
+    start_scheduler()
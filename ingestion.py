@@ -0,0 +1,104 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import telebot  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_user_id(update: telebot.types.Update) -> Optional[int]:
+    """The id of the user who has sent the update, if there is one"""
+    for item in [
+        update.message,
+        update.edited_message,
+        update.callback_query,
+        update.inline_query,
+        update.my_chat_member,
+    ]:
+        from_user = getattr(item, "from_user", None)
+        if from_user is not None:
+            return from_user.id
+    return None
+
+
+class UpdateDispatcher:
+    """
+    Processes the incoming Telegram updates in background threads, so that the webhook can answer immediately.
+    The updates are partitioned by user: all the updates of one user go to the same worker and keep their order,
+    while the updates of different users are processed in parallel.
+    The `handle` should process the update before returning (e.g. a TeleBot with threaded=False):
+    otherwise, neither the order nor the stats mean anything.
+    """
+
+    def __init__(
+        self,
+        handle: Callable[[telebot.types.Update], None],
+        n_workers: int = 4,
+        max_queue_size: int = 1000,
+    ):
+        self.handle = handle
+        self.n_workers = n_workers
+        # each item is (update, time of its arrival)
+        self.queues: List[queue.Queue] = [
+            queue.Queue(maxsize=max_queue_size) for _ in range(n_workers)
+        ]
+        self._start_lock = threading.Lock()
+        self._started = False
+
+        self.n_processed = 0
+        self.n_errors = 0
+        # how long the last processed update waited in the queue
+        self.last_lag = 0.0
+
+    def submit(self, update: telebot.types.Update) -> None:
+        """Put the update into the queue of its user; if the queue is full, wait for a free place"""
+        self._ensure_started()
+        user_id = get_update_user_id(update)
+        key = user_id if user_id is not None else update.update_id
+        self.queues[hash(key) % self.n_workers].put((update, time.monotonic()))
+
+    @property
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            "depth": self.depth,
+            "processed": self.n_processed,
+            "errors": self.n_errors,
+            "last_lag_seconds": round(self.last_lag, 3),
+        }
+
+    def join(self) -> None:
+        """Wait until all the submitted updates are processed"""
+        for q in self.queues:
+            q.join()
+
+    def _ensure_started(self) -> None:
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i, q in enumerate(self.queues):
+                threading.Thread(
+                    target=self._run, args=(q,), name=f"updates-{i}", daemon=True
+                ).start()
+            self._started = True
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            update, arrival_time = q.get()
+            self.last_lag = time.monotonic() - arrival_time
+            try:
+                self.handle(update)
+            except Exception:
+                self.n_errors += 1
+                logger.exception(f"Error when processing the update {update.update_id}")
+            finally:
+                self.n_processed += 1
+                q.task_done()
@@ -0,0 +1,138 @@
+import functools
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+import sentry_sdk
+from pymongo import DESCENDING  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+from pymongo.errors import DuplicateKeyError  # type: ignore
+
+import metrics
+import models
+from models import queries
+
+logger = logging.getLogger(__name__)
+
+# if the leader has not renewed its lease for this long, another process takes the leadership over
+LEADER_LEASE_SECONDS = 60
+
+
+class LeaderLease:
+    """
+    A named lease in Mongo that at most one process holds at a time: {"_id": name, "holder", "expires_at"}.
+    The holder has to renew it well before it expires; when the holder dies, the lease expires,
+    and the next process that tries to renew it becomes the leader.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        name: str,
+        holder_id: str,
+        lease_seconds: float = LEADER_LEASE_SECONDS,
+    ):
+        self.collection = collection
+        self.name = name
+        self.holder_id = holder_id
+        self.lease_seconds = lease_seconds
+        self.is_leader = False
+
+    def renew(self) -> bool:
+        """Take or prolong the lease if it is free, expired or already ours, and return whether we are the leader"""
+        now = time.time()
+        try:
+            result = self.collection.update_one(
+                {
+                    "_id": self.name,
+                    "$or": [
+                        {"holder": self.holder_id},
+                        {"holder": None},
+                        {"expires_at": {"$lt": now}},
+                    ],
+                },
+                {
+                    "$set": {
+                        "holder": self.holder_id,
+                        "expires_at": now + self.lease_seconds,
+                    }
+                },
+                upsert=True,
+            )
+            is_leader = result.matched_count > 0 or result.upserted_id is not None
+        except DuplicateKeyError:
+            # the lease exists and belongs to another live process, so the upsert has failed
+            is_leader = False
+        if is_leader != self.is_leader:
+            logger.info(
+                f"{self.holder_id} has {'become' if is_leader else 'stopped being'} the leader of {self.name}"
+            )
+        self.is_leader = is_leader
+        return is_leader
+
+    def release(self) -> None:
+        """Give the leadership away immediately (e.g. on a graceful shutdown)"""
+        self.collection.update_one(
+            {"_id": self.name, "holder": self.holder_id},
+            {"$set": {"holder": None, "expires_at": None}},
+        )
+        self.is_leader = False
+
+
+class ScheduledJobs:
+    """
+    Runs the periodic jobs only in the process that holds the leader lease, so that each job runs once per cluster,
+    and records each run with its duration in the `job_runs` collection.
+    """
+
+    def __init__(self, db: models.Database, lease: LeaderLease):
+        self.job_runs = db.job_runs
+        self.lease = lease
+
+    def leader_only(self, job: str, func: Callable) -> Callable:
+        """Wrap a job for the scheduler"""
+        return functools.partial(self.run, job, func)
+
+    def run(self, job: str, func: Callable, **kwargs) -> None:
+        if not self.lease.renew():
+            logger.debug(f"Skipping the job {job}: this process is not the leader")
+            return
+        started_at = time.time()
+        run_id = self.job_runs.insert_one(
+            {
+                "job": job,
+                "holder": self.lease.holder_id,
+                "status": "running",
+                "started_at": started_at,
+            }
+        ).inserted_id
+        status, error = "ok", None
+        try:
+            func(**kwargs)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logger.exception(f"The job {job} has failed")
+            status, error = "failed", str(e)
+        finished_at = time.time()
+        metrics.JOB_SECONDS.labels(job, status).observe(finished_at - started_at)
+        self.job_runs.update_one(
+            {"_id": run_id},
+            {
+                "$set": {
+                    "status": status,
+                    "error": error,
+                    "finished_at": finished_at,
+                    "duration_seconds": round(finished_at - started_at, 3),
+                }
+            },
+        )
+        logger.info(
+            f"The job {job} has finished with the status {status} in {finished_at - started_at:.1f}s"
+        )
+
+    @queries("job_runs", "job", "started_at")
+    def get_recent_runs(self, job: Optional[str] = None, limit: int = 20) -> List[Dict]:
+        query = {} if job is None else {"job": job}
+        return list(
+            self.job_runs.find(query).sort("started_at", DESCENDING).limit(limit)
+        )
@@ -1,14 +1,17 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
+import atexit
 import logging
 import os
 
 import sentry_sdk
+import telebot  # type: ignore
 from apscheduler.schedulers.background import BackgroundScheduler  # type: ignore
 
-from app import DB, DM, bot, server, web_hook
-from web_app import views # noqa
+from app import create_app, get_bot, get_db, get_dm, set_webhook
+from cluster import ClusterWorker, default_worker_id
+from leadership import LeaderLease, ScheduledJobs
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -18,17 +21,50 @@ if os.getenv("SENTRY_DSN", None) is not None:
     sentry_sdk.init(os.environ["SENTRY_DSN"])  # type: ignore
 
 
-scheduler = BackgroundScheduler()
-# https://apscheduler.readthedocs.io/en/stable/modules/triggers/cron.html
-
-# the time in UTC, so the pushes will be sent each 21 pm (by Moscow time)
-scheduler.add_job(DM.run_reminders, "cron", hour=18, jitter=60 * 1)
-
-# Rerun the scheduler every couple of hours (with a jitter of a whole hour)
-scheduler.add_job(DM.run_reminders, "interval", hours=2, jitter=60 * 60)
+def start_scheduler() -> BackgroundScheduler:
+    """Start the periodic jobs of this process; every process has a scheduler, but only the leader runs the jobs"""
+    db, dm = get_db(), get_dm()
+    leader = LeaderLease(
+        db.leader_leases, name="scheduler", holder_id=default_worker_id()
+    )
+    jobs = ScheduledJobs(db, lease=leader)
+    atexit.register(leader.release)
+
+    scheduler = BackgroundScheduler()
+    # https://apscheduler.readthedocs.io/en/stable/modules/triggers/cron.html
+
+    # the leader renews its lease, and the others check whether the leader is still alive
+    scheduler.add_job(leader.renew, "interval", seconds=leader.lease_seconds / 3)
+
+    # the time in UTC, so the pushes will be sent each 21 pm (by Moscow time)
+    scheduler.add_job(
+        jobs.leader_only("daily_reminders", dm.run_reminders),
+        "cron",
+        hour=18,
+        jitter=60 * 1,
+    )
+
+    # Rerun the scheduler every couple of hours (with a jitter of a whole hour)
+    scheduler.add_job(
+        jobs.leader_only("reminders", dm.run_reminders),
+        "interval",
+        hours=2,
+        jitter=60 * 60,
+    )
+
+    # The task statuses are updated after each translation or label; once a day, we check them for consistency
+    scheduler.add_job(
+        jobs.leader_only("task_statuses", db.update_all_task_statuses),
+        "interval",
+        hours=24,
+        jitter=60 * 60,
+        kwargs={"n_workers": int(os.environ.get("STATUS_UPDATE_WORKERS", 1))},
+    )
+    scheduler.start()
 
-# Update the tasks statuses every 3 hours
-scheduler.add_job(DB.update_all_task_statuses, "interval", hours=3, jitter=60 * 60)
+    # if the previous leader has been stopped in the middle of a reminder run, we finish it
+    jobs.run("resume_reminders", dm.campaigns.resume_interrupted)
+    return scheduler
 
 
 def main():
@@ -36,17 +72,33 @@ def main():
     parser.add_argument("--poll", action="store_true")
     parser.add_argument("--web_only", action="store_true")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="process the updates queued by the webhook in the cluster mode (CLUSTER_MODE=1), without the website",
+    )
 
-    scheduler.start()
     args = parser.parse_args()
-
-    if args.poll:
-        bot.remove_webhook()
-        bot.polling()
+    start_scheduler()
+
+    if args.worker:
+        ClusterWorker(
+            db=get_db(),
+            handle=lambda payload: get_bot().process_new_updates(
+                [telebot.types.Update.de_json(payload)]
+            ),
+        ).run_forever()
+    elif args.poll:
+        get_bot().remove_webhook()
+        get_bot().polling()
     else:
         if not args.web_only:
-            web_hook()
-        server.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=bool(args.debug))
+            set_webhook()
+        create_app().run(
+            host="0.0.0.0",
+            port=int(os.environ.get("PORT", 5000)),
+            debug=bool(args.debug),
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import argparse
+import logging
+import os
+import sys
+
+import models
+
+logging.basicConfig(level=logging.INFO)
+
+MONGO_URL = os.environ.get("MONGODB_URI")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance of the bot database")
+    parser.add_argument(
+        "--ensure-indexes",
+        action="store_true",
+        help="create the missing indexes and report the queries that are not supported by any index",
+    )
+    parser.add_argument(
+        "--rebuild-stats",
+        action="store_true",
+        help="recompute the statistics of all projects from scratch",
+    )
+    args = parser.parse_args()
+
+    db = models.Database.setup(mongo_url=MONGO_URL)
+    exit_code = 0
+
+    if args.ensure_indexes:
+        # the indexes are already created by the setup; here we only report the problems
+        unindexed = db.find_unindexed_queries()
+        for shape in unindexed:
+            print(
+                f"No index for {shape.collection} filtered by {shape.fields} (in {shape.method})"
+            )
+        print(f"Indexes are up to date; {len(unindexed)} queries are not indexed.")
+        if unindexed:
+            exit_code = 1
+
+    if args.rebuild_stats:
+        for project in db.get_projects():
+            stats = db.rebuild_project_stats(project_id=project.project_id)
+            print(f"Project {project.project_id}: {stats}")
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
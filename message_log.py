@@ -0,0 +1,114 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pymongo import WriteConcern  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLogWriter:
+    """
+    Writes the conversation log in the background, so that the users do not wait for it.
+    The documents are buffered in a bounded queue and inserted by batches,
+    when `batch_size` documents have accumulated or `flush_seconds` have passed.
+    If the queue is full, the new documents are dropped: the log is not worth slowing the bot down.
+    """
+
+    def __init__(
+        self,
+        collection: Collection,
+        max_queue_size: int = 10_000,
+        batch_size: int = 100,
+        flush_seconds: float = 1.0,
+    ):
+        # the log is not critical, so we do not wait for the acknowledgement of the writes
+        self.collection = collection.with_options(write_concern=WriteConcern(w=0))
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+
+        self._pending: List[Dict] = []
+        self._last_write_time = time.monotonic()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self.n_written = 0
+        self.n_dropped = 0
+
+    @property
+    def depth(self) -> int:
+        """The number of documents waiting to be written"""
+        return self.queue.qsize() + len(self._pending)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self.depth,
+            "written": self.n_written,
+            "dropped": self.n_dropped,
+        }
+
+    def log(self, doc: Dict) -> None:
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(doc)
+        except queue.Full:
+            self.n_dropped += 1
+            logger.warning(
+                f"The message log queue is full; {self.n_dropped} documents dropped so far"
+            )
+
+    def _ensure_started(self) -> None:
+        # the thread is started lazily, so that the processes that do not log anything do not run it
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="message-log-writer", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                doc: Optional[Dict] = self.queue.get(timeout=self.flush_seconds)
+            except queue.Empty:
+                doc = None
+            with self._write_lock:
+                if doc is not None:
+                    self._pending.append(doc)
+                if (
+                    len(self._pending) >= self.batch_size
+                    or time.monotonic() - self._last_write_time >= self.flush_seconds
+                ):
+                    self._write_pending()
+
+    def flush(self) -> None:
+        """Write all the queued documents now"""
+        with self._write_lock:
+            while True:
+                try:
+                    self._pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        self._last_write_time = time.monotonic()
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            self.n_written += len(batch)
+        except Exception:
+            logger.exception(f"Could not write {len(batch)} messages to the log")
@@ -0,0 +1,317 @@
+"""
+The in-process metrics: labeled counters, gauges and latency histograms, served in the Prometheus text format.
+Each set of label values gets its own child with its own lock, created on the first use of these values
+(`timed` creates the children of the decorated functions right away). The buckets of a child are allocated
+when it is created, so recording a value is a dictionary lookup and a few additions,
+and the threads rarely wait for each other.
+"""
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple, TypeVar
+
+# in seconds; from a cached lookup to a slow reminder run
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    60,
+    600,
+)
+# for the numbers of queries and documents
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000)
+
+
+def _format_labels(labelnames: Sequence[str], values: Sequence[str]) -> str:
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = (
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """The child for the given label values; it is created on the first use and reused afterwards"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f"{self.name} expects the labels {self.labelnames}, got {values}"
+                )
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def collect(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in sorted(self._children.items()):
+            lines.extend(
+                child.collect(self.name, _format_labels(self.labelnames, values))
+            )
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def collect(self, name: str, labels: str) -> List[str]:
+        return [f"{name}{labels} {self.value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def collect(self, name: str, labels: str) -> List[str]:
+        return [f"{name}{labels} {self.value}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # the number of observations in each bucket (not cumulative), the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def collect(self, name: str, labels: str) -> List[str]:
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        # the "le" label goes after the others
+        prefix = labels[:-1] + "," if labels else "{"
+        lines = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+MetricType = TypeVar("MetricType", bound=_Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: MetricType) -> MetricType:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+DIALOGUE_SECONDS = REGISTRY.register(
+    Histogram(
+        "bot_dialogue_seconds",
+        "The time to respond to an incoming message, by the dialogue branch",
+        ["branch"],
+    )
+)
+DIALOGUE_ERRORS = REGISTRY.register(
+    Counter(
+        "bot_dialogue_errors_total",
+        "The incoming messages whose processing has failed",
+        ["branch"],
+    )
+)
+DB_SECONDS = REGISTRY.register(
+    Histogram(
+        "bot_db_method_seconds", "The duration of the Database methods", ["method"]
+    )
+)
+TELEGRAM_SECONDS = REGISTRY.register(
+    Histogram(
+        "bot_telegram_call_seconds",
+        "The duration of the outgoing Telegram API calls",
+        ["method"],
+    )
+)
+TELEGRAM_ERRORS = REGISTRY.register(
+    Counter(
+        "bot_telegram_errors_total",
+        "The failed outgoing Telegram API calls",
+        ["method", "code"],
+    )
+)
+DIALOGUE_DB_QUERIES = REGISTRY.register(
+    Histogram(
+        "bot_dialogue_db_queries",
+        "The number of database queries made to respond to a message, by the dialogue branch",
+        ["branch"],
+        buckets=COUNT_BUCKETS,
+    )
+)
+DIALOGUE_DB_DOCUMENTS = REGISTRY.register(
+    Histogram(
+        "bot_dialogue_db_documents",
+        "The number of documents read from the database to respond to a message, by the dialogue branch",
+        ["branch"],
+        buckets=COUNT_BUCKETS,
+    )
+)
+SLOW_DB_OPERATIONS = REGISTRY.register(
+    Counter(
+        "bot_db_slow_operations_total",
+        "The database operations slower than query_log.SLOW_OPERATION_SECONDS",
+        ["collection", "operation"],
+    )
+)
+JOB_SECONDS = REGISTRY.register(
+    Histogram(
+        "bot_job_seconds", "The duration of the scheduled jobs", ["job", "status"]
+    )
+)
+CACHE_REQUESTS = REGISTRY.register(
+    Counter(
+        "bot_cache_requests_total",
+        "The lookups in the in-process caches, by the cache and the result (hit or miss)",
+        ["cache", "result"],
+    )
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge(
+        "bot_queue_depth",
+        "The number of items waiting in the in-process queues",
+        ["queue"],
+    )
+)
+
+
+@contextmanager
+def telegram_call(method: str) -> Iterator[None]:
+    """Time an outgoing Telegram API call, and count its failure by the error code (if Telegram has given one)"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        TELEGRAM_ERRORS.labels(method, str(getattr(e, "error_code", "unknown"))).inc()
+        raise
+    finally:
+        TELEGRAM_SECONDS.labels(method).observe(time.perf_counter() - started)
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable:
+    """A decorator that records the duration of each call of the function"""
+
+    def decorator(func: Callable) -> Callable:
+        child = histogram.labels(*labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_methods(cls: type, histogram: Histogram) -> type:
+    """Time every public method of the class, labeled by its name (the generators are skipped, as they run lazily)"""
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or not inspect.isfunction(func):
+            continue
+        if inspect.isgeneratorfunction(inspect.unwrap(func)):
+            continue
+        setattr(cls, name, timed(histogram, name)(func))
+    return cls
@@ -1,29 +1,260 @@
+import copy
+import functools
 import logging
 import random
+import threading
 import time
 import typing as tp
 from collections import Counter
-from typing import Dict, List, Optional, Set, Union
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import mongomock
 import telebot  # type: ignore
-from pydantic import BaseModel  # type: ignore
-from pymongo import MongoClient  # type: ignore
+from pydantic import BaseModel, PrivateAttr  # type: ignore
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateOne  # type: ignore
 from pymongo.collection import Collection  # type: ignore
+from pymongo.errors import DuplicateKeyError, OperationFailure  # type: ignore
 
 from flask_login import UserMixin
 
+import metrics
+from dedup import DEDUP_TTL_SECONDS
+from events import EventBus, LabelFinalized, TranslationSaved
+from message_log import MessageLogWriter
+from query_log import InstrumentedDatabase
+from sequences import SequenceAllocator
+from session import Session
+from task_scheduler import TaskScheduler
+from ttl_cache import TTLCache
+
 logger = logging.getLogger(__name__)
 
 NO_ID = -1
 NO_USER = -1
+# after 7 days, we treat the user as inactive and the task lease expires
+TASK_LEASE_SECONDS = 60 * 60 * 24 * 7
+# the lease fields are changed only atomically, by claim_task and release_task
+TASK_LEASE_FIELDS = {"locked_by", "locked_until"}
+# how many unsolved inputs are loaded at once to choose the next one; usually, one of the first few is chosen
+WORKING_SET_SIZE = 10
+# how many scheduled tasks to check against the database before giving up on finding a task
+MAX_TASK_PICK_ATTEMPTS = 5
+# pinging the user at most once per 3 days, and at most 10 times in a row
+REMINDER_INTERVAL_SECONDS = 60 * 60 * 24 * 3
+REMINDER_JITTER_SECONDS = 60 * 60 * 12
+MAX_REMINDERS = 10
+# the process that runs a reminder campaign renews its claim on it; an expired claim can be taken over
+REMINDER_RUN_LEASE_SECONDS = 120
+# the outcome of a user who has been claimed by a reminder run but not reminded yet
+REMINDER_PENDING = "pending"
+# how many times a save is retried after the concurrent changes of the same document
+MAX_WRITE_ATTEMPTS = 5
+# the projects are cached in each process, so their changes by other processes appear with this delay
+PROJECT_CACHE_SECONDS = 60
+# the counters that are maintained for each project and shown by /stats
+PROJECT_STATS_KEYS = [
+    "n_inputs",
+    "n_partial",
+    "n_solved",
+    "n_user_translations",
+    "n_rejected_user_translations",
+    "n_labels",
+    "n_positive_labels",
+    "n_negative_labels",
+]
 FLUENT = 2
 COHERENT = 1
 INCOHERENT = 0
 
+# the field values that can be remembered without copying
+IMMUTABLE_TYPES = (type(None), bool, int, float, str, tuple)
+
+
+class IndexSpec(NamedTuple):
+    keys: Tuple[str, ...]
+    unique: bool = False
+    # for the TTL indexes, after how many seconds the documents are deleted
+    expire_after_seconds: Optional[int] = None
+    # only the documents that have the fields are indexed (e.g. for a uniqueness of the flagged documents)
+    sparse: bool = False
+
+
+class QueryShape(NamedTuple):
+    collection: str
+    fields: Tuple[str, ...]
+    method: str
+
+
+# The filters that the database methods use, registered with the `queries` decorator next to each method.
+# They are checked against Database.INDEXES by Database.find_unindexed_queries.
+QUERY_SHAPES: List[QueryShape] = []
+
+
+def index_prefix_length(keys: Tuple[str, ...], fields: tp.Collection[str]) -> int:
+    """How many leading keys of the index are among the fields, i.e. how much of the index a query can use"""
+    length = 0
+    for key in keys:
+        if key not in fields:
+            break
+        length += 1
+    return length
+
+
+def queries(collection: str, *fields: str, autoflush: bool = True) -> Callable:
+    """
+    Register that the decorated function filters the collection by the given fields.
+    If it is a Database method, the pending changes of the current session are written before the query,
+    unless `autoflush` is off (which is safe for the lookups served by the identity map).
+    """
+
+    def decorator(func: Callable) -> Callable:
+        QUERY_SHAPES.append(
+            QueryShape(collection=collection, fields=fields, method=func.__name__)
+        )
+        if not autoflush:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if args and isinstance(args[0], Database):
+                args[0].flush()
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class ConcurrentModificationError(Exception):
+    """The same fields of a document have been changed by someone else since we loaded it"""
+
+
+class DocumentNotFoundError(LookupError):
+    """The document to be changed atomically does not exist (e.g. it has been deleted since we loaded it)"""
+
+
+class TrackedModel(BaseModel):
+    """
+    A model that remembers the field values it had when it was last loaded or written,
+    so that a save sends only the changed fields (or nothing at all).
+    The counter fields are saved as atomic increments, and the other fields are saved
+    only if the document version has not changed since the model was loaded (see Database._write_entity).
+    """
+
+    # incremented by each write that changes the non-counter fields
+    version: int = 0
+
+    # the names of the stored fields, computed once per class
+    stored_fields: ClassVar[Tuple[str, ...]] = ()
+    # the fields that are only incremented, so their concurrent changes can be merged
+    counter_fields: ClassVar[Tuple[str, ...]] = ()
+    _snapshot: Optional[Dict[str, tp.Any]] = PrivateAttr(default=None)
+
+    @classmethod
+    def __pydantic_init_subclass__(cls, **kwargs):
+        super().__pydantic_init_subclass__(**kwargs)
+        cls.stored_fields = tuple(cls.model_fields)
+
+    @classmethod
+    def from_db(cls, obj: Dict):
+        """Construct the model from a database document without validation, and start tracking its changes"""
+        model = cls.model_construct(**obj)
+        model.mark_clean()
+        return model
+
+    def mark_clean(self) -> None:
+        """Remember the current values as the ones stored in the database"""
+        values = self.__dict__
+        self._snapshot = {
+            # the mutable values are copied, so that their in-place changes are detected
+            name: (
+                values[name]
+                if isinstance(values[name], IMMUTABLE_TYPES)
+                else copy.deepcopy(values[name])
+            )
+            for name in self.stored_fields
+            if name in values
+        }
+
+    @property
+    def is_new(self) -> bool:
+        return self._snapshot is None
+
+    def changed_fields(self, exclude: tp.Collection[str] = ()) -> Dict[str, tp.Any]:
+        """
+        The fields that have changed since the model was loaded or written (all the fields, if it is new).
+        For a loaded model, the version and the counters are not included.
+        """
+        values = self.__dict__
+        snapshot = self._snapshot
+        if snapshot is None:
+            return {
+                name: values.get(name)
+                for name in self.stored_fields
+                if name not in exclude
+            }
+        return {
+            name: values.get(name)
+            for name in self.stored_fields
+            if name not in exclude
+            and name != "version"
+            and name not in self.counter_fields
+            and (name not in snapshot or snapshot[name] != values.get(name))
+        }
+
+    def counter_increments(self) -> Dict[str, int]:
+        """How much the counter fields have grown (or decreased) since the model was loaded or written"""
+        if self._snapshot is None:
+            return {}
+        values = self.__dict__
+        increments = {
+            name: (values.get(name) or 0) - (self._snapshot.get(name) or 0)
+            for name in self.counter_fields
+        }
+        return {name: value for name, value in increments.items() if value}
+
+    def adopt(self, obj: Dict) -> None:
+        """
+        Take the stored document as the base of a new model that turned out to exist already:
+        the own fields stay as the changes on top of it, and the own counters become the increments.
+        """
+        fresh = type(self).from_db(obj)
+        for name in self.counter_fields:
+            self.__dict__[name] = (fresh.__dict__.get(name) or 0) + (
+                self.__dict__.get(name) or 0
+            )
+        self.__dict__["version"] = fresh.__dict__.get("version")
+        self._snapshot = fresh._snapshot
+
+    def rebase(self, obj: Dict) -> None:
+        """Take the stored document as the new base, keeping the own unsaved changes on top of it"""
+        changes = self.changed_fields() if not self.is_new else {}
+        increments = self.counter_increments()
+        fresh = type(self).from_db(obj)
+        for name in self.stored_fields:
+            if name in changes:
+                continue
+            value = fresh.__dict__.get(name)
+            if name in increments:
+                value = (value or 0) + increments[name]
+            self.__dict__[name] = value
+        self._snapshot = fresh._snapshot
+
 
 # This is the user representation tailored for Telegram (but not only)
-class UserState(BaseModel):
+class UserState(TrackedModel):
     # Base account information for web users
     password_hash: Optional[str] = None
 
@@ -54,41 +285,33 @@ class UserState(BaseModel):
     n_labels: int = 0
     n_translations: int = 0
 
+    counter_fields: ClassVar[Tuple[str, ...]] = ("n_labels", "n_translations")
+
     # User status
     is_blocked: bool = False  # blocked the bot in Telegram
     block_log: Optional[str] = None
     last_activity_time: Optional[float] = None
     last_reminder_time: Optional[float] = None
     n_last_reminders: int = 0
+    # when the user should get the next reminder (None means never)
+    next_reminder_at: Optional[float] = None
 
     # web settings
     interface_lang: Optional[str] = None
 
-
-def update_user_state(users_collection: Collection, state: UserState):
-    dumped = state.model_dump()
-    print("dumped: ", type(dumped), dumped)
-    users_collection.update_one(
-        filter={"user_id": state.user_id}, update={"$set": dumped}, upsert=True
-    )
-
-
-def find_user(users_collection: Collection, user: telebot.types.User) -> UserState:
-    user_id = user.id
-    obj = users_collection.find_one({"user_id": user_id})
-    if obj is None:
-        print("creating a new user!")
-        state = UserState(
-            user_id=user_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name,
+    def schedule_next_reminder(self) -> None:
+        """Update `next_reminder_at` after an activity of the user, a reminder, or a change of the blocked status"""
+        if self.is_blocked or (self.n_last_reminders or 0) > MAX_REMINDERS:
+            # the user seems to be dead, not bothering them
+            self.next_reminder_at = None
+            return
+        last_contact = max(self.last_activity_time or 0, self.last_reminder_time or 0)
+        # the random delay diversifies the times of the messages
+        self.next_reminder_at = (
+            last_contact
+            + REMINDER_INTERVAL_SECONDS
+            + random.uniform(0, REMINDER_JITTER_SECONDS)
         )
-        update_user_state(users_collection, state)
-    else:
-        print("loading a user!")
-        state = UserState.model_construct(**obj)
-    return state
 
 
 class TransProject(BaseModel):
@@ -105,18 +328,27 @@ class TransProject(BaseModel):
     parent_project_id: Optional[int] = None
 
 
-class TransTask(BaseModel):
+class TransTask(TrackedModel):
     task_id: int
     project_id: int
     completions: int = 0
     prompt: Optional[str] = None
-    locked: bool = False
+    # the task is locked by a user until the lease expires
+    locked_by: Optional[int] = None
+    locked_until: Optional[float] = None
     completed: bool = False
     meta: Optional[Dict] = None
     completion_stats: Optional[Dict[str, int]] = (
         None  # Counter of InputStatus values of its inputs
     )
 
+    counter_fields: ClassVar[Tuple[str, ...]] = ("completions",)
+
+    def is_locked(self, now: Optional[float] = None) -> bool:
+        if self.locked_until is None:
+            return False
+        return self.locked_until > (now or time.time())
+
     @property
     def incompleteness_score(self) -> int:
         """Priority (higher = more important) in terms of covering all inputs with translations."""
@@ -134,7 +366,7 @@ class TransTask(BaseModel):
         return score
 
 
-class TransInput(BaseModel):
+class TransInput(TrackedModel):
     project_id: int
     task_id: int
     input_id: int
@@ -176,7 +408,16 @@ class PrioritizeType:
         }
 
 
-class TransResult(BaseModel):
+# The TaskPool methods that choose a task for each of the prioritization types
+PICK_METHODS = {
+    PrioritizeType.RANDOM: "pick_random",
+    PrioritizeType.LEAST_COMPLETIONS: "pick_least_completions",
+    PrioritizeType.LEAST_COMPLETE: "pick_least_complete",
+    PrioritizeType.MOST_COMPLETE: "pick_most_complete",
+}
+
+
+class TransResult(TrackedModel):
     project_id: int
     task_id: int
     input_id: int
@@ -191,7 +432,7 @@ class TransResult(BaseModel):
     status: int = TransStatus.UNCHECKED
 
 
-class TransLabel(BaseModel):
+class TransLabel(TrackedModel):
     project_id: int
     task_id: int
     input_id: int
@@ -228,6 +469,20 @@ class TransLabel(BaseModel):
             return self.is_coherent and self.semantics_score >= semantic_threshold
 
 
+class TaskWorkingSet(NamedTuple):
+    """Everything needed to choose the next input of a task for a user, loaded by a few bulk queries"""
+
+    project: Optional[TransProject]
+    # the next unsolved inputs of the task, in the order of their ids
+    inputs: List[TransInput]
+    # the translations of these inputs, by input id
+    translations: Dict[int, List[TransResult]]
+    # the translations of the task that the user has already labeled
+    scored_translation_ids: Set[int]
+    # whether `inputs` include all the remaining unsolved inputs of the task
+    exhausted: bool
+
+
 # silly user model
 class FlaskUser(UserMixin):
     def __init__(
@@ -261,13 +516,126 @@ class FlaskUser(UserMixin):
         return str(self.id)
 
 
+def compute_input_status(translations: tp.Iterable[TransResult]) -> str:
+    """Find the InputStatus of an input with the given translations"""
+    status = InputStatus.NO_TRANSLATION
+    for translation in translations:
+        # rejected or duplicate translations do not count
+        if translation.status in {TransStatus.REJECTED, TransStatus.DUPLICATE}:
+            continue
+        # if there is a translation, reflect in the status that it exists
+        if translation.user_id == NO_USER:
+            status = max(status, InputStatus.UNCHECKED_SYSTEM_TRANSLATION)
+        else:
+            status = max(status, InputStatus.UNCHECKED_USER_TRANSLATION)
+        # if the translation has positive feedback, reflect it
+        if translation.n_approvals > 0:
+            status = max(status, InputStatus.PARTIALLY_ACCEPTED)
+        if translation.status == TransStatus.ACCEPTED:
+            status = max(status, InputStatus.ACCEPTED)
+    return status
+
+
+# the connection of a worker process of `update_all_task_statuses`, reused for all the chunks it processes
+_worker_db: Optional["Database"] = None
+
+
+def _connect_worker_process(mongo_url: str) -> None:
+    # each worker process needs its own connection; the indexes have been created by the parent process
+    global _worker_db
+    _worker_db = Database.setup(mongo_url=mongo_url, ensure_indexes=False)
+
+
+def _rebuild_task_statuses_in_process(
+    project_id: int, task_id_range: Tuple[int, int]
+) -> None:
+    assert _worker_db is not None, "The worker process has not been initialized"
+    _worker_db.rebuild_task_statuses(project_id=project_id, task_id_range=task_id_range)
+
+
 class Database:
+    # The indexes for all the collections; they are created (idempotently) by `ensure_indexes`
+    INDEXES: Dict[str, List[IndexSpec]] = {
+        "users": [
+            IndexSpec(("user_id",), unique=True),
+            IndexSpec(("username",)),
+            IndexSpec(("next_reminder_at",)),
+            IndexSpec(("is_blocked",)),
+        ],
+        "trans_projects": [
+            IndexSpec(("project_id",), unique=True),
+            IndexSpec(("is_active",)),
+        ],
+        "trans_tasks": [
+            IndexSpec(("task_id",), unique=True),
+            IndexSpec(("project_id", "completed")),
+            IndexSpec(("project_id", "task_id")),
+            IndexSpec(("locked_by",)),
+        ],
+        "trans_inputs": [
+            IndexSpec(("input_id",), unique=True),
+            IndexSpec(("task_id", "solved", "input_id")),
+            # includes task and input ids to cover the distinct() queries
+            IndexSpec(("project_id", "solved", "task_id", "input_id")),
+        ],
+        "trans_results": [
+            IndexSpec(("translation_id",), unique=True),
+            IndexSpec(("input_id", "status")),
+            IndexSpec(("project_id", "status")),
+            IndexSpec(("project_id", "task_id")),
+        ],
+        "trans_labels": [
+            IndexSpec(("label_id",), unique=True),
+            IndexSpec(("user_id", "task_id")),
+            IndexSpec(("user_id", "project_id")),
+            IndexSpec(("project_id",)),
+            # for joining the labels to the translations
+            IndexSpec(("translation_id", "user_id")),
+        ],
+        "user_task_map": [
+            IndexSpec(("user_id", "task_id"), unique=True),
+        ],
+        "project_stats": [
+            IndexSpec(("project_id",), unique=True),
+        ],
+        "reminder_runs": [
+            IndexSpec(("run_id",), unique=True),
+            IndexSpec(("status",)),
+            # at most one run is unfinished at a time
+            IndexSpec(("active",), unique=True, sparse=True),
+        ],
+        "reminder_outcomes": [
+            IndexSpec(("run_id", "user_id"), unique=True),
+        ],
+        "update_queue": [
+            IndexSpec(("partition", "_id")),
+        ],
+        "cluster_workers": [
+            IndexSpec(("heartbeat",)),
+        ],
+        "processed_updates": [
+            IndexSpec(("created_at",), expire_after_seconds=DEDUP_TTL_SECONDS),
+        ],
+        "job_runs": [
+            IndexSpec(("job", "started_at")),
+        ],
+    }
+
     def __init__(self, mongo_db):
+        self.mongo_db = mongo_db
+        # the url to connect to the same database from other processes
+        self.mongo_url: Optional[str] = None
+        # some queries have a simpler implementation for the in-memory mongomock database
+        self.is_mock = isinstance(mongo_db, mongomock.Database)
+        # the operations on the collections are counted per message, and the slow ones are logged
+        mongo_db = InstrumentedDatabase(mongo_db)
+
         # UserState
         self.mongo_users: Collection = mongo_db.get_collection("users")
 
         # user_id, from_user, text, timestamp, message_id
         self.mongo_messages: Collection = mongo_db.get_collection("messages")
+        self.message_log = MessageLogWriter(self.mongo_messages)
 
         # translation-related stuff
         self.trans_projects: Collection = mongo_db.get_collection("trans_projects")
@@ -276,9 +644,68 @@ class Database:
         self.trans_results: Collection = mongo_db.get_collection("trans_results")
         self.trans_labels: Collection = mongo_db.get_collection("trans_labels")
         self.user_task_map: Collection = mongo_db.get_collection("user_task_map")
+        # project_id and the PROJECT_STATS_KEYS counters
+        self.project_stats: Collection = mongo_db.get_collection("project_stats")
+
+        # run_id, status, started_at, finished_at, requested_by, outcomes (counter of outcomes)
+        self.reminder_runs: Collection = mongo_db.get_collection("reminder_runs")
+        # run_id, user_id, outcome, error, time
+        self.reminder_outcomes: Collection = mongo_db.get_collection(
+            "reminder_outcomes"
+        )
+
+        # the keys of the handled updates (as _id) and created_at, see UpdateDeduplicator
+        self.processed_updates: Collection = mongo_db.get_collection(
+            "processed_updates"
+        )
+
+        # the cluster mode (see cluster.py): the queued updates, the owners of their partitions, and the workers
+        self.update_queue: Collection = mongo_db.get_collection("update_queue")
+        self.partition_leases: Collection = mongo_db.get_collection("partition_leases")
+        self.cluster_workers: Collection = mongo_db.get_collection("cluster_workers")
+
+        # the periodic jobs (see leadership.py): the lease of the process that runs them, and the history of the runs
+        self.leader_leases: Collection = mongo_db.get_collection("leader_leases")
+        # job, holder, status, error, started_at, finished_at, duration_seconds
+        self.job_runs: Collection = mongo_db.get_collection("job_runs")
+
+        # the project documents and lists, which are read often but almost never change
+        self.project_cache = TTLCache("projects", ttl_seconds=PROJECT_CACHE_SECONDS)
+
+        # the request-scoped sessions, one per thread (see `session`)
+        self._local = threading.local()
+
+        # an in-memory index of incomplete tasks, kept up to date by save_task
+        self.task_scheduler = TaskScheduler()
+
+        # the input statuses and task completion stats are updated after each change of the translations
+        self.events = EventBus()
+        self.events.subscribe(TranslationSaved, self._on_translation_changed)
+        self.events.subscribe(LabelFinalized, self._on_translation_changed)
+
+        # {"_id": sequence name, "seq": last allocated id}
+        self.counters: Collection = mongo_db.get_collection("counters")
+        self.sequences = SequenceAllocator(
+            counters=self.counters,
+            seeders={
+                "project_id": lambda: self._get_max_value(
+                    self.trans_projects, "project_id"
+                ),
+                "task_id": lambda: self._get_max_value(self.trans_tasks, "task_id"),
+                "input_id": lambda: self._get_max_value(self.trans_inputs, "input_id"),
+                "translation_id": lambda: self._get_max_value(
+                    self.trans_results, "translation_id"
+                ),
+                "label_id": lambda: self._get_max_value(self.trans_labels, "label_id"),
+                # web user ids are negative, so we count them in the opposite direction
+                "web_user_id": lambda: -min(
+                    self._get_min_value(self.mongo_users, "user_id"), 0
+                ),
+            },
+        )
 
     @classmethod
-    def setup(cls, mongo_url: Optional[str]) -> "Database":
+    def setup(cls, mongo_url: Optional[str], ensure_indexes: bool = True) -> "Database":
         mongo_client: Union[MongoClient, mongomock.MongoClient]
         if mongo_url is not None:
             mongo_client = MongoClient(mongo_url)
@@ -286,24 +713,447 @@ class Database:
         else:
             mongo_client = mongomock.MongoClient()
             mongo_db = mongo_client.db
-        return Database(mongo_db=mongo_db)
+        db = Database(mongo_db=mongo_db)
+        db.mongo_url = mongo_url
+        if ensure_indexes:
+            db.ensure_indexes()
+        return db
+
+    def ensure_indexes(self) -> None:
+        """Create all the registered indexes. Creating an existing index is a no-op."""
+        for collection_name, specs in self.INDEXES.items():
+            collection = self.mongo_db.get_collection(collection_name)
+            for spec in specs:
+                options: Dict[str, tp.Any] = {"unique": spec.unique}
+                if spec.expire_after_seconds is not None:
+                    options["expireAfterSeconds"] = spec.expire_after_seconds
+                if spec.sparse:
+                    options["sparse"] = True
+                try:
+                    collection.create_index(
+                        [(key, ASCENDING) for key in spec.keys], **options
+                    )
+                except OperationFailure as e:
+                    # e.g. there are duplicate ids that do not allow a unique index
+                    logger.error(
+                        f"Could not create the index {spec} on {collection_name}: {e}"
+                    )
+        for shape in self.find_unindexed_queries():
+            logger.warning(f"The query {shape} is not supported by any index")
+
+    @classmethod
+    def find_unindexed_queries(cls) -> List[QueryShape]:
+        """
+        Find the registered queries that most of their fields have to filter without an index:
+        only the longest prefix of an index that consists of the filtered fields narrows the scan.
+        A query that includes all the keys of a unique index finds at most one document, so it is always covered.
+        """
+        unindexed = []
+        for shape in QUERY_SHAPES:
+            fields = set(shape.fields)
+            n_indexed = 0
+            for spec in cls.INDEXES.get(shape.collection, []):
+                prefix = index_prefix_length(spec.keys, fields)
+                if spec.unique and prefix == len(spec.keys):
+                    n_indexed = len(fields)
+                    break
+                n_indexed = max(n_indexed, prefix)
+            if n_indexed * 2 < len(fields):
+                unindexed.append(shape)
+        return unindexed
+
+    def _bulk_update(
+        self,
+        collection: Collection,
+        updates: List[Tuple[Dict, Dict]],
+        upsert: bool = False,
+    ) -> None:
+        """Apply a list of (filter, update) pairs in a single round trip"""
+        if not updates:
+            return
+        if self.is_mock or len(updates) == 1:
+            # mongomock does not support the bulk operations of the recent pymongo versions
+            for fltr, update in updates:
+                collection.update_one(fltr, update, upsert=upsert)
+            return
+        collection.bulk_write(
+            [UpdateOne(fltr, update, upsert=upsert) for fltr, update in updates],
+            ordered=False,
+        )
+
+    def _write_changes(
+        self,
+        collection: Collection,
+        key: str,
+        entities: tp.Sequence[TrackedModel],
+        exclude: tp.Collection[str] = (),
+    ) -> None:
+        """Write only the changed fields of the entities; the unchanged entities are not written at all"""
+        for entity in entities:
+            self._write_entity(collection, key, entity, exclude=exclude)
+
+    def _write_entity(
+        self,
+        collection: Collection,
+        key: str,
+        entity: TrackedModel,
+        exclude: tp.Collection[str] = (),
+    ) -> None:
+        """
+        Save the changes of the entity with optimistic concurrency control.
+        The counters are incremented atomically. The other changed fields are set only if the document version
+        is the one we have loaded; otherwise, we reload the document and retry, unless someone else
+        has changed the same fields.
+        """
+        entity_filter = {key: getattr(entity, key)}
+        if entity.is_new:
+            fields = entity.changed_fields(exclude=exclude)
+            try:
+                collection.insert_one(dict(fields))
+                entity.mark_clean()
+                return
+            except DuplicateKeyError:
+                pass
+            # the document has been created concurrently: our fields are saved on top of it like the changes
+            # of a loaded entity, unless they would overwrite the values set by someone else
+            fresh = collection.find_one(entity_filter)
+            if fresh is None:
+                raise ConcurrentModificationError(
+                    f"{collection.name} {entity_filter} has been created and deleted concurrently"
+                )
+            conflicts = [
+                name
+                for name, value in fields.items()
+                if name != "version"
+                and name not in entity.counter_fields
+                and fresh.get(name) is not None
+                and fresh[name] != value
+            ]
+            if conflicts:
+                raise ConcurrentModificationError(
+                    f"The fields {conflicts} of {collection.name} {entity_filter} have been set concurrently"
+                )
+            entity.adopt(fresh)
+
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            changes = entity.changed_fields(exclude=exclude)
+            increments = entity.counter_increments()
+            if not changes:
+                if increments:
+                    collection.update_one(entity_filter, {"$inc": increments})
+                entity.mark_clean()
+                return
+            version = entity.version or 0
+            result = collection.update_one(
+                # the documents saved before the versioning have no version at all
+                {**entity_filter, "version": version or {"$in": [0, None]}},
+                {"$set": changes, "$inc": {**increments, "version": 1}},
+            )
+            if result.matched_count:
+                entity.version = version + 1
+                entity.mark_clean()
+                return
+
+            # the document has been changed since we loaded it; we check whether the changes overlap
+            fresh = collection.find_one(entity_filter)
+            if fresh is None:
+                collection.update_one(
+                    entity_filter, {"$set": entity.model_dump()}, upsert=True
+                )
+                entity.mark_clean()
+                return
+            snapshot = entity._snapshot or {}
+            conflicts = [
+                name
+                for name, value in changes.items()
+                if name in fresh
+                and fresh[name] != snapshot.get(name)
+                and fresh[name] != value
+            ]
+            if conflicts:
+                raise ConcurrentModificationError(
+                    f"The fields {conflicts} of {collection.name} {entity_filter} have been changed concurrently"
+                )
+            entity.rebase(fresh)
+        raise ConcurrentModificationError(
+            f"Could not save {collection.name} {entity_filter} after {MAX_WRITE_ATTEMPTS} attempts"
+        )
+
+    def _refresh_cached(self, kind: str, key: int, obj: Dict) -> None:
+        """After an atomic update of a document, bring its copy in the current session up to date"""
+        session = self.current_session
+        cached = session.lookup(kind, key) if session else None
+        if cached is not None:
+            cached.rebase(obj)
+
+    @property
+    def current_session(self) -> Optional[Session]:
+        return getattr(self._local, "session", None)
+
+    @contextmanager
+    def session(self) -> tp.Iterator[Session]:
+        """
+        Open a request-scoped session: within it, the entities are loaded at most once,
+        and the changes of the existing entities are written in batches when the session is flushed
+        (before the other queries, and at the exit from the session, unless it exits with an error).
+        Nested calls reuse the outer session.
+        """
+        current = self.current_session
+        if current is not None:
+            yield current
+            return
+        session = Session()
+        self._local.session = session
+        try:
+            yield session
+        except BaseException:
+            # the pending changes of a failed message are not written, and a failing flush cannot hide the error
+            self._local.session = None
+            raise
+        self._local.session = None
+        session.flush()
+        logger.debug(
+            f"Session closed: {session.n_loads} loads, {session.n_hits} hits, {session.n_flushes} flushes"
+        )
+
+    def flush(self) -> None:
+        """Write the pending changes of the current session, if any"""
+        session = self.current_session
+        if session is not None:
+            session.flush()
 
+    def _load(self, kind: str, key: int, loader: Callable[[], tp.Any]) -> tp.Any:
+        session = self.current_session
+        if session is None:
+            return loader()
+        return session.get(kind, key, loader)
+
+    def _save(
+        self,
+        kind: str,
+        key: int,
+        entity: tp.Any,
+        writer: Callable[[List[tp.Any]], None],
+    ) -> None:
+        """Write the entity now, or mark it as dirty if there is a session"""
+        session = self.current_session
+        if session is None:
+            writer([entity])
+        else:
+            session.mark_dirty(kind, key, entity, writer)
+
+    def _remember(self, kind: str, key: int, entity: tp.Any) -> None:
+        """Put a newly created entity into the identity map of the current session"""
+        session = self.current_session
+        if session is not None:
+            session.add(kind, key, entity)
+
+    @staticmethod
+    def _get_max_value(collection: Collection, field: str) -> int:
+        for obj in collection.find({field: {"$ne": None}}).sort(field, -1).limit(1):
+            return obj[field]
+        return 0
+
+    @staticmethod
+    def _get_min_value(collection: Collection, field: str) -> int:
+        for obj in collection.find({field: {"$ne": None}}).sort(field, 1).limit(1):
+            return obj[field]
+        return 0
+
+    @queries("users", "user_id", autoflush=False)
     def get_user(self, user_id: int) -> Optional[UserState]:
+        return self._load("user", user_id, lambda: self._find_user(user_id))
+
+    def _find_user(self, user_id: int) -> Optional[UserState]:
         obj = self.mongo_users.find_one({"user_id": user_id})
         if obj:
-            user = UserState.model_construct(**obj)
+            user = UserState.from_db(obj)
             return user
         return None
 
+    def get_or_create_user(self, tg_user: telebot.types.User) -> UserState:
+        """Load the state of the Telegram user (through the session), or create it for a new user"""
+        user = self.get_user(tg_user.id)
+        if user is None:
+            logger.info(f"Creating a new user {tg_user.id}")
+            user = UserState(
+                user_id=tg_user.id,
+                username=tg_user.username,
+                first_name=tg_user.first_name,
+                last_name=tg_user.last_name,
+            )
+            self.save_user(user)
+        return user
+
     def save_user(self, user: UserState) -> None:
-        update_user_state(users_collection=self.mongo_users, state=user)
+        assert user.user_id is not None, "Cannot save a user without an id"
+        self._save("user", user.user_id, user, self._write_users)
+
+    def _write_users(self, users: List[UserState]) -> None:
+        self._write_changes(self.mongo_users, "user_id", users)
 
     def get_all_users(self) -> List[UserState]:
-        return [UserState.model_construct(**obj) for obj in self.mongo_users.find()]
+        return [UserState.from_db(obj) for obj in self.mongo_users.find()]
+
+    @queries("users", "next_reminder_at")
+    def iter_users_due_for_reminder(self, now: float) -> tp.Iterator[UserState]:
+        """Stream the users whose next reminder is due, in the order of their due time"""
+        cursor = self.mongo_users.find({"next_reminder_at": {"$lte": now}}).sort(
+            "next_reminder_at", ASCENDING
+        )
+        for obj in cursor:
+            yield UserState.from_db(obj)
+
+    @queries("users", "next_reminder_at")
+    def backfill_reminder_schedule(self) -> int:
+        """Compute `next_reminder_at` for the users saved before this field existed"""
+        legacy = list(self.mongo_users.find({"next_reminder_at": {"$exists": False}}))
+        updates = []
+        for obj in legacy:
+            user = UserState.from_db(obj)
+            user.schedule_next_reminder()
+            updates.append(
+                (
+                    {"user_id": user.user_id},
+                    {
+                        "$set": {"next_reminder_at": user.next_reminder_at},
+                        "$inc": {"version": 1},
+                    },
+                )
+            )
+        self._bulk_update(self.mongo_users, updates)
+        if updates:
+            logger.info(f"Scheduled the reminders for {len(updates)} legacy users")
+        return len(updates)
+
+    @queries("reminder_runs", "status")
+    def get_unfinished_reminder_run(self) -> Optional[Dict]:
+        return self.reminder_runs.find_one(
+            {"status": "running"}, sort=[("run_id", ASCENDING)]
+        )
+
+    @queries("reminder_runs", "status")
+    def claim_reminder_run(
+        self, owner: str, requested_by: Optional[int] = None
+    ) -> Optional[Dict]:
+        """
+        Take the unfinished run if it is not claimed by a live process, or create a new one if there is none.
+        Return None if another process is running a campaign.
+        """
+        now = time.time()
+        run = self.reminder_runs.find_one_and_update(
+            {
+                "status": "running",
+                "$or": [
+                    {"owner": owner},
+                    {"owner": None},
+                    {"expires_at": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "owner": owner,
+                    "expires_at": now + REMINDER_RUN_LEASE_SECONDS,
+                }
+            },
+            sort=[("run_id", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if run is not None:
+            return run
+        if self.get_unfinished_reminder_run() is not None:
+            return None
+        run = {
+            "run_id": self.sequences.next_id("reminder_run_id"),
+            "status": "running",
+            # unique, so that the processes that start a campaign at the same time do not both create a run
+            "active": True,
+            "owner": owner,
+            "expires_at": now + REMINDER_RUN_LEASE_SECONDS,
+            "started_at": now,
+            "finished_at": None,
+            "requested_by": requested_by,
+            "outcomes": {},
+        }
+        try:
+            self.reminder_runs.insert_one(run)
+        except DuplicateKeyError:
+            return None
+        return run
+
+    @queries("reminder_runs", "run_id")
+    def renew_reminder_run(self, run_id: int, owner: str) -> bool:
+        """Prolong the claim on the run, and return whether it is still ours"""
+        result = self.reminder_runs.update_one(
+            {"run_id": run_id, "owner": owner, "status": "running"},
+            {"$set": {"expires_at": time.time() + REMINDER_RUN_LEASE_SECONDS}},
+        )
+        return result.matched_count > 0
+
+    @queries("reminder_runs", "run_id")
+    def finish_reminder_run(self, run_id: int) -> Optional[Dict]:
+        return self.reminder_runs.find_one_and_update(
+            {"run_id": run_id},
+            {
+                "$set": {"status": "finished", "finished_at": time.time()},
+                "$unset": {"active": ""},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @queries("reminder_outcomes", "run_id")
+    def get_reminded_user_ids(self, run_id: int) -> Set[int]:
+        return set(self.reminder_outcomes.distinct("user_id", {"run_id": run_id}))
+
+    @queries("reminder_outcomes", "run_id", "user_id")
+    def claim_reminder_user(self, run_id: int, user_id: int) -> bool:
+        """
+        Record that the user is being reminded within the run, before the reminder is sent,
+        and return False if the user has already been claimed: no one is reminded twice, even after a crash.
+        """
+        result = self.reminder_outcomes.update_one(
+            {"run_id": run_id, "user_id": user_id},
+            {"$setOnInsert": {"outcome": REMINDER_PENDING, "time": time.time()}},
+            upsert=True,
+        )
+        return result.upserted_id is not None
+
+    @queries("reminder_outcomes", "run_id", "user_id")
+    def record_reminder_outcome(
+        self, run_id: int, user_id: int, outcome: str, error: Optional[str] = None
+    ) -> None:
+        result = self.reminder_outcomes.update_one(
+            {"run_id": run_id, "user_id": user_id, "outcome": REMINDER_PENDING},
+            {"$set": {"outcome": outcome, "error": error, "time": time.time()}},
+        )
+        # the counters of the run are incremented only once per user, even if the outcome is recorded twice
+        if result.modified_count > 0:
+            self.reminder_runs.update_one(
+                {"run_id": run_id}, {"$inc": {f"outcomes.{outcome}": 1}}
+            )
+
+    @queries("users", "is_blocked")
+    def reset_blocked_users(self) -> int:
+        """Detach the users who have blocked the bot from their current tasks"""
+        curr_fields = [
+            "curr_task_id",
+            "curr_sent_id",
+            "curr_label_id",
+            "curr_result_id",
+        ]
+        result = self.mongo_users.update_many(
+            {
+                "is_blocked": True,
+                "$or": [{field: {"$ne": None}} for field in curr_fields],
+            },
+            {"$set": {field: None for field in curr_fields}, "$inc": {"version": 1}},
+        )
+        return result.modified_count
 
+    @queries("trans_tasks", "completed", "project_id")
     def get_incomplete_tasks_for_project(self, project_id: int) -> List[TransTask]:
         tasks = [
-            TransTask.model_construct(**obj)
+            TransTask.from_db(obj)
             for obj in self.trans_tasks.find(
                 {
                     "completed": False,
@@ -313,149 +1163,226 @@ class Database:
         ]
         return tasks
 
+    def _load_task_schedule(self, project_id: int) -> None:
+        if self.task_scheduler.needs_loading(project_id):
+            tasks = self.get_incomplete_tasks_for_project(project_id=project_id)
+            self.task_scheduler.load(
+                project_id,
+                [
+                    (
+                        task.task_id,
+                        task.completions,
+                        task.incompleteness_score,
+                        task.locked_until,
+                    )
+                    for task in tasks
+                ],
+            )
+
+    def warm_task_scheduler(self) -> None:
+        """Load the incomplete tasks of all active projects into the scheduler"""
+        for project in self.get_projects(active=True):
+            self._load_task_schedule(project_id=project.project_id)
+
+    @queries("user_task_map", "user_id")
     def get_new_task(
         self, user: UserState, prioritize_type: Optional[str] = None
     ) -> Optional[TransTask]:
         if user.curr_proj_id is None:
             return None
-        self.cleanup_locked_tasks()
-        tasks = self.get_incomplete_tasks_for_project(project_id=user.curr_proj_id)
-
-        unfinished_task_ids = {
-            (task.task_id, task.completions) for task in tasks if task.locked is False
-        }
-        if len(unfinished_task_ids) == 0:
-            # if all unfinished tasks are locked, pick any of the locked ones
-            unfinished_task_ids = {(task.task_id, task.completions) for task in tasks}
-        if len(unfinished_task_ids) == 0:
+        project_id = user.curr_proj_id
+        self._load_task_schedule(project_id=project_id)
+        if self.task_scheduler.count(project_id) == 0:
             logger.info(f"Did not find any unfinished tasks!")
             return None
 
+        if prioritize_type not in PrioritizeType.all():
+            prioritize_type = random.choice(list(PrioritizeType.all()))
+        pick_method = PICK_METHODS[prioritize_type]
+
         # prioritize the tasks that the user has not contributed yet
         user_tasks = {
             obj["task_id"] for obj in self.user_task_map.find({"user_id": user.user_id})
         }
-        tasks_untouched_by_user = {
-            (task_id, completion)
-            for task_id, completion in unfinished_task_ids
-            if task_id not in user_tasks
-        }
-
-        if len(tasks_untouched_by_user) > 0:
-            unfinished_task_ids = tasks_untouched_by_user
-        else:
-            # If all the tasks are touched by the user, apply some more filtering.
-            # In principle, we should only keep the tasks where there are unsolved inputs with:
-            # - either pending translations that were neither produced nor labeled by the user
-            # - or without pending (or accepted) translations at all
-            unsolved_inputs = [
-                TransInput.model_construct(**obj)
-                for obj in self.trans_inputs.find(
-                    {"solved": False, "project_id": user.curr_proj_id}
-                )
-            ]
-            pending_translations = [
-                TransResult.model_construct(**obj)
-                for obj in self.trans_results.find(
-                    {"status": TransStatus.UNCHECKED, "project_id": user.curr_proj_id}
-                )
-            ]
-            user_labels = [
-                TransLabel.model_construct(**obj)
-                for obj in self.trans_labels.find(
-                    {"user_id": user.user_id, "project_id": user.curr_proj_id}
+        good_task_ids: Optional[Set[int]] = None
+        # the scheduler of this process may be stale, so the chosen task is checked against the database
+        stale_task_ids: Set[int] = set()
+        for _ in range(MAX_TASK_PICK_ATTEMPTS):
+            # if all the unfinished tasks are locked, the scheduler picks one of the locked ones to share
+            from_locked_pool = self.task_scheduler.count_unlocked(project_id) == 0
+            task_id = self.task_scheduler.pick(
+                project_id,
+                pick_method,
+                lambda t_id: t_id not in user_tasks and t_id not in stale_task_ids,
+            )
+            if task_id is None:
+                # If all the tasks are touched by the user, apply some more filtering.
+                if good_task_ids is None:
+                    good_task_ids = self.get_task_ids_with_work_for_user(
+                        project_id=project_id, user_id=user.user_id
+                    )
+                task_id = self.task_scheduler.pick(
+                    project_id,
+                    pick_method,
+                    lambda t_id: t_id in (good_task_ids or ())
+                    and t_id not in stale_task_ids,
                 )
-            ]
-
-            translation_ids_labeled_by_user = {
-                lab.translation_id for lab in user_labels
-            }
-            input_ids_to_label = {
-                t.input_id
-                for t in pending_translations
-                if t.user_id != user.user_id
-                and t.translation_id not in translation_ids_labeled_by_user
-            }
-            input_ids_with_pending_translations = {
-                t.input_id for t in pending_translations
-            }
-            good_task_ids = {
-                inp.task_id
-                for inp in unsolved_inputs
-                if inp.input_id in input_ids_to_label
-                or inp.input_id not in input_ids_with_pending_translations
-            }
-            unfinished_task_ids = {
-                (task_id, completion)
-                for task_id, completion in unfinished_task_ids
-                if task_id in good_task_ids
-            }
-
-        if len(unfinished_task_ids) == 0:
-            logger.info(f"Did not find any unfinished tasks!")
-            return None
-
-        # choose the specific task
-        id2priority = {task.task_id: task.incompleteness_score for task in tasks}
-
-        if prioritize_type not in PrioritizeType.all():
-            prioritize_type = random.choice(list(PrioritizeType.all()))
+            if task_id is None:
+                break
+            task = self.get_task(task_id)
+            if (
+                task is not None
+                and not task.completed
+                and (from_locked_pool or self._is_task_free(task, user.user_id))
+            ):
+                logger.info(f"Chose the task {task_id} ({prioritize_type}).")
+                return task
+            logger.info(f"The scheduled task {task_id} is not available any more.")
+            if task is None or task.completed:
+                stale_task_ids.add(task_id)
+            # a task leased meanwhile moves to the locked pool, where it can still be shared
+            self._refresh_task_in_scheduler(project_id, task_id, task)
+
+        logger.info(f"Did not find any unfinished tasks!")
+        return None
 
-        n = len(unfinished_task_ids)
-        if prioritize_type == PrioritizeType.LEAST_COMPLETIONS:
-            # 1/4 of the time, prioritize the tasks with the lowest number of completions
-            min_completion = min(
-                [completion for task_id, completion in unfinished_task_ids]
+    @staticmethod
+    def _is_task_free(task: TransTask, user_id: Optional[int]) -> bool:
+        return task.locked_by == user_id or not task.is_locked()
+
+    def _refresh_task_in_scheduler(
+        self, project_id: int, task_id: int, task: Optional[TransTask]
+    ) -> None:
+        if task is None:
+            # the task has been deleted
+            self.task_scheduler.update(
+                project_id, task_id, completions=0, score=0, completed=True
             )
-            least_completed_ids = [
-                task_id
-                for task_id, completion in unfinished_task_ids
-                if completion == min_completion
-            ]
+            return
+        self._update_task_in_scheduler(task)
+        self.task_scheduler.set_lease(project_id, task_id, task.locked_until)
+
+    @queries("trans_inputs", "project_id", "solved")
+    @queries("trans_results", "input_id", "status")
+    @queries("trans_labels", "translation_id", "user_id")
+    def get_task_ids_with_work_for_user(
+        self, project_id: int, user_id: Optional[int]
+    ) -> Set[int]:
+        """
+        Find the tasks where there are unsolved inputs with:
+        - either pending translations that were neither produced nor labeled by the user
+        - or without pending (or accepted) translations at all
+        It is a single aggregation that joins the translations and the labels of each unsolved input,
+        so only the task ids are transferred from the database, and no id lists are sent to it.
+        """
+        if self.is_mock:
+            return self._get_task_ids_with_work_for_user_in_python(project_id, user_id)
+        pipeline: List[Dict[str, tp.Any]] = [
+            {"$match": {"project_id": project_id, "solved": False}},
+            {"$project": {"_id": 0, "input_id": 1, "task_id": 1}},
+            {
+                "$lookup": {
+                    "from": "trans_results",
+                    "localField": "input_id",
+                    "foreignField": "input_id",
+                    "as": "translations",
+                }
+            },
+            {
+                "$project": {
+                    "input_id": 1,
+                    "task_id": 1,
+                    "pending": {
+                        "$filter": {
+                            "input": "$translations",
+                            "as": "res",
+                            "cond": {"$eq": ["$$res.status", TransStatus.UNCHECKED]},
+                        }
+                    },
+                }
+            },
+            # one document per pending translation (or one without it, if the input has none)
+            {"$unwind": {"path": "$pending", "preserveNullAndEmptyArrays": True}},
+            {
+                "$lookup": {
+                    "from": "trans_labels",
+                    "localField": "pending.translation_id",
+                    "foreignField": "translation_id",
+                    "as": "labels",
+                }
+            },
+            {
+                "$project": {
+                    "input_id": 1,
+                    "task_id": 1,
+                    "is_pending": {
+                        "$ne": [{"$ifNull": ["$pending.translation_id", None]}, None]
+                    },
+                    "is_labeled_by_user": {
+                        "$in": [user_id, {"$ifNull": ["$labels.user_id", []]}]
+                    },
+                    "is_by_user": {
+                        "$eq": [{"$ifNull": ["$pending.user_id", None]}, user_id]
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": "$input_id",
+                    "task_id": {"$first": "$task_id"},
+                    "n_pending": {"$sum": {"$cond": ["$is_pending", 1, 0]}},
+                    "n_to_label": {
+                        "$sum": {
+                            "$cond": [
+                                {
+                                    "$and": [
+                                        "$is_pending",
+                                        {"$eq": ["$is_by_user", False]},
+                                        {"$eq": ["$is_labeled_by_user", False]},
+                                    ]
+                                },
+                                1,
+                                0,
+                            ]
+                        }
+                    },
+                }
+            },
+            {"$match": {"$or": [{"n_pending": 0}, {"n_to_label": {"$gt": 0}}]}},
+            {"$group": {"_id": "$task_id"}},
+        ]
+        return {obj["_id"] for obj in self.trans_inputs.aggregate(pipeline)}
 
-            task_id = random.choice(least_completed_ids)
-            logger.info(
-                f"Chose the task {task_id} among {n} options (least completions)"
-            )
-        elif prioritize_type == PrioritizeType.LEAST_COMPLETE:
-            # 1/4 of the time, prioritize the tasks with the highest incompleteness score
-            max_score = max(
-                [
-                    id2priority.get(task_id, 0)
-                    for task_id, completion in unfinished_task_ids
-                ]
-            )
-            least_completed_ids = [
-                task_id
-                for task_id, completion in unfinished_task_ids
-                if id2priority.get(task_id, 0) == max_score
-            ]
-            task_id = random.choice(least_completed_ids)
-            logger.info(
-                f"Chose the task {task_id} among {n} options (the most incomplete)"
+    @queries("trans_labels", "user_id", "project_id")
+    @queries("trans_results", "project_id", "status")
+    @queries("trans_inputs", "project_id", "solved")
+    def _get_task_ids_with_work_for_user_in_python(
+        self, project_id: int, user_id: Optional[int]
+    ) -> Set[int]:
+        """The same as `get_task_ids_with_work_for_user`, as mongomock aggregation is slow and incomplete"""
+        labeled = set(
+            self.trans_labels.distinct(
+                "translation_id", {"user_id": user_id, "project_id": project_id}
             )
-        elif prioritize_type == PrioritizeType.MOST_COMPLETE:
-            # 1/4 of the time, prioritize the tasks with the lowest incompleteness score (i.e. almost complete)
-            min_score = min(
-                [
-                    id2priority.get(task_id, 0)
-                    for task_id, completion in unfinished_task_ids
-                ]
+        )
+        n_to_label: tp.Counter[int] = Counter()
+        projection = {"input_id": 1, "user_id": 1, "translation_id": 1, "_id": 0}
+        for obj in self.trans_results.find(
+            {"project_id": project_id, "status": TransStatus.UNCHECKED}, projection
+        ):
+            n_to_label[obj["input_id"]] += (
+                obj["user_id"] != user_id and obj["translation_id"] not in labeled
             )
-            most_completed_ids = [
-                task_id
-                for task_id, completion in unfinished_task_ids
-                if id2priority.get(task_id, 0) == min_score
-            ]
-            task_id = random.choice(most_completed_ids)
-            logger.info(
-                f"Chose the task {task_id} among {n} options (the most complete)."
+        return {
+            obj["task_id"]
+            for obj in self.trans_inputs.find(
+                {"project_id": project_id, "solved": False},
+                {"input_id": 1, "task_id": 1, "_id": 0},
             )
-        else:
-            task_id, _ = random.choice(list(unfinished_task_ids))
-            logger.info(f"Chose the task {task_id} among {n} options (at random).")
-        return self.get_task(task_id)
+            if n_to_label.get(obj["input_id"], 1) > 0
+        }
 
+    @queries("user_task_map", "user_id", "task_id", "project_id")
     def add_user_task_link(self, user_id: int, task: TransTask) -> None:
         obj = {
             "user_id": user_id,
@@ -464,31 +1391,43 @@ class Database:
         }
         self.user_task_map.update_one(obj, {"$set": obj}, upsert=True)
 
+    @queries("trans_projects", "project_id", autoflush=False)
     def get_project(self, project_id: int) -> Optional[TransProject]:
-        obj = self.trans_projects.find_one({"project_id": project_id})
+        return self._load("project", project_id, lambda: self._find_project(project_id))
+
+    def _find_project(self, project_id: int) -> Optional[TransProject]:
+        obj = self.project_cache.get(
+            project_id, lambda: self.trans_projects.find_one({"project_id": project_id})
+        )
         if obj:
             proj = TransProject.model_construct(**obj)
             return proj
         return None
 
+    @queries("trans_tasks", "task_id", autoflush=False)
     def get_task(self, task_id: int) -> Optional[TransTask]:
+        return self._load("task", task_id, lambda: self._find_task(task_id))
+
+    def _find_task(self, task_id: int) -> Optional[TransTask]:
         obj = self.trans_tasks.find_one({"task_id": task_id})
         if obj:
-            task = TransTask.model_construct(**obj)
+            task = TransTask.from_db(obj)
             return task
         return None
 
+    @queries("trans_inputs", "task_id", "solved")
     def get_unsolved_inputs_for_task(self, task: TransTask) -> List[TransInput]:
         return [
-            TransInput.model_construct(**obj)
+            TransInput.from_db(obj)
             for obj in self.trans_inputs.find(
                 {"task_id": task.task_id, "solved": False}
             )
         ]
 
+    @queries("trans_inputs", "task_id")
     def get_inputs_for_task(self, task: TransTask) -> List[TransInput]:
         return [
-            TransInput.model_construct(**obj)
+            TransInput.from_db(obj)
             for obj in self.trans_inputs.find({"task_id": task.task_id})
         ]
 
@@ -500,18 +1439,162 @@ class Database:
         """
         For the given task, get the next input.
         """
-        # then we should skip this input
-        if prev_sent_id is None:
-            prev_sent_id = -1
-        all_inputs = self.get_unsolved_inputs_for_task(task=task)
-        prev_inputs = sorted(
-            [inp for inp in all_inputs if inp.input_id > prev_sent_id],
-            key=lambda x: x.input_id,
-        )
-        if prev_inputs:
-            return prev_inputs[0]
+        for inp in self.iter_unsolved_inputs(
+            task=task, after_id=prev_sent_id, batch_size=1
+        ):
+            return inp
         return None
 
+    @queries("trans_inputs", "task_id", "solved", "input_id")
+    def iter_unsolved_inputs(
+        self,
+        task: TransTask,
+        after_id: Optional[int] = None,
+        batch_size: int = 10,
+    ) -> tp.Iterator[TransInput]:
+        """
+        Iterate over the unsolved inputs of the task in the order of their ids, starting after `after_id`.
+        The inputs are fetched by small pages, each of them being a single index range scan.
+        """
+        last_id = -1 if after_id is None else after_id
+        while True:
+            page = list(
+                self.trans_inputs.find(
+                    {
+                        "task_id": task.task_id,
+                        "solved": False,
+                        "input_id": {"$gt": last_id},
+                    }
+                )
+                .sort("input_id", ASCENDING)
+                .limit(batch_size)
+            )
+            for obj in page:
+                yield TransInput.from_db(obj)
+            if len(page) < batch_size:
+                return
+            last_id = page[-1]["input_id"]
+
+    @queries("trans_results", "project_id", "task_id")
+    def load_task_working_set(
+        self,
+        task: TransTask,
+        user_id: int,
+        after_id: Optional[int] = None,
+        max_inputs: int = WORKING_SET_SIZE,
+    ) -> TaskWorkingSet:
+        """
+        Load the next unsolved inputs of the task (starting after `after_id`), their translations,
+        and the labels of the user for this task, so that the next input can be chosen in memory.
+        """
+        inputs = list(
+            self.iter_unsolved_inputs(
+                task=task, after_id=after_id, batch_size=max_inputs + 1
+            )
+        )
+        exhausted = len(inputs) <= max_inputs
+        inputs = inputs[:max_inputs]
+        translations: Dict[int, List[TransResult]] = {
+            inp.input_id: [] for inp in inputs
+        }
+        if inputs:
+            found = self.trans_results.find(
+                {
+                    "project_id": task.project_id,
+                    "task_id": task.task_id,
+                    "input_id": {"$in": list(translations)},
+                }
+            )
+            for obj in found:
+                translations[obj["input_id"]].append(TransResult.from_db(obj))
+        return TaskWorkingSet(
+            project=self.get_project(project_id=task.project_id),
+            inputs=inputs,
+            translations=translations,
+            scored_translation_ids=self.get_translations_ids_scored_by_user(
+                user_id=user_id, task_id=task.task_id
+            ),
+            exhausted=exhausted,
+        )
+
+    @queries("trans_inputs", "task_id", "solved")
+    def count_unsolved_inputs_for_task(self, task: TransTask) -> int:
+        return self.trans_inputs.count_documents(
+            {"task_id": task.task_id, "solved": False}
+        )
+
+    @queries("trans_results", "translation_id")
+    def apply_translation_verdict(
+        self, res: TransResult, accepted: bool, overlap: int
+    ) -> TransResult:
+        """
+        Atomically register an approval or a rejection of the translation and update its status:
+        it is accepted after `overlap` approvals, unless it has been rejected.
+        Return the translation as it was before; `res` is updated to the new state.
+        """
+        fltr = {"translation_id": res.translation_id}
+        if accepted:
+            before = self.trans_results.find_one_and_update(
+                fltr,
+                {"$inc": {"n_approvals": 1, "version": 1}},
+                return_document=ReturnDocument.BEFORE,
+            )
+            if before is None:
+                raise DocumentNotFoundError(
+                    f"The translation {res.translation_id} does not exist"
+                )
+            if (before.get("n_approvals") or 0) + 1 >= overlap:
+                self.trans_results.update_one(
+                    {**fltr, "status": {"$ne": TransStatus.REJECTED}},
+                    {"$set": {"status": TransStatus.ACCEPTED}, "$inc": {"version": 1}},
+                )
+        else:
+            before = self.trans_results.find_one_and_update(
+                fltr,
+                {"$set": {"status": TransStatus.REJECTED}, "$inc": {"version": 1}},
+                return_document=ReturnDocument.BEFORE,
+            )
+            if before is None:
+                raise DocumentNotFoundError(
+                    f"The translation {res.translation_id} does not exist"
+                )
+        after = self.trans_results.find_one(fltr)
+        if after is None:
+            raise DocumentNotFoundError(
+                f"The translation {res.translation_id} has been deleted"
+            )
+        res.rebase(after)
+        return TransResult.from_db(before)
+
+    @queries("trans_inputs", "input_id", "solved")
+    def mark_input_solved(self, inp: TransInput) -> bool:
+        """Atomically mark the input as solved; return whether it has not been solved before"""
+        result = self.trans_inputs.update_one(
+            {"input_id": inp.input_id, "solved": False},
+            {"$set": {"solved": True}, "$inc": {"version": 1}},
+        )
+        obj = self.trans_inputs.find_one({"input_id": inp.input_id})
+        if obj is None:
+            raise DocumentNotFoundError(f"The input {inp.input_id} does not exist")
+        inp.rebase(obj)
+        return bool(result.modified_count)
+
+    @queries("trans_results", "input_id", "status")
+    def input_has_partial_translations(
+        self, input_id: int, exclude_translation_id: Optional[int] = None
+    ) -> bool:
+        """Whether the input has an unchecked translation with some approvals"""
+        found = self.trans_results.find_one(
+            {
+                "input_id": input_id,
+                "status": TransStatus.UNCHECKED,
+                "n_approvals": {"$gt": 0},
+                "translation_id": {"$ne": exclude_translation_id},
+            }
+        )
+        return found is not None
+
+    @queries("trans_results", "user_id", "input_id", "status")
     def user_has_unscored_translations_for_input(
         self, user_id: int, input_id: int
     ) -> bool:
@@ -523,28 +1606,40 @@ class Database:
         return False
 
     def create_project(self, title: str, save: bool = True):
-        project_ids = {p["project_id"] for p in self.trans_projects.find({})}
-        project_id = max(project_ids, default=0) + 1
+        project_id = self.sequences.next_id("project_id")
         project = TransProject(
             project_id=project_id,
             title=title,
         )
         if save:
             self.save_project(project)
+            self.project_stats.update_one(
+                {"project_id": project_id},
+                {"$setOnInsert": {key: 0 for key in PROJECT_STATS_KEYS}},
+                upsert=True,
+            )
         return project
 
     def save_project(self, project: TransProject) -> None:
-        self.trans_projects.update_one(
-            filter={"project_id": project.project_id},
-            update={"$set": project.model_dump()},
+        # project ids are sometimes assigned by hand, so the counter should not fall behind them
+        self.sequences.observe("project_id", project.project_id)
+        self._save("project", project.project_id, project, self._write_projects)
+
+    def _write_projects(self, projects: List[TransProject]) -> None:
+        self._bulk_update(
+            self.trans_projects,
+            [
+                ({"project_id": project.project_id}, {"$set": project.model_dump()})
+                for project in projects
+            ],
             upsert=True,
         )
+        self.project_cache.invalidate()
 
     def create_task(
         self, project: TransProject, prompt: Optional[str] = None, save: bool = True
     ) -> TransTask:
-        ids = {t["task_id"] for t in self.trans_tasks.find({})}
-        task_id = max(ids, default=0) + 1
+        task_id = self.sequences.next_id("task_id")
         task = TransTask(
             project_id=project.project_id,
             task_id=task_id,
@@ -555,16 +1650,99 @@ class Database:
         return task
 
     def save_task(self, task: TransTask) -> None:
-        self.trans_tasks.update_one(
-            filter={"task_id": task.task_id},
-            update={"$set": task.model_dump()},
-            upsert=True,
+        self._save("task", task.task_id, task, self._write_tasks)
+        self._update_task_in_scheduler(task)
+
+    def _write_tasks(self, tasks: List[TransTask]) -> None:
+        self._write_changes(
+            self.trans_tasks, "task_id", tasks, exclude=TASK_LEASE_FIELDS
+        )
+
+    def _update_task_in_scheduler(self, task: TransTask) -> None:
+        self.task_scheduler.update(
+            project_id=task.project_id,
+            task_id=task.task_id,
+            completions=task.completions,
+            score=task.incompleteness_score,
+            completed=task.completed,
+            locked_until=task.locked_until,
+        )
+
+    @queries("trans_tasks", "task_id")
+    @queries("trans_tasks", "locked_by")
+    def claim_task(
+        self, task: TransTask, user_id: int, lease_seconds: float = TASK_LEASE_SECONDS
+    ) -> bool:
+        """
+        Atomically lock the task for the user, unless it is locked by someone else and the lease has not expired.
+        Return whether the task has been claimed.
+        """
+        now = time.time()
+        obj = self.trans_tasks.find_one_and_update(
+            {
+                "task_id": task.task_id,
+                "$or": [
+                    {"locked_by": None},
+                    {"locked_by": user_id},
+                    {"locked_until": {"$lt": now}},
+                ],
+            },
+            {"$set": {"locked_by": user_id, "locked_until": now + lease_seconds}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if obj is None:
+            return False
+        task.locked_by = obj["locked_by"]
+        task.locked_until = obj["locked_until"]
+        self.task_scheduler.set_lease(task.project_id, task.task_id, task.locked_until)
+
+        # a user works on one task at a time, so their other leases are released
+        self.release_user_tasks(user_id=user_id, except_task_id=task.task_id)
+        return True
+
+    @queries("trans_tasks", "locked_by")
+    def release_user_tasks(
+        self, user_id: int, except_task_id: Optional[int] = None
+    ) -> None:
+        """Release all the leases held by the user (except the one on the given task)"""
+        fltr: Dict = {"locked_by": user_id}
+        if except_task_id is not None:
+            fltr["task_id"] = {"$ne": except_task_id}
+        for obj in self.trans_tasks.find(fltr, {"task_id": 1, "project_id": 1}):
+            self._release_lease(
+                task_id=obj["task_id"], project_id=obj["project_id"], user_id=user_id
+            )
+
+    def release_task(self, task: TransTask, user_id: int) -> None:
+        """Release the lease on the task, if the user still holds it"""
+        self._release_lease(
+            task_id=task.task_id, project_id=task.project_id, user_id=user_id
+        )
+        if task.locked_by == user_id:
+            task.locked_by = None
+            task.locked_until = None
+
+    def _release_lease(self, task_id: int, project_id: int, user_id: int) -> None:
+        result = self.trans_tasks.update_one(
+            {"task_id": task_id, "locked_by": user_id},
+            {"$set": {"locked_by": None, "locked_until": None}},
         )
+        if result.modified_count:
+            self.task_scheduler.set_lease(project_id, task_id, None)
 
+    def has_free_tasks(self, project_id: int) -> bool:
+        """Whether there are incomplete tasks in the project that are not locked by anyone"""
+        self._load_task_schedule(project_id=project_id)
+        return self.task_scheduler.count_unlocked(project_id) > 0
+
+    @queries("trans_inputs", "input_id", autoflush=False)
     def get_input(self, input_id: int) -> Optional[TransInput]:
+        return self._load("input", input_id, lambda: self._find_input(input_id))
+
+    def _find_input(self, input_id: int) -> Optional[TransInput]:
         obj = self.trans_inputs.find_one({"input_id": input_id})
         if obj:
-            inp = TransInput.model_construct(**obj)
+            inp = TransInput.from_db(obj)
             return inp
         return None
 
@@ -587,30 +1765,48 @@ class Database:
 
     def save_input(self, inp: TransInput) -> None:
         if inp.input_id == NO_ID:
-            ids = {inp["input_id"] for inp in self.trans_inputs.find({})}
-            inp.input_id = max(ids, default=0) + 1
+            inp.input_id = self.sequences.next_id("input_id")
             self.trans_inputs.insert_one(inp.model_dump())
+            inp.mark_clean()
+            self._remember("input", inp.input_id, inp)
+            self.inc_project_stats(inp.project_id, n_inputs=1, n_solved=int(inp.solved))
         else:
-            self.trans_inputs.update_one(
-                filter={"input_id": inp.input_id},
-                update={"$set": inp.model_dump()},
-                upsert=True,
-            )
+            self._save("input", inp.input_id, inp, self._write_inputs)
+
+    def _write_inputs(self, inps: List[TransInput]) -> None:
+        self._write_changes(self.trans_inputs, "input_id", inps)
 
     def add_inputs(self, inps: List[TransInput]) -> None:
-        ids = {inp["input_id"] for inp in self.trans_inputs.find({})}
-        max_id = max(ids, default=0) + 1
+        if not inps:
+            return
+        first_id = self.sequences.reserve("input_id", count=len(inps))
         for i, inp in enumerate(inps):
-            inp.input_id = max_id + i
+            inp.input_id = first_id + i
         self.trans_inputs.insert_many([inp.model_dump() for inp in inps])
+        for inp in inps:
+            inp.mark_clean()
+        for project_id in {inp.project_id for inp in inps}:
+            project_inputs = [inp for inp in inps if inp.project_id == project_id]
+            self.inc_project_stats(
+                project_id,
+                n_inputs=len(project_inputs),
+                n_solved=sum(inp.solved for inp in project_inputs),
+            )
 
+    @queries("trans_results", "translation_id", autoflush=False)
     def get_translation(self, result_id: int) -> Optional[TransResult]:
+        return self._load(
+            "translation", result_id, lambda: self._find_translation(result_id)
+        )
+
+    def _find_translation(self, result_id: int) -> Optional[TransResult]:
         obj = self.trans_results.find_one({"translation_id": result_id})
         if obj:
-            res = TransResult.model_construct(**obj)
+            res = TransResult.from_db(obj)
             return res
         return None
 
+    @queries("trans_results", "input_id", "task_id", "project_id", "status")
     def get_translations_for_input(
         self, inp: TransInput, status: Optional[int] = None
     ) -> List[TransResult]:
@@ -621,9 +1817,7 @@ class Database:
         }
         if status is not None:
             fltr["status"] = status
-        results = [
-            TransResult.model_construct(**obj) for obj in self.trans_results.find(fltr)
-        ]
+        results = [TransResult.from_db(obj) for obj in self.trans_results.find(fltr)]
         return results
 
     def create_translation(
@@ -642,27 +1836,49 @@ class Database:
 
     def save_translation(self, result: TransResult) -> None:
         if result.translation_id == NO_ID:
-            ids = {t["translation_id"] for t in self.trans_results.find({})}
-            result.translation_id = max(ids, default=0) + 1
+            result.translation_id = self.sequences.next_id("translation_id")
             self.trans_results.insert_one(result.model_dump())
+            result.mark_clean()
+            self._remember("translation", result.translation_id, result)
+            self.inc_project_stats(
+                result.project_id,
+                n_user_translations=int(result.user_id != NO_USER),
+            )
         else:
-            self.trans_results.update_one(
-                filter={"translation_id": result.translation_id},
-                update={"$set": result.model_dump()},
-                upsert=True,
+            self._save(
+                "translation", result.translation_id, result, self._write_translations
             )
 
+    def _write_translations(self, results: List[TransResult]) -> None:
+        self._write_changes(self.trans_results, "translation_id", results)
+
     def add_translations(self, translations: List[TransResult]) -> None:
-        ids = {tr["translation_id"] for tr in self.trans_results.find({})}
-        max_id = max(ids, default=0) + 1
+        if not translations:
+            return
+        first_id = self.sequences.reserve("translation_id", count=len(translations))
         for i, tr in enumerate(translations):
-            tr.translation_id = max_id + i
+            tr.translation_id = first_id + i
         self.trans_results.insert_many([tr.model_dump() for tr in translations])
+        for tr in translations:
+            tr.mark_clean()
+        for project_id in {tr.project_id for tr in translations}:
+            self.inc_project_stats(
+                project_id,
+                n_user_translations=sum(
+                    tr.user_id != NO_USER
+                    for tr in translations
+                    if tr.project_id == project_id
+                ),
+            )
 
+    @queries("trans_labels", "label_id", autoflush=False)
     def get_label(self, label_id: int) -> Optional[TransLabel]:
+        return self._load("label", label_id, lambda: self._find_label(label_id))
+
+    def _find_label(self, label_id: int) -> Optional[TransLabel]:
         obj = self.trans_labels.find_one({"label_id": label_id})
         if obj:
-            label = TransLabel.model_construct(**obj)
+            label = TransLabel.from_db(obj)
             return label
         return None
 
@@ -680,39 +1896,62 @@ class Database:
 
     def save_label(self, label: TransLabel):
         if label.label_id == NO_ID:
-            ids = {t["label_id"] for t in self.trans_labels.find({})}
-            label.label_id = max(ids, default=0) + 1
+            label.label_id = self.sequences.next_id("label_id")
             self.trans_labels.insert_one(label.model_dump())
+            label.mark_clean()
+            self._remember("label", label.label_id, label)
+            self.inc_project_stats(label.project_id, n_labels=1)
         else:
-            self.trans_labels.update_one(
-                filter={"label_id": label.label_id},
-                update={"$set": label.model_dump()},
-                upsert=True,
-            )
+            self._save("label", label.label_id, label, self._write_labels)
+
+    def _write_labels(self, labels: List[TransLabel]) -> None:
+        self._write_changes(self.trans_labels, "label_id", labels)
 
+    @queries("trans_labels", "user_id", "task_id")
     def get_translations_ids_scored_by_user(
         self, user_id: int, task_id: int
     ) -> Set[int]:
         found = self.trans_labels.find({"user_id": user_id, "task_id": task_id})
         return {item["translation_id"] for item in found}
 
+    @queries("project_stats", "project_id")
     def get_project_stats(self, project_id: int) -> Dict:
+        obj = self.project_stats.find_one(
+            {"project_id": project_id}, {"_id": 0, "project_id": 0}
+        )
+        if obj is None:
+            return self.rebuild_project_stats(project_id=project_id)
+        return obj
+
+    def inc_project_stats(self, project_id: int, **deltas: int) -> None:
+        """Atomically update the project statistics counters"""
+        deltas = {key: value for key, value in deltas.items() if value}
+        if not deltas:
+            return
+        # if there are no stats yet, they will be computed from scratch when requested
+        self.project_stats.update_one({"project_id": project_id}, {"$inc": deltas})
+
+    @queries("trans_inputs", "project_id")
+    @queries("trans_results", "project_id")
+    @queries("trans_labels", "project_id")
+    def rebuild_project_stats(self, project_id: int) -> Dict:
+        """Recompute the project statistics from scratch, to repair the drift of the counters"""
         project = self.get_project(project_id=project_id)
         if project is None:
             return {"error": f"project {project_id} not found!"}
         all_inputs = [
-            TransInput.model_construct(**obj)
+            TransInput.from_db(obj)
             for obj in self.trans_inputs.find({"project_id": project_id})
         ]
         all_translations = [
-            TransResult.model_construct(**obj)
+            TransResult.from_db(obj)
             for obj in self.trans_results.find({"project_id": project_id})
         ]
         all_labels = [
-            TransLabel.model_construct(**obj)
+            TransLabel.from_db(obj)
             for obj in self.trans_labels.find({"project_id": project_id})
         ]
-        return dict(
+        stats = dict(
             n_inputs=len(all_inputs),
             n_partial=len(
                 {
@@ -744,84 +1983,215 @@ class Database:
                 ]
             ),
         )
-
-    def cleanup_locked_tasks(self):
-        users = self.get_all_users()
-        now = time.time()
-        seconds_to_inactivation = (
-            60 * 60 * 24 * 7
-        )  # after 7 days, we treat the user as inactive and unblock the task
-        real_locked_task_ids = {
-            u.curr_task_id
-            for u in users
-            if u.curr_task_id is not None
-            and not u.is_blocked
-            and ((u.last_activity_time or 0) > now - seconds_to_inactivation)
-        }
-        locked_tasks = [
-            TransTask.model_construct(**obj)
-            for obj in self.trans_tasks.find({"locked": True})
-        ]
-        print(
-            f"found {len(locked_tasks)} tasks that are potentially locked, and {len(real_locked_task_ids)} real locks."
+        self.project_stats.update_one(
+            {"project_id": project_id}, {"$set": stats}, upsert=True
         )
-        n_unlock = 0
-        for task in locked_tasks:
-            if task.task_id not in real_locked_task_ids:
-                task.locked = False
-                self.save_task(task)
-                n_unlock += 1
-        print(f"Unlocked {n_unlock} tasks.")
+        return stats
 
+    @queries("trans_projects", "is_active")
     def get_projects(self, active: Optional[bool] = None) -> List[TransProject]:
+        docs = self.project_cache.get(
+            ("list", active), lambda: self._find_projects(active=active)
+        )
+        return [TransProject.model_construct(**obj) for obj in docs]
+
+    def _find_projects(self, active: Optional[bool] = None) -> List[Dict]:
         fltr = {}
         if active is not None:
             fltr["is_active"] = active
-        projects = [
-            TransProject.model_construct(**obj)
-            for obj in self.trans_projects.find(fltr)
-        ]
-        projects = sorted(projects, key=lambda x: x.project_id)
-        return projects
+        return sorted(self.trans_projects.find(fltr), key=lambda x: x["project_id"])
 
     def update_input_status(self, inp: TransInput) -> None:
-        translations = self.get_translations_for_input(inp=inp)
-        status = InputStatus.NO_TRANSLATION
-        for translation in translations:
-            # rejected or duplicate translations do not count
-            if translation.status in {TransStatus.REJECTED, TransStatus.DUPLICATE}:
-                continue
-            # if there is a translation, reflect in the status that it exists
-            if translation.user_id == NO_USER:
-                status = max(status, InputStatus.UNCHECKED_SYSTEM_TRANSLATION)
-            else:
-                status = max(status, InputStatus.UNCHECKED_USER_TRANSLATION)
-            # if the translation has positive feedback, reflect it
-            if translation.n_approvals > 0:
-                status = max(status, InputStatus.PARTIALLY_ACCEPTED)
-            if translation.status == TransStatus.ACCEPTED:
-                status = max(status, InputStatus.ACCEPTED)
-        inp.input_status = status
+        inp.input_status = compute_input_status(
+            self.get_translations_for_input(inp=inp)
+        )
         self.save_input(inp)
 
+    def _on_translation_changed(
+        self, event: Union[TranslationSaved, LabelFinalized]
+    ) -> None:
+        self.refresh_input_status(input_id=event.translation.input_id)
+
+    @queries("trans_tasks", "task_id", "completion_stats")
+    def refresh_input_status(self, input_id: int) -> None:
+        """
+        Recompute the status of a single input and apply the change to the completion stats of its task,
+        so that the task priorities stay fresh between the full recomputations.
+        """
+        inp = self.get_input(input_id=input_id)
+        if inp is None:
+            return
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            old_status = inp.input_status
+            new_status = compute_input_status(self.get_translations_for_input(inp=inp))
+            if new_status == old_status:
+                return
+            # the status is changed (and the delta is applied) only by the process that has seen the old one
+            obj = self.trans_inputs.find_one_and_update(
+                {"input_id": input_id, "input_status": old_status},
+                {"$set": {"input_status": new_status}, "$inc": {"version": 1}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if obj is not None:
+                inp.rebase(obj)
+                break
+            # another process has changed the status meanwhile, so we start over from its result
+            obj = self.trans_inputs.find_one({"input_id": input_id})
+            if obj is None:
+                return
+            inp.rebase(obj)
+        else:
+            logger.warning(
+                f"Could not update the status of the input {input_id} because of the concurrent changes"
+            )
+            return
+
+        deltas = {f"completion_stats.{new_status}": 1}
+        if old_status is not None:
+            deltas[f"completion_stats.{old_status}"] = -1
+        obj = self.trans_tasks.find_one_and_update(
+            {"task_id": inp.task_id, "completion_stats": {"$ne": None}},
+            {"$inc": {**deltas, "version": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if obj is not None:
+            self._refresh_cached("task", inp.task_id, obj)
+            self._update_task_in_scheduler(TransTask.from_db(obj))
+            return
+        # the task stats have never been computed, so there is nothing to apply the delta to
+        task = self.get_task(task_id=inp.task_id)
+        if task is not None:
+            self.update_task_status(task=task)
+
     def update_task_status(self, task: TransTask) -> None:
-        inputs = self.get_inputs_for_task(task=task)
-        cnt: tp.Counter[str] = Counter()
-        for inp in inputs:
-            self.update_input_status(inp=inp)
-            cnt[inp.input_status or "undefined"] += 1
-        stats = dict(cnt)
-        task.completion_stats = stats
-        self.save_task(task=task)
-
-    def update_all_task_statuses(self) -> None:
-        """This function is slow; it takes a couple seconds per task"""
-        for obj in self.trans_tasks.find({}):
-            task = self.get_task(task_id=obj["task_id"])
-            if task is not None:
-                self.update_task_status(task)
+        stats = self.rebuild_task_statuses(
+            project_id=task.project_id, task_id_range=(task.task_id, task.task_id + 1)
+        ).get(task.task_id, {})
+        if stats != task.completion_stats:
+            # the document has been rewritten, so the copies of the task must not keep the old stats and version
+            obj = self.trans_tasks.find_one({"task_id": task.task_id}, {"_id": 0})
+            if obj is not None:
+                self._refresh_cached("task", task.task_id, obj)
+                if task.version != obj.get("version"):
+                    task.rebase(obj)
+        self._update_task_in_scheduler(task)
+
+    @queries("trans_results", "project_id", "task_id")
+    @queries("trans_inputs", "project_id", "task_id")
+    @queries("trans_tasks", "project_id", "task_id")
+    def rebuild_task_statuses(
+        self,
+        project_id: int,
+        task_id_range: Optional[Tuple[int, int]] = None,
+        batch_size: int = 1000,
+    ) -> Dict[int, Dict[str, int]]:
+        """
+        Recompute the statuses of all inputs and the completion stats of all tasks in the project
+        (or in the range of task ids), reading each translation once and writing the changes in batches.
+        Only the inputs and tasks whose statuses have changed are written.
+        Return the completion stats of the tasks.
+        """
+        fltr: Dict = {"project_id": project_id}
+        if task_id_range is not None:
+            fltr["task_id"] = {"$gte": task_id_range[0], "$lt": task_id_range[1]}
+
+        translations_by_input: Dict[int, List[TransResult]] = {}
+        for obj in self.trans_results.find(
+            fltr, {"input_id": 1, "user_id": 1, "status": 1, "n_approvals": 1, "_id": 0}
+        ):
+            translations_by_input.setdefault(obj["input_id"], []).append(
+                TransResult.from_db(obj)
+            )
+
+        task_stats: Dict[int, tp.Counter[str]] = {}
+        input_updates = []
+        n_corrected = 0
+        for obj in self.trans_inputs.find(
+            fltr, {"input_id": 1, "task_id": 1, "input_status": 1, "_id": 0}
+        ):
+            status = compute_input_status(
+                translations_by_input.get(obj["input_id"], [])
+            )
+            task_stats.setdefault(obj["task_id"], Counter())[status] += 1
+            if status != obj.get("input_status"):
+                n_corrected += 1
+                input_updates.append(
+                    (
+                        {"input_id": obj["input_id"]},
+                        {"$set": {"input_status": status}, "$inc": {"version": 1}},
+                    )
+                )
+            if len(input_updates) >= batch_size:
+                self._bulk_update(self.trans_inputs, input_updates)
+                input_updates = []
+        self._bulk_update(self.trans_inputs, input_updates)
+        if n_corrected:
+            logger.info(
+                f"Corrected the statuses of {n_corrected} inputs in the project {project_id}"
+            )
+
+        result = {}
+        task_updates = []
+        for obj in self.trans_tasks.find(
+            fltr, {"task_id": 1, "completion_stats": 1, "_id": 0}
+        ):
+            stats = dict(task_stats.get(obj["task_id"], {}))
+            result[obj["task_id"]] = stats
+            if stats == obj.get("completion_stats"):
+                continue
+            task_updates.append(
+                (
+                    {"task_id": obj["task_id"]},
+                    {"$set": {"completion_stats": stats}, "$inc": {"version": 1}},
+                )
+            )
+        for i in range(0, len(task_updates), batch_size):
+            self._bulk_update(self.trans_tasks, task_updates[i : i + batch_size])
+        return result
+
+    def update_all_task_statuses(
+        self, n_workers: int = 1, tasks_per_job: int = 1000
+    ) -> None:
+        """
+        Recompute the statuses of all inputs and tasks.
+        The work is split by projects and ranges of task ids; with several workers, it runs in a process pool.
+        """
+        jobs = []
+        for project_id in self.trans_tasks.distinct("project_id"):
+            task_ids = sorted(
+                self.trans_tasks.distinct("task_id", {"project_id": project_id})
+            )
+            for i in range(0, len(task_ids), tasks_per_job):
+                chunk = task_ids[i : i + tasks_per_job]
+                jobs.append((project_id, (chunk[0], chunk[-1] + 1)))
+        logger.info(f"Updating the task statuses in {len(jobs)} jobs")
+
+        # mongomock databases cannot be shared with other processes
+        if n_workers <= 1 or self.is_mock or self.mongo_url is None:
+            for project_id, task_id_range in jobs:
+                self.rebuild_task_statuses(
+                    project_id=project_id, task_id_range=task_id_range
+                )
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_connect_worker_process,
+                initargs=(self.mongo_url,),
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _rebuild_task_statuses_in_process, project_id, task_id_range
+                    )
+                    for project_id, task_id_range in jobs
+                ]
+                for future in futures:
+                    future.result()
+        # the priorities have changed, so the scheduler should reload them
+        self.task_scheduler.invalidate()
 
     # Web user management
+    @queries("users", "username")
+    @queries("users", "user_id")
     def find_user_account(
         self,
         username: Optional[str] = None,
@@ -835,7 +2205,8 @@ class Database:
             obj = None
 
         if obj:
-            return UserState.model_construct(**obj)
+            return UserState.from_db(obj)
+        return None
 
     def create_user_with_password(
         self, username: str, password_hash: str
@@ -855,8 +2226,7 @@ class Database:
 
     def _get_next_user_id(self) -> int:
         # returning negative ids, because positive ones are already reserved by Telegram users
-        next_uid = -1
-        for obj in self.mongo_users.find():
-            next_uid = min(next_uid, obj.get("user_id", -1) - 1)
+        return -self.sequences.next_id("web_user_id")
+
 
-        return next_uid
+metrics.instrument_methods(Database, metrics.DB_SECONDS)
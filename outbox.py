@@ -0,0 +1,254 @@
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+from telebot.apihelper import ApiTelegramException  # type: ignore
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second in total, and about 1 message per second to the same chat
+GLOBAL_MESSAGES_PER_SECOND = 25
+CHAT_MESSAGES_PER_SECOND = 1
+# how many times a message is retried after "429 Too Many Requests"
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """A bucket that refills at `rate` tokens per second up to `capacity`; each message takes one token"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """How long to wait until a token is available"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        """Take a token; the balance may go negative, which delays the following messages"""
+        self._refill(now)
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """The global and per-chat limits of the Telegram Bot API, plus a global pause after a 429 response"""
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_MESSAGES_PER_SECOND,
+        chat_rate: float = CHAT_MESSAGES_PER_SECOND,
+    ):
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets: Dict[Any, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                rate=self.chat_rate, capacity=1
+            )
+        return bucket
+
+    def try_acquire(self, chat_id) -> float:
+        """Take the tokens for a message to the chat and return 0, or return how long to wait before trying again"""
+        with self.lock:
+            now = time.monotonic()
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(
+                self.paused_until - now,
+                self.global_bucket.wait_time(now),
+                chat_bucket.wait_time(now),
+            )
+            if wait > 0:
+                return wait
+            self.global_bucket.consume(now)
+            chat_bucket.consume(now)
+            if len(self.chat_buckets) > 10_000:
+                # the full buckets carry no information, so they can be forgotten
+                self.chat_buckets = {
+                    k: b for k, b in self.chat_buckets.items() if b.wait_time(now) > 0
+                }
+            return 0.0
+
+    def consume(self, chat_id) -> None:
+        """Take the tokens without waiting (for the messages that cannot be delayed)"""
+        with self.lock:
+            now = time.monotonic()
+            self.global_bucket.consume(now)
+            self._chat_bucket(chat_id).consume(now)
+
+    def pause(self, seconds: float) -> None:
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_retry_after(e: Exception) -> Optional[int]:
+    """If the exception is a "429 Too Many Requests" from Telegram, return how many seconds it asks to wait"""
+    if isinstance(e, ApiTelegramException) and e.error_code == 429:
+        parameters = (e.result_json or {}).get("parameters") or {}
+        return int(parameters.get("retry_after", 1))
+    return None
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: Any
+    text: str
+    kwargs: Dict = field(default_factory=dict)
+    on_sent: Optional[Callable[[Any], None]] = None
+    on_error: Optional[Callable[[Exception], None]] = None
+    n_retries: int = 0
+
+
+class Outbox:
+    """
+    Delivers the outgoing messages of the bot within the Telegram rate limits.
+    Replies to the users are sent at once by `send_now`; the bulk messages (e.g. reminders)
+    are queued by `enqueue` and sent by background workers as fast as the limits allow.
+    Any object with the `send_message` method of telebot.TeleBot can be used as the bot (e.g. FakeBot).
+    """
+
+    def __init__(
+        self,
+        bot,
+        limiter: Optional[RateLimiter] = None,
+        n_workers: int = 1,
+    ):
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        self.n_workers = n_workers
+        self.queue: queue.Queue = queue.Queue()
+        self._start_lock = threading.Lock()
+        self._started = False
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def send_now(self, chat_id, text: str, **kwargs):
+        """Send a message immediately, waiting only if Telegram asks to"""
+        self.limiter.consume(chat_id)
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return self._send_message(chat_id, text, **kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or attempt == MAX_RETRIES:
+                    raise
+                logger.warning(
+                    f"Telegram asked to wait {retry_after} seconds before sending to {chat_id}"
+                )
+                self.limiter.pause(retry_after)
+                time.sleep(retry_after)
+
+    def send_throttled(self, chat_id, text: str, **kwargs):
+        """Send a message from the calling thread as soon as the rate limits allow"""
+        for attempt in range(MAX_RETRIES + 1):
+            self._wait_for_tokens(chat_id)
+            try:
+                return self._send_message(chat_id, text, **kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e)
+                if retry_after is None or attempt == MAX_RETRIES:
+                    raise
+                logger.warning(
+                    f"Telegram asked to wait {retry_after} seconds before sending to {chat_id}"
+                )
+                self.limiter.pause(retry_after)
+
+    def _send_message(self, chat_id, text: str, **kwargs):
+        with metrics.telegram_call("send_message"):
+            return self.bot.send_message(chat_id, text, **kwargs)
+
+    def _wait_for_tokens(self, chat_id) -> None:
+        while True:
+            wait = self.limiter.try_acquire(chat_id)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def enqueue(
+        self,
+        chat_id,
+        text: str,
+        on_sent: Optional[Callable[[Any], None]] = None,
+        on_error: Optional[Callable[[Exception], None]] = None,
+        **kwargs,
+    ) -> None:
+        """Schedule a message to be sent in the background; the callbacks are called from a worker thread"""
+        self._ensure_started()
+        self.queue.put(
+            OutgoingMessage(
+                chat_id=chat_id,
+                text=text,
+                kwargs=kwargs,
+                on_sent=on_sent,
+                on_error=on_error,
+            )
+        )
+
+    def join(self) -> None:
+        """Wait until all the queued messages are processed"""
+        self.queue.join()
+
+    def _ensure_started(self) -> None:
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            for i in range(self.n_workers):
+                threading.Thread(
+                    target=self._run, name=f"outbox-{i}", daemon=True
+                ).start()
+            self._started = True
+
+    def _run(self) -> None:
+        while True:
+            message: OutgoingMessage = self.queue.get()
+            try:
+                self._deliver(message)
+            except Exception:
+                logger.exception(
+                    f"Error when delivering a message to {message.chat_id}"
+                )
+            finally:
+                self.queue.task_done()
+
+    def _deliver(self, message: OutgoingMessage) -> None:
+        self._wait_for_tokens(message.chat_id)
+        try:
+            result = self._send_message(message.chat_id, message.text, **message.kwargs)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None and message.n_retries < MAX_RETRIES:
+                logger.warning(
+                    f"Telegram asked to wait {retry_after} seconds; the message to {message.chat_id} is postponed"
+                )
+                self.limiter.pause(retry_after)
+                message.n_retries += 1
+                self.queue.put(message)
+                return
+            if message.on_error is None:
+                raise
+            message.on_error(e)
+            return
+        if message.on_sent is not None:
+            message.on_sent(result)
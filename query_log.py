@@ -0,0 +1,309 @@
+"""
+Accounting of the database operations: how many queries, documents and bytes each dialogue message costs,
+and a log of the slow operations with their filter shapes and call sites.
+The collections of `models.Database` are wrapped into `InstrumentedCollection`, which behaves like the wrapped one.
+"""
+
+import logging
+import os
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import bson  # type: ignore
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# an operation that takes longer than this is logged with its filter shape and call site
+SLOW_OPERATION_SECONDS = float(os.environ.get("SLOW_QUERY_SECONDS", 0.1))
+
+# the operations that send a filter to the database, with the name of the filter argument
+FILTERED_OPERATIONS = {
+    "find": "filter",
+    "find_one": "filter",
+    "find_one_and_update": "filter",
+    "find_one_and_delete": "filter",
+    "find_one_and_replace": "filter",
+    "update_one": "filter",
+    "update_many": "filter",
+    "replace_one": "filter",
+    "delete_one": "filter",
+    "delete_many": "filter",
+    "count_documents": "filter",
+    "distinct": "filter",
+    "aggregate": "pipeline",
+}
+OTHER_OPERATIONS = {
+    "insert_one",
+    "insert_many",
+    "bulk_write",
+    "estimated_document_count",
+}
+# the operations that return a cursor; their documents are counted as they are read
+CURSOR_OPERATIONS = {"find", "aggregate"}
+
+
+class QueryStats:
+    """The database operations made while handling one message"""
+
+    def __init__(self):
+        self.n_queries = 0
+        self.n_documents = 0
+        self.n_bytes = 0
+        self.seconds = 0.0
+        # (collection, operation) -> the number of calls
+        self.operations: Counter = Counter()
+
+    def add(
+        self,
+        collection: str,
+        operation: str,
+        n_documents: int,
+        n_bytes: int,
+        seconds: float,
+        new_query: bool = True,
+    ) -> None:
+        if new_query:
+            self.n_queries += 1
+            self.operations[(collection, operation)] += 1
+        self.n_documents += n_documents
+        self.n_bytes += n_bytes
+        self.seconds += seconds
+
+    def summary(self, top: int = 5) -> str:
+        frequent = ", ".join(
+            f"{collection}.{operation} x{count}"
+            for (collection, operation), count in self.operations.most_common(top)
+        )
+        return (
+            f"{self.n_queries} queries, {self.n_documents} documents, {self.n_bytes} bytes "
+            f"in {self.seconds:.3f}s ({frequent})"
+        )
+
+
+CURRENT_STATS: ContextVar[Optional[QueryStats]] = ContextVar(
+    "CURRENT_STATS", default=None
+)
+
+
+@contextmanager
+def track() -> Iterator[QueryStats]:
+    """Attribute the database operations of the current thread (or task) to a new QueryStats"""
+    stats = QueryStats()
+    token = CURRENT_STATS.set(stats)
+    try:
+        yield stats
+    finally:
+        CURRENT_STATS.reset(token)
+
+
+def query_shape(query: Any) -> Any:
+    """The filter without its values, e.g. {"user_id": "?", "status": {"$in": "?"}}"""
+    if isinstance(query, dict):
+        return {
+            key: (
+                query_shape(value)
+                if key.startswith("$") or isinstance(value, dict)
+                else "?"
+            )
+            for key, value in query.items()
+        }
+    if isinstance(query, (list, tuple)) and any(
+        isinstance(item, dict) for item in query
+    ):
+        # e.g. the conditions of $or or the stages of a pipeline, but not the values of $in
+        return [query_shape(item) for item in query]
+    return "?"
+
+
+def get_call_site() -> str:
+    """The innermost frame of the bot's own code that is not in this module"""
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        if frame.filename == __file__ or "site-packages" in frame.filename:
+            continue
+        return f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}"
+    return "unknown"
+
+
+def _document_size(doc: Any) -> int:
+    try:
+        return len(bson.encode(doc))
+    except Exception:
+        return 0
+
+
+class InstrumentedCollection:
+    """
+    A proxy of a pymongo (or mongomock) collection that records each operation:
+    to the QueryStats of the current message, if there is one, and to the slow operation log.
+    The sizes of the documents are measured only within a message, as it costs an encoding of each document.
+    """
+
+    def __init__(self, collection, slow_seconds: float = SLOW_OPERATION_SECONDS):
+        self._collection = collection
+        self._slow_seconds = slow_seconds
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._collection, name)
+        if name in FILTERED_OPERATIONS or name in OTHER_OPERATIONS:
+            return self._instrument(name, attribute)
+        return attribute
+
+    def __getitem__(self, name: str):
+        return self._collection[name]
+
+    def __repr__(self) -> str:
+        return f"InstrumentedCollection({self._collection!r})"
+
+    def _instrument(self, operation: str, method):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            result = method(*args, **kwargs)
+            seconds = time.perf_counter() - started
+            if operation in CURSOR_OPERATIONS:
+                return _InstrumentedCursor(
+                    result, self, operation, args, kwargs, seconds
+                )
+            n_documents, n_bytes = 0, 0
+            stats = CURRENT_STATS.get()
+            if operation in {"find_one", "find_one_and_update"} and result is not None:
+                n_documents = 1
+                n_bytes = _document_size(result) if stats is not None else 0
+            self._record(operation, n_documents, n_bytes, seconds)
+            self._log_if_slow(operation, args, kwargs, n_documents, seconds)
+            return result
+
+        return wrapper
+
+    def _record(
+        self,
+        operation: str,
+        n_documents: int,
+        n_bytes: int,
+        seconds: float,
+        new_query: bool = True,
+    ) -> None:
+        stats = CURRENT_STATS.get()
+        if stats is not None:
+            stats.add(
+                self._collection.name,
+                operation,
+                n_documents=n_documents,
+                n_bytes=n_bytes,
+                seconds=seconds,
+                new_query=new_query,
+            )
+
+    def _log_if_slow(
+        self,
+        operation: str,
+        args: Tuple,
+        kwargs: Dict,
+        n_documents: int,
+        seconds: float,
+    ) -> None:
+        if seconds < self._slow_seconds:
+            return
+        metrics.SLOW_DB_OPERATIONS.labels(self._collection.name, operation).inc()
+        argument = FILTERED_OPERATIONS.get(operation)
+        query = kwargs.get(argument, args[0] if args else None)
+        logger.warning(
+            f"Slow {self._collection.name}.{operation} ({seconds:.3f}s, {n_documents} documents) "
+            f"with the filter {query_shape(query)} at {get_call_site()}"
+        )
+
+
+class _InstrumentedCursor:
+    """
+    Counts the documents and the time of a cursor as it is read.
+    The query is counted when the cursor is created, as it may be abandoned before it is exhausted;
+    whether it is slow is checked when it is exhausted.
+    """
+
+    def __init__(
+        self,
+        cursor,
+        collection: InstrumentedCollection,
+        operation: str,
+        args: Tuple,
+        kwargs: Dict,
+        seconds: float,
+    ):
+        self._cursor = cursor
+        self._collection = collection
+        self._operation = operation
+        self._args = args
+        self._kwargs = kwargs
+        self._seconds = seconds
+        self._n_documents = 0
+        self._finished = False
+        collection._record(operation, n_documents=0, n_bytes=0, seconds=seconds)
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._cursor, name)
+        if not callable(attribute):
+            return attribute
+
+        def wrapper(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            # the chained calls like `.sort(...).limit(...)` keep the cursor instrumented
+            return self if result is self._cursor else result
+
+        return wrapper
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            doc = next(self._cursor)
+        except StopIteration:
+            self._finish(time.perf_counter() - started)
+            raise
+        seconds = time.perf_counter() - started
+        self._seconds += seconds
+        self._n_documents += 1
+        n_bytes = _document_size(doc) if CURRENT_STATS.get() is not None else 0
+        self._collection._record(
+            self._operation,
+            n_documents=1,
+            n_bytes=n_bytes,
+            seconds=seconds,
+            new_query=False,
+        )
+        return doc
+
+    def _finish(self, seconds: float) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        self._seconds += seconds
+        self._collection._record(
+            self._operation, n_documents=0, n_bytes=0, seconds=seconds, new_query=False
+        )
+        self._collection._log_if_slow(
+            self._operation, self._args, self._kwargs, self._n_documents, self._seconds
+        )
+
+
+class InstrumentedDatabase:
+    """A proxy of a pymongo (or mongomock) database that gives out instrumented collections"""
+
+    def __init__(self, mongo_db, slow_seconds: float = SLOW_OPERATION_SECONDS):
+        self._mongo_db = mongo_db
+        self._slow_seconds = slow_seconds
+
+    def get_collection(self, name: str, **kwargs) -> InstrumentedCollection:
+        return InstrumentedCollection(
+            self._mongo_db.get_collection(name, **kwargs),
+            slow_seconds=self._slow_seconds,
+        )
+
+    def __getattr__(self, name: str):
+        return getattr(self._mongo_db, name)
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import sentry_sdk
+
+import models
+from cluster import default_worker_id
+
+logger = logging.getLogger(__name__)
+
+# the outcomes of a reminder for a single user
+SENT = "sent"
+SKIPPED = "skipped"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+# how often the admin who has started a campaign gets a progress report
+PROGRESS_REPORT_EVERY = 100
+
+
+class ReminderCampaigns:
+    """
+    Runs the reminder passes over the due users ("campaigns").
+    Each run and the outcome for each user are recorded in Mongo, so an interrupted run can be resumed
+    without reminding anyone twice. A run is claimed by one process at a time (the claim is renewed while it runs),
+    and each user is claimed before the reminder is sent. The reminders are sent by a bounded pool of workers;
+    the global rate limit is applied by the outbox of the sender.
+    """
+
+    def __init__(
+        self,
+        db: models.Database,
+        remind: Callable[[models.UserState], str],
+        notify: Callable[[int, str], None],
+        n_workers: int = 4,
+    ):
+        self.db = db
+        # sends a reminder to a user and returns the outcome
+        self.remind = remind
+        # sends a progress report to the admin
+        self.notify = notify
+        self.n_workers = n_workers
+        self._lock = threading.Lock()
+
+    def start_in_background(self, requested_by: Optional[int] = None) -> None:
+        """Start a new run (or resume an interrupted one) without waiting for it"""
+        threading.Thread(
+            target=self.run, kwargs={"requested_by": requested_by}, daemon=True
+        ).start()
+
+    def resume_interrupted(self) -> None:
+        """Continue the run that was interrupted by a restart, if there is one"""
+        if self.db.get_unfinished_reminder_run() is not None:
+            self.start_in_background()
+
+    def run(self, requested_by: Optional[int] = None) -> Optional[int]:
+        """Remind all the due users, and return the id of the run"""
+        if not self._lock.acquire(blocking=False):
+            logger.info("A reminder run is already in progress in this process")
+            if requested_by is not None:
+                self.notify(requested_by, "Обход юзеров уже идёт.")
+            return None
+        try:
+            return self._run(requested_by=requested_by)
+        finally:
+            self._lock.release()
+
+    def _keep_claim(self, run_id: int, owner: str, stop: threading.Event) -> None:
+        """Renew the claim on the run until it is finished; if the claim is lost, stop the run"""
+        while not stop.wait(models.REMINDER_RUN_LEASE_SECONDS / 3):
+            try:
+                if not self.db.renew_reminder_run(run_id=run_id, owner=owner):
+                    logger.warning(f"The reminder run {run_id} has been taken over")
+                    stop.set()
+            except Exception:
+                logger.exception(f"Could not renew the reminder run {run_id}")
+
+    def _run(self, requested_by: Optional[int]) -> Optional[int]:
+        owner = default_worker_id()
+        run = self.db.claim_reminder_run(owner=owner, requested_by=requested_by)
+        if run is None:
+            logger.info("A reminder run is already in progress in another process")
+            if requested_by is not None:
+                self.notify(requested_by, "Обход юзеров уже идёт.")
+            return None
+        run_id = run["run_id"]
+        logger.info(f"Running the reminder run {run_id} in {owner}")
+        admin_id = requested_by or run.get("requested_by")
+
+        self.db.reset_blocked_users()
+        self.db.backfill_reminder_schedule()
+        done_user_ids = self.db.get_reminded_user_ids(run_id=run_id)
+
+        n_processed = 0
+        # the semaphore bounds the number of users taken from the cursor but not yet processed
+        in_flight = threading.BoundedSemaphore(self.n_workers * 2)
+        # set when the run is finished or when another process has taken it over
+        stop = threading.Event()
+        threading.Thread(
+            target=self._keep_claim,
+            args=(run_id, owner, stop),
+            name="reminder-run-claim",
+            daemon=True,
+        ).start()
+
+        def process(user: models.UserState) -> None:
+            try:
+                # the user is claimed before the reminder, so that no one is reminded twice
+                if stop.is_set() or not self.db.claim_reminder_user(
+                    run_id=run_id, user_id=user.user_id
+                ):
+                    return
+                try:
+                    outcome = self.remind(user)
+                    error = None
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    logger.exception(f"Could not remind the user {user.user_id}")
+                    outcome, error = FAILED, str(e)
+                self.db.record_reminder_outcome(
+                    run_id=run_id, user_id=user.user_id, outcome=outcome, error=error
+                )
+            finally:
+                in_flight.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+                # the blocked, too inactive or recently active users are not due (see UserState.schedule_next_reminder)
+                for user in self.db.iter_users_due_for_reminder(now=time.time()):
+                    if stop.is_set():
+                        break
+                    if user.user_id in done_user_ids:
+                        continue
+                    in_flight.acquire()
+                    pool.submit(process, user)
+                    n_processed += 1
+                    if (
+                        admin_id is not None
+                        and n_processed % PROGRESS_REPORT_EVERY == 0
+                    ):
+                        self.notify(admin_id, f"Обработано юзеров: {n_processed}...")
+            if stop.is_set():
+                # another process continues the run
+                return run_id
+        finally:
+            stop.set()
+
+        finished = self.db.finish_reminder_run(run_id=run_id)
+        outcomes = (finished or {}).get("outcomes") or {}
+        logger.info(f"Finished the reminder run {run_id}: {outcomes}")
+        if admin_id is not None:
+            report = ", ".join(f"{key}: {value}" for key, value in outcomes.items())
+            self.notify(admin_id, f"Обход юзеров завершён! {report}")
+        return run_id
@@ -0,0 +1,58 @@
+import logging
+from typing import Callable, Dict, Set
+
+from pymongo import ReturnDocument  # type: ignore
+from pymongo.collection import Collection  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceAllocator:
+    """
+    Allocates integer ids from named counters stored in a Mongo collection.
+    Each counter document looks like {"_id": name, "seq": last_allocated_value}.
+    Allocation is a single atomic find-and-increment, so concurrent writers never get the same id.
+    """
+
+    def __init__(
+        self,
+        counters: Collection,
+        seeders: Dict[str, Callable[[], int]],
+    ):
+        self.counters = counters
+        # for each counter, a function that returns the largest value already used by the existing documents
+        self.seeders = seeders
+        self._seeded: Set[str] = set()
+
+    def _ensure_seeded(self, name: str) -> None:
+        """Initialize the counter from the existing data, if it has never been used before"""
+        if name in self._seeded:
+            return
+        if self.counters.find_one({"_id": name}) is None:
+            seeder = self.seeders.get(name)
+            start = seeder() if seeder is not None else 0
+            logger.info(f"Seeding the id counter {name} with the value {start}")
+            # $max is idempotent, so concurrent seeding by several processes is harmless
+            self.observe(name, start)
+        self._seeded.add(name)
+
+    def observe(self, name: str, value: int) -> None:
+        """Make sure that the counter is not behind a value assigned outside of the allocator"""
+        self.counters.update_one({"_id": name}, {"$max": {"seq": value}}, upsert=True)
+
+    def reserve(self, name: str, count: int = 1) -> int:
+        """Reserve a block of `count` consecutive ids and return the first of them"""
+        assert count > 0
+        self._ensure_seeded(name)
+        obj = self.counters.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        # with upsert and ReturnDocument.AFTER, the counter document is always returned
+        assert obj is not None, f"The id counter {name} has not been created"
+        return obj["seq"] - count + 1
+
+    def next_id(self, name: str) -> int:
+        return self.reserve(name, count=1)
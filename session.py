@@ -0,0 +1,65 @@
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# an entity is identified by its kind (e.g. "task") and its id
+EntityKey = Tuple[str, Hashable]
+# a function that writes the given entities of one kind to the database at once
+Writer = Callable[[List[Any]], None]
+
+
+class Session:
+    """
+    A request-scoped identity map and unit of work.
+    Within a session, each entity is loaded at most once, and the same object is returned for repeated lookups.
+    Changes of the existing entities are collected and written when the session is flushed,
+    so an entity saved several times while handling a message is written only once.
+    """
+
+    def __init__(self):
+        self.identity_map: Dict[EntityKey, Any] = {}
+        # dirty entities by key, in the order of their first modification
+        self.dirty: Dict[EntityKey, Any] = {}
+        self.writers: Dict[str, Writer] = {}
+        self.n_loads = 0
+        self.n_hits = 0
+        self.n_flushes = 0
+
+    def get(self, kind: str, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the entity from the identity map, or load it (and remember it, if it exists)"""
+        entity_key = (kind, key)
+        if entity_key in self.identity_map:
+            self.n_hits += 1
+            return self.identity_map[entity_key]
+        self.n_loads += 1
+        entity = loader()
+        if entity is not None:
+            self.identity_map[entity_key] = entity
+        return entity
+
+    def lookup(self, kind: str, key: Hashable) -> Optional[Any]:
+        """Return the entity if it is already in the identity map, without loading it"""
+        return self.identity_map.get((kind, key))
+
+    def add(self, kind: str, key: Hashable, entity: Any) -> Any:
+        """Put the entity into the identity map; if another object with the same key is there, it is replaced"""
+        self.identity_map[(kind, key)] = entity
+        return entity
+
+    def mark_dirty(self, kind: str, key: Hashable, entity: Any, writer: Writer) -> None:
+        self.add(kind, key, entity)
+        self.dirty[(kind, key)] = entity
+        self.writers[kind] = writer
+
+    def flush(self) -> None:
+        """Write all the dirty entities, one batch per kind"""
+        if not self.dirty:
+            return
+        batches: Dict[str, List[Any]] = {}
+        for (kind, _), entity in self.dirty.items():
+            batches.setdefault(kind, []).append(entity)
+        self.dirty = {}
+        for kind, entities in batches.items():
+            self.writers[kind](entities)
+        self.n_flushes += 1
@@ -0,0 +1,306 @@
+import heapq
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from sortedcontainers import SortedDict  # type: ignore
+
+# Tells whether a task id can be given to the current user
+TaskFilter = Callable[[int], bool]
+
+# How many times we try a random task before looking through the others one by one
+N_RANDOM_ATTEMPTS = 20
+
+
+class RandomSet:
+    """A set of task ids with O(1) insertion, deletion and random choice"""
+
+    def __init__(self):
+        self.ids: List[int] = []
+        # the positions of the ids in the list
+        self.positions: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self.positions
+
+    def add(self, task_id: int) -> None:
+        if task_id in self.positions:
+            return
+        self.positions[task_id] = len(self.ids)
+        self.ids.append(task_id)
+
+    def remove(self, task_id: int) -> None:
+        position = self.positions.pop(task_id, None)
+        if position is None:
+            return
+        # move the last id into the place of the removed one
+        last_id = self.ids.pop()
+        if last_id != task_id:
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def pick(self, is_allowed: TaskFilter) -> Optional[int]:
+        """
+        Choose a random allowed task. The filter is applied lazily: usually, one of the first random tries is allowed;
+        otherwise, the tasks are checked one by one from a random position until an allowed one is found.
+        """
+        if not self.ids:
+            return None
+        for _ in range(min(N_RANDOM_ATTEMPTS, len(self.ids))):
+            task_id = random.choice(self.ids)
+            if is_allowed(task_id):
+                return task_id
+        start = random.randrange(len(self.ids))
+        for i in range(len(self.ids)):
+            task_id = self.ids[(start + i) % len(self.ids)]
+            if is_allowed(task_id):
+                return task_id
+        return None
+
+
+class BucketIndex:
+    """Task ids grouped by an integer key, with the keys in a sorted map (O(log n) insertion and deletion)"""
+
+    def __init__(self):
+        self.buckets = SortedDict()
+
+    def add(self, key: int, task_id: int) -> None:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = RandomSet()
+        bucket.add(task_id)
+
+    def remove(self, key: int, task_id: int) -> None:
+        bucket = self.buckets[key]
+        bucket.remove(task_id)
+        if not bucket:
+            del self.buckets[key]
+
+    def iter_buckets(self, descending: bool = False) -> Iterator[RandomSet]:
+        keys = reversed(self.buckets) if descending else iter(self.buckets)
+        for key in keys:
+            yield self.buckets[key]
+
+    def pick(self, is_allowed: TaskFilter, descending: bool = False) -> Optional[int]:
+        """Choose randomly among the allowed tasks with the lowest (or highest) key, going through the keys in order"""
+        for bucket in self.iter_buckets(descending=descending):
+            task_id = bucket.pick(is_allowed)
+            if task_id is not None:
+                return task_id
+        return None
+
+
+class TaskPool:
+    """A set of tasks indexed by the number of completions, by incompleteness score, and for random access"""
+
+    def __init__(self):
+        # task_id => (completions, incompleteness score)
+        self.entries: Dict[int, Tuple[int, int]] = {}
+        self.by_completions = BucketIndex()
+        self.by_score = BucketIndex()
+        self.ids = RandomSet()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self.entries
+
+    def add(self, task_id: int, completions: int, score: int) -> None:
+        if task_id in self.entries:
+            self.remove(task_id)
+        self.entries[task_id] = (completions, score)
+        self.by_completions.add(completions, task_id)
+        self.by_score.add(score, task_id)
+        self.ids.add(task_id)
+
+    def remove(self, task_id: int) -> None:
+        if task_id not in self.entries:
+            return
+        completions, score = self.entries.pop(task_id)
+        self.by_completions.remove(completions, task_id)
+        self.by_score.remove(score, task_id)
+        self.ids.remove(task_id)
+
+    def pick_least_completions(self, is_allowed: TaskFilter) -> Optional[int]:
+        return self.by_completions.pick(is_allowed)
+
+    def pick_least_complete(self, is_allowed: TaskFilter) -> Optional[int]:
+        return self.by_score.pick(is_allowed, descending=True)
+
+    def pick_most_complete(self, is_allowed: TaskFilter) -> Optional[int]:
+        return self.by_score.pick(is_allowed)
+
+    def pick_random(self, is_allowed: TaskFilter) -> Optional[int]:
+        return self.ids.pick(is_allowed)
+
+
+class ProjectSchedule:
+    """
+    The incomplete tasks of a project, split into the locked and the unlocked pool.
+    A task is locked while its lease has not expired; the expired leases are moved to the unlocked pool
+    when a task is picked, so no separate cleanup is needed.
+    """
+
+    def __init__(self):
+        self.locked = TaskPool()
+        self.unlocked = TaskPool()
+        # task_id => lease expiration time, for the locked tasks
+        self.leases: Dict[int, float] = {}
+        # (lease expiration time, task_id); outdated entries are skipped when popped
+        self.expirations: List[Tuple[float, int]] = []
+        self.loaded_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.locked) + len(self.unlocked)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self.locked or task_id in self.unlocked
+
+    def update(
+        self,
+        task_id: int,
+        completions: int,
+        score: int,
+        completed: bool,
+        locked_until: Optional[float] = None,
+    ) -> None:
+        """Update the task priorities; the lease of a known task is changed only by `set_lease`"""
+        if task_id in self:
+            locked_until = self.leases.get(task_id)
+        self._remove(task_id)
+        if not completed:
+            self._add(task_id, completions, score, locked_until)
+
+    def set_lease(self, task_id: int, locked_until: Optional[float]) -> None:
+        entry = self.locked.entries.get(task_id) or self.unlocked.entries.get(task_id)
+        if entry is None:
+            return
+        completions, score = entry
+        self._remove(task_id)
+        self._add(task_id, completions, score, locked_until)
+
+    def _remove(self, task_id: int) -> None:
+        self.locked.remove(task_id)
+        self.unlocked.remove(task_id)
+        self.leases.pop(task_id, None)
+
+    def _add(
+        self, task_id: int, completions: int, score: int, locked_until: Optional[float]
+    ) -> None:
+        if locked_until is not None and locked_until > time.time():
+            self.locked.add(task_id, completions=completions, score=score)
+            self.leases[task_id] = locked_until
+            heapq.heappush(self.expirations, (locked_until, task_id))
+        else:
+            self.unlocked.add(task_id, completions=completions, score=score)
+
+    def release_expired(self, now: float) -> None:
+        while self.expirations and self.expirations[0][0] <= now:
+            expiration, task_id = heapq.heappop(self.expirations)
+            if self.leases.get(task_id) == expiration:
+                self.set_lease(task_id, None)
+
+    def candidate_pool(self) -> TaskPool:
+        self.release_expired(time.time())
+        # if all unfinished tasks are locked, pick any of the locked ones
+        return self.unlocked if len(self.unlocked) > 0 else self.locked
+
+
+class TaskScheduler:
+    """
+    An in-memory index of the incomplete tasks for each project, used to choose a new task for a user.
+    A project is loaded on the first use and reloaded after `refresh_seconds`,
+    to pick up the changes made by other processes; in between, it is updated on every task save.
+    """
+
+    def __init__(self, refresh_seconds: float = 60 * 10):
+        self.refresh_seconds = refresh_seconds
+        self.projects: Dict[int, ProjectSchedule] = {}
+        self.lock = threading.RLock()
+
+    def needs_loading(self, project_id: int) -> bool:
+        schedule = self.projects.get(project_id)
+        return (
+            schedule is None or time.time() - schedule.loaded_at > self.refresh_seconds
+        )
+
+    def load(
+        self, project_id: int, tasks: List[Tuple[int, int, int, Optional[float]]]
+    ) -> None:
+        """Replace the project index with the given (task_id, completions, score, locked_until) tuples"""
+        schedule = ProjectSchedule()
+        for task_id, completions, score, locked_until in tasks:
+            schedule.update(
+                task_id,
+                completions=completions,
+                score=score,
+                completed=False,
+                locked_until=locked_until,
+            )
+        with self.lock:
+            self.projects[project_id] = schedule
+
+    def update(
+        self,
+        project_id: int,
+        task_id: int,
+        completions: int,
+        score: int,
+        completed: bool,
+        locked_until: Optional[float] = None,
+    ) -> None:
+        with self.lock:
+            schedule = self.projects.get(project_id)
+            # the projects that are not loaded yet will get the fresh data when loaded
+            if schedule is not None:
+                schedule.update(
+                    task_id,
+                    completions=completions,
+                    score=score,
+                    completed=completed,
+                    locked_until=locked_until,
+                )
+
+    def set_lease(
+        self, project_id: int, task_id: int, locked_until: Optional[float]
+    ) -> None:
+        with self.lock:
+            schedule = self.projects.get(project_id)
+            if schedule is not None:
+                schedule.set_lease(task_id, locked_until)
+
+    def invalidate(self, project_id: Optional[int] = None) -> None:
+        with self.lock:
+            if project_id is None:
+                self.projects.clear()
+            else:
+                self.projects.pop(project_id, None)
+
+    def count(self, project_id: int) -> int:
+        with self.lock:
+            schedule = self.projects.get(project_id)
+            return len(schedule) if schedule is not None else 0
+
+    def count_unlocked(self, project_id: int) -> int:
+        with self.lock:
+            schedule = self.projects.get(project_id)
+            if schedule is None:
+                return 0
+            schedule.release_expired(time.time())
+            return len(schedule.unlocked)
+
+    def pick(
+        self, project_id: int, pick_method: str, is_allowed: TaskFilter
+    ) -> Optional[int]:
+        """Choose an allowed task with one of the TaskPool.pick_* methods"""
+        with self.lock:
+            schedule = self.projects.get(project_id)
+            if schedule is None:
+                return None
+            pool = schedule.candidate_pool()
+            return getattr(pool, pick_method)(is_allowed)
@@ -1,13 +1,18 @@
 import os
 import random
-from typing import List, Optional, Tuple
+import time
+from typing import List, Optional, Set, Tuple
 
 import texts
+from events import LabelFinalized, TranslationSaved
 from language_coding import LangCodeForm, get_lang_name
 from models import (
+    NO_USER,
+    TASK_LEASE_SECONDS,
     Database,
     TransInput,
     TransLabel,
+    TransProject,
     TransResult,
     TransStatus,
     TransTask,
@@ -24,18 +29,35 @@ def do_assign_input(
 ) -> Tuple[str, List[str]]:
     # we do a loop, because we may need to skip some inputs
     assert user.user_id is not None
-    prev_sent_id = user.curr_sent_id
+    # the user is still active, so their lease on the task is renewed before it runs out
+    if (
+        task.locked_by == user.user_id
+        and task.locked_until is not None
+        and task.locked_until - time.time() < TASK_LEASE_SECONDS / 2
+    ):
+        db.claim_task(task=task, user_id=user.user_id)
+    # the data for choosing the input is loaded by pages, so skipping the inputs rarely costs extra queries
+    working_set = db.load_task_working_set(
+        task=task, user_id=user.user_id, after_id=user.curr_sent_id
+    )
+    unsolved_inputs = iter(working_set.inputs)
     for attempt in range(100):
 
-        inp: Optional[TransInput] = db.get_next_unsolved_input(
-            task=task,
-            prev_sent_id=prev_sent_id,
-        )
+        inp: Optional[TransInput] = next(unsolved_inputs, None)
+        if inp is None and not working_set.exhausted:
+            # all the inputs of the page have been skipped, so the next page starts after the last of them
+            working_set = db.load_task_working_set(
+                task=task,
+                user_id=user.user_id,
+                after_id=working_set.inputs[-1].input_id,
+            )
+            unsolved_inputs = iter(working_set.inputs)
+            inp = next(unsolved_inputs, None)
         print("attempt", attempt, "trying input:", inp)
         # No input means that the task is completed by the user
         if inp is None:
             # check the conditions whether the task is fully completed, and update ts status
-            task.locked = False
+            db.release_task(task=task, user_id=user.user_id)
             task.completions += 1
             unsolved_input = db.get_next_unsolved_input(task=task, prev_sent_id=None)
             if unsolved_input is None:
@@ -61,7 +83,11 @@ def do_assign_input(
             all_translations,
             unchecked_translations_unseen_by_user,
             all_unchecked_translations,
-        ) = find_translations_to_score(user=user, db=db, inp=inp)
+        ) = split_translations_to_score(
+            user=user,
+            all_translations=working_set.translations[inp.input_id],
+            already_scored_candidates=working_set.scored_translation_ids,
+        )
         print(
             f"for input {inp.input_id} found {len(all_translations)} translations: including {len(all_unchecked_translations)} unchecked, and {len(unchecked_translations_unseen_by_user)} unseen by user."
         )
@@ -75,7 +101,6 @@ def do_assign_input(
 
         # Case 2: no translations to score, but there are some pending translatons => skip the input, until the pending translations are scored
         elif len(all_unchecked_translations):
-            prev_sent_id = inp.input_id
             print(
                 f"continuing to another input, because there are {len(all_unchecked_translations)} unscored translations for the input {inp.input_id}"
             )
@@ -86,7 +111,9 @@ def do_assign_input(
             print(
                 f"asking to translate, because for user {user.user_id} and input {inp.input_id}, there are no unscored translations"
             )
-            return do_ask_to_translate(user=user, db=db, inp=inp)
+            return do_ask_to_translate(
+                user=user, db=db, inp=inp, project=working_set.project
+            )
     return (
         f"Произошло что-то странное. Пожалуйста, напишите @cointegrated, что по заданию {task.task_id} вам не смогли выдать текст.",
         [],
@@ -102,6 +129,18 @@ def find_translations_to_score(
     already_scored_candidates = db.get_translations_ids_scored_by_user(
         user_id=user.user_id, task_id=inp.task_id
     )
+    return split_translations_to_score(
+        user=user,
+        all_translations=all_translations,
+        already_scored_candidates=already_scored_candidates,
+    )
+
+
+def split_translations_to_score(
+    user: UserState,
+    all_translations: List[TransResult],
+    already_scored_candidates: Set[int],
+) -> Tuple[List[TransResult], List[TransResult], List[TransResult]]:
     all_unchecked_translations = [
         cand for cand in all_translations if cand.status == TransStatus.UNCHECKED
     ]
@@ -141,10 +180,11 @@ def do_ask_to_translate(
     user: UserState,
     db: Database,
     inp: TransInput,
+    project: Optional[TransProject] = None,
 ) -> Tuple[str, List[str]]:
     src_text = inp.source
 
-    proj = db.get_project(project_id=inp.project_id)
+    proj = project or db.get_project(project_id=inp.project_id)
     assert proj is not None and proj.src_code is not None and proj.tgt_code is not None
     src_lang_phrase = get_lang_name(proj.src_code, code_form_id=LangCodeForm.src)
     tgt_lang_phrase = get_lang_name(proj.tgt_code, code_form_id=LangCodeForm.tgt)
@@ -276,23 +316,43 @@ def do_finalize_label_and_continue(
     # Case 1: acceptance
     if label_is_good is True:
         accepted = True
-        res.n_approvals += 1
-        if res.n_approvals >= project.overlap and res.status != TransStatus.REJECTED:
-            res.status = TransStatus.ACCEPTED
-
     # Case 2: rejection
     elif label_is_good is False:
         accepted = False
-        res.status = TransStatus.REJECTED
     else:  # this is not possible!
         return texts.FALLBACK, []
 
-    db.save_translation(res)
+    # the verdict is applied atomically, because other users may be scoring the same translation concurrently
+    before = db.apply_translation_verdict(
+        res=res, accepted=accepted, overlap=project.overlap
+    )
+    old_status, was_partial = before.status, is_partially_accepted(before)
 
     # if the translation is accepted, the translation input is solved
-    if res.status == TransStatus.ACCEPTED:
-        inp.solved = True
-        db.save_input(inp)
+    newly_solved = res.status == TransStatus.ACCEPTED and db.mark_input_solved(inp)
+
+    # an input is partially accepted if any of its translations is; we check the others only if this one has changed
+    partial_delta = 0
+    is_partial = is_partially_accepted(res)
+    if is_partial != was_partial and not db.input_has_partial_translations(
+        input_id=inp.input_id, exclude_translation_id=res.translation_id
+    ):
+        partial_delta = 1 if is_partial else -1
+    db.inc_project_stats(
+        project.project_id,
+        n_positive_labels=int(accepted),
+        n_negative_labels=int(not accepted),
+        n_rejected_user_translations=int(
+            res.status == TransStatus.REJECTED
+            and old_status != TransStatus.REJECTED
+            and res.user_id != NO_USER
+        ),
+        n_solved=int(newly_solved),
+        n_partial=partial_delta,
+    )
+    db.events.publish(
+        LabelFinalized(label=label, translation=res, old_status=old_status)
+    )
 
     # if the user has accepted a translation, no reason in asking for a new one; jumping to the next input
     if accepted:
@@ -322,6 +382,10 @@ def do_finalize_label_and_continue(
     return do_ask_to_translate(user=user, db=db, inp=inp)
 
 
+def is_partially_accepted(res: TransResult) -> bool:
+    return res.status == TransStatus.UNCHECKED and res.n_approvals > 0
+
+
 def do_save_translation_and_ask_for_next(
     user: UserState, db: Database, user_text: str
 ) -> Tuple[str, List[str]]:
@@ -345,6 +409,7 @@ def do_save_translation_and_ask_for_next(
             # TODO (future) maybe, tell the user that the translation is a duplicate and ask for a different one!
 
     db.save_translation(translation)
+    db.events.publish(TranslationSaved(translation=translation))
 
     # do NOT reset current sent id, because it will be used to determine the next input!
     user.curr_result_id = None
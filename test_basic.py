@@ -1,8 +1,13 @@
 import time
 
+import pytest
 import telebot.types  # type: ignore
+from telebot.apihelper import ApiTelegramException  # type: ignore
 
+import metrics
 import models
+import reminders
+import session
 import tasking
 import texts
 from dialogue_management import DialogueManager, FakeBot
@@ -42,6 +47,7 @@ def setup_fake_project(db: models.Database):
     project.src_code = "eng"
     project.tgt_code = "rus"
     db.save_project(project)
+    db.rebuild_project_stats(project_id=project.project_id)
     task1 = db.create_task(
         project=project, prompt="This is a first task prompt", save=True
     )
@@ -155,3 +161,176 @@ def test_basic_scenario():
 
     manager.respond(get_test_message("/task"))
     assert "нет никаких заданий" in bot.last_message.text
+
+    # the incrementally updated statistics match the full recomputation
+    stats = db.get_project_stats(project_id=TEST_PROJECT_ID)
+    assert stats["n_labels"] == 2
+    assert stats == db.rebuild_project_stats(project_id=TEST_PROJECT_ID)
+
+
+def test_input_paging():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Paging", save=False)
+    project.src_code, project.tgt_code = "eng", "rus"
+    db.save_project(project)
+    task = db.create_task(project=project, save=True)
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(models.WORKING_SET_SIZE + 2)
+    ]
+    db.add_inputs(inputs)
+    # the inputs with the pending translations of the user themselves are skipped, even beyond the first page
+    db.add_translations(
+        [db.create_translation(user_id=1, trans_input=inp) for inp in inputs[:-1]]
+    )
+    user = models.UserState(user_id=1, curr_proj_id=project.project_id)
+    tasking.do_assign_input(user=user, db=db, task=task)
+    assert user.state_id == States.ASK_TRANSLATION
+    assert user.curr_sent_id == inputs[-1].input_id
+
+
+def test_reminders():
+    db = models.Database.setup(mongo_url=None)
+    setup_fake_project(db)
+    bot = FakeBot()
+    manager = DialogueManager(db=db, bot=bot)
+    manager.respond(get_test_message("/start"))
+    user = db.get_user(TEST_USER_ID)
+    assert user.next_reminder_at > time.time() + models.REMINDER_INTERVAL_SECONDS - 1
+
+    # a recently active user is not reminded
+    manager.run_reminders()
+    manager.outbox.join()
+    assert bot.last_message.user_id == TEST_USER_ID and len(bot.messages) == 1
+
+    # an inactive user is reminded and rescheduled; a blocked one is detached from the task
+    db.mongo_users.update_one(
+        {"user_id": TEST_USER_ID},
+        {
+            "$set": {
+                "next_reminder_at": time.time() - 1,
+                "curr_proj_id": TEST_PROJECT_ID,
+            }
+        },
+    )
+    db.save_user(models.UserState(user_id=456, is_blocked=True, curr_task_id=1))
+    manager.run_reminders()
+    manager.outbox.join()
+    assert len(bot.messages) == 2
+    assert "Добрый день!" in bot.last_message.text
+    user = db.get_user(TEST_USER_ID)
+    assert user.n_last_reminders == 1
+    assert user.next_reminder_at > time.time()
+    blocked = db.get_user(456)
+    assert blocked.curr_task_id is None and blocked.next_reminder_at is None
+    assert [run["outcomes"] for run in db.reminder_runs.find()] == [
+        {},
+        {reminders.SENT: 1},
+    ]
+
+    # an interrupted run is resumed without reminding the same users again
+    db.mongo_users.update_one(
+        {"user_id": TEST_USER_ID}, {"$set": {"next_reminder_at": time.time() - 1}}
+    )
+    run = db.claim_reminder_run(owner="another process")
+    assert db.claim_reminder_user(run_id=run["run_id"], user_id=TEST_USER_ID)
+    # while the other process is alive, its run is not taken over
+    assert manager.campaigns.run() is None
+    assert len(bot.messages) == 2
+
+    # when it dies, its claim expires, and the run is resumed without the users it has claimed
+    db.reminder_runs.update_one({"run_id": run["run_id"]}, {"$set": {"expires_at": 0}})
+    assert manager.campaigns.run() == run["run_id"]
+    assert len(bot.messages) == 2
+    assert db.get_unfinished_reminder_run() is None
+
+
+def test_blocked_user_releases_tasks():
+    db = models.Database.setup(mongo_url=None)
+    setup_fake_project(db)
+    manager = DialogueManager(db=db, bot=FakeBot())
+    user = models.UserState(user_id=TEST_USER_ID, curr_proj_id=TEST_PROJECT_ID)
+    db.save_user(user)
+    task = db.get_new_task(user=user, prioritize_type=models.PrioritizeType.RANDOM)
+    assert db.claim_task(task=task, user_id=TEST_USER_ID)
+    assert not db.has_free_tasks(TEST_PROJECT_ID)
+
+    error = ApiTelegramException(
+        "sendMessage",
+        None,
+        {"error_code": 403, "description": "Forbidden: bot was blocked by the user"},
+    )
+    manager.handle_push_error(user, error)
+    assert db.get_user(TEST_USER_ID).is_blocked
+    assert db.trans_tasks.find_one({"task_id": task.task_id})["locked_by"] is None
+    assert db.has_free_tasks(TEST_PROJECT_ID)
+
+
+def test_metrics():
+    db = models.Database.setup(mongo_url=None)
+    manager = DialogueManager(db=db, bot=FakeBot())
+    help_seconds = metrics.DIALOGUE_SECONDS.labels("/help")
+    n_before = sum(help_seconds.counts)
+    manager.respond(get_test_message("/help"))
+    assert sum(help_seconds.counts) == n_before + 1
+
+    exported = metrics.REGISTRY.render()
+    assert "# TYPE bot_dialogue_seconds histogram" in exported
+    assert 'bot_dialogue_seconds_bucket{branch="/help",le="+Inf"}' in exported
+    assert 'bot_db_method_seconds_count{method="save_user"}' in exported
+    assert 'bot_telegram_call_seconds_count{method="send_message"}' in exported
+
+
+def test_replies_after_flush(monkeypatch):
+    db = models.Database.setup(mongo_url=None)
+    bot = FakeBot()
+    manager = DialogueManager(db=db, bot=bot)
+
+    def fail(self):
+        raise RuntimeError("The database is unavailable")
+
+    # if the changes cannot be written, the user gets no reply
+    monkeypatch.setattr(session.Session, "flush", fail)
+    with pytest.raises(RuntimeError, match="unavailable"):
+        manager.respond(get_test_message("/help"))
+    assert bot.messages == []
+
+    monkeypatch.undo()
+    manager.respond(get_test_message("/help"))
+    assert len(bot.messages) == 1
+    assert db.get_user(TEST_USER_ID).username == "test_user"
+
+
+def test_app_factory(monkeypatch):
+    monkeypatch.setenv("TOKEN", "123:test")
+    monkeypatch.setenv("SECRET_KEY", "test")
+    import app
+
+    server = app.create_app()
+    assert server.secret_key == "test"
+    client = server.test_client()
+    assert client.get("/projects").status_code == 200
+    assert client.post("/telegram/wrong_token", data="{}").status_code == 404
+
+    # the clients are created once per process, and again in a forked process
+    context = app.get_context()
+    assert client.get("/health/").json["pid"] == context.pid
+
+    # the direct calls of the bot are timed like the outgoing messages, and their failures are counted
+    def reply_to(msg, text):
+        raise ApiTelegramException(
+            "sendMessage", None, {"error_code": 403, "description": "Forbidden"}
+        )
+
+    monkeypatch.setattr(context.bot, "send_chat_action", lambda chat_id, action: None)
+    monkeypatch.setattr(context.bot, "reply_to", reply_to)
+    group_message = get_test_message("/start")
+    group_message.chat.type = "group"
+    with pytest.raises(ApiTelegramException):
+        app._process_new_message(context, group_message)
+    exported = metrics.REGISTRY.render()
+    assert 'bot_telegram_call_seconds_count{method="send_chat_action"}' in exported
+    assert 'bot_telegram_errors_total{method="reply_to",code="403"}' in exported
+    assert app.get_context() is context
+    context.pid = -1
+    assert app.get_context() is not context
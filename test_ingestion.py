@@ -0,0 +1,173 @@
+import json
+import threading
+import time
+
+import telebot.types  # type: ignore
+
+import models
+from cluster import (
+    N_PARTITIONS,
+    ClusterWorker,
+    PartitionLeases,
+    UpdateQueue,
+    partition_for,
+)
+from dedup import UpdateDeduplicator
+from ingestion import UpdateDispatcher, get_update_user_id
+from leadership import LeaderLease, ScheduledJobs
+
+
+def make_payload(update_id, user_id, text):
+    return json.dumps(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+                "text": text,
+            },
+        }
+    )
+
+
+def make_update(update_id, user_id, text):
+    return telebot.types.Update.de_json(make_payload(update_id, user_id, text))
+
+
+def make_bot(handled, failing=()):
+    """A real bot whose handler records the messages; the earlier messages take longer to handle"""
+    bot = telebot.TeleBot("123:test", threaded=False)
+    lock = threading.Lock()
+
+    def handle(msg):
+        if msg.text in failing:
+            raise RuntimeError(f"Could not handle {msg.text}")
+        time.sleep(0.01 if int(msg.text) < 10 else 0)
+        with lock:
+            handled.append((msg.from_user.id, msg.text))
+
+    bot.register_message_handler(handle, func=lambda msg: True)
+    return bot
+
+
+def test_update_dispatcher():
+    handled = []
+    bot = make_bot(handled)
+    dispatcher = UpdateDispatcher(
+        handle=lambda update: bot.process_new_updates([update]), n_workers=3
+    )
+    for i in range(30):
+        dispatcher.submit(make_update(i, user_id=i % 5, text=str(i)))
+    dispatcher.join()
+
+    assert dispatcher.stats["processed"] == 30 and dispatcher.depth == 0
+    for user_id in range(5):
+        texts = [text for uid, text in handled if uid == user_id]
+        assert texts == [str(i) for i in range(user_id, 30, 5)]
+
+
+def test_update_deduplicator():
+    db = models.Database.setup(mongo_url=None)
+    dedup = UpdateDeduplicator(collection=db.processed_updates, max_size=2)
+    assert not dedup.is_handled(dedup.message_key(1, 10))
+    dedup.mark_handled(dedup.message_key(1, 10))
+    assert dedup.is_handled(dedup.message_key(1, 10))
+    # the same message id in another chat is a different message
+    assert not dedup.is_handled(dedup.message_key(2, 10))
+
+    # the memory is bounded, but the shared collection still remembers the evicted keys
+    dedup.mark_handled(dedup.message_key(2, 10))
+    dedup.mark_handled(dedup.message_key(3, 10))
+    assert len(dedup._recent) == 2
+    assert dedup.is_handled(dedup.message_key(1, 10))
+    another_process = UpdateDeduplicator(collection=db.processed_updates)
+    assert another_process.is_handled(dedup.message_key(2, 10))
+
+    # an update whose handling has been interrupted is not marked, so another process handles it
+    assert not dedup.is_handled(dedup.message_key(4, 10))
+    assert not another_process.is_handled(dedup.message_key(4, 10))
+
+
+def test_cluster_partitions():
+    db = models.Database.setup(mongo_url=None)
+    first = PartitionLeases(db, worker_id="first", lease_seconds=60)
+    assert len(first.rebalance()) == N_PARTITIONS
+
+    # a new worker gets half of the partitions after the first one releases its extra ones
+    second = PartitionLeases(db, worker_id="second", lease_seconds=60)
+    assert second.rebalance() == set()
+    assert len(first.rebalance()) == N_PARTITIONS // 2
+    assert len(second.rebalance()) == N_PARTITIONS // 2
+    assert not first.owned & second.owned
+
+    # when a worker dies, its leases expire and the other takes them over
+    db.cluster_workers.delete_one({"_id": "first"})
+    db.partition_leases.update_many(
+        {"owner": "first"}, {"$set": {"expires_at": time.time() - 1}}
+    )
+    assert len(second.rebalance()) == N_PARTITIONS
+
+
+def test_cluster_worker():
+    db = models.Database.setup(mongo_url=None)
+    handled = []
+    failing = {"7"}
+    bot = make_bot(handled, failing=failing)
+    worker = ClusterWorker(
+        db,
+        handle=lambda payload: bot.process_new_updates(
+            [telebot.types.Update.de_json(payload)]
+        ),
+        worker_id="worker",
+    )
+    queue = UpdateQueue(db)
+    for i in range(30):
+        queue.enqueue(
+            update_id=i, user_id=i % 5, payload=make_payload(i, i % 5, str(i))
+        )
+    # a redelivered update is queued only once
+    queue.enqueue(update_id=0, user_id=0, payload=make_payload(0, 0, "0"))
+
+    # a failed update stays in the queue, and the later updates of its user wait for it
+    assert worker.run_once() == 25
+    assert queue.depth() == 5
+    failing.clear()
+    assert worker.run_once() == 5
+    assert queue.depth() == 0
+    for user_id in range(5):
+        texts = [text for uid, text in handled if uid == user_id]
+        assert texts == [str(i) for i in range(user_id, 30, 5)]
+
+    # a partition whose lease has been taken by another worker is not processed any more
+    partition = partition_for(1, update_id=100)
+    db.partition_leases.update_one({"_id": partition}, {"$set": {"owner": "other"}})
+    assert partition not in worker.leases.renew()
+    queue.enqueue(update_id=100, user_id=1, payload=make_payload(100, 1, "100"))
+    assert worker.run_once() == 0 and queue.depth() == 1
+
+
+def test_scheduled_jobs_leader():
+    db = models.Database.setup(mongo_url=None)
+    first = ScheduledJobs(db, LeaderLease(db.leader_leases, "scheduler", "first"))
+    second = ScheduledJobs(db, LeaderLease(db.leader_leases, "scheduler", "second"))
+    calls = []
+    for jobs in [first, second]:
+        jobs.leader_only("job", lambda holder: calls.append(holder))(
+            holder=jobs.lease.holder_id
+        )
+    # only the leader runs the job
+    assert calls == ["first"]
+
+    # when the leader dies, its lease expires and another process takes over
+    db.leader_leases.update_one({"_id": "scheduler"}, {"$set": {"expires_at": 0}})
+    second.run("job", lambda: 1 / 0)
+    assert second.lease.is_leader and not first.lease.renew()
+
+    runs = second.get_recent_runs(job="job")
+    assert [(run["holder"], run["status"]) for run in runs] == [
+        ("second", "failed"),
+        ("first", "ok"),
+    ]
+    assert all(run["duration_seconds"] >= 0 for run in runs)
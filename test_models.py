@@ -0,0 +1,538 @@
+import time
+
+import pytest
+
+import events
+import metrics
+import models
+import query_log
+
+
+def test_id_sequences():
+    db = models.Database.setup(mongo_url=None)
+    # the counters are seeded from the data that existed before them
+    db.trans_tasks.insert_one({"task_id": 41, "project_id": 1})
+    project = db.create_project(title="Sequences")
+    task = db.create_task(project=project)
+    assert task.task_id == 42
+
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(3)
+    ]
+    db.add_inputs(inputs)
+    assert [inp.input_id for inp in inputs] == [1, 2, 3]
+    extra = db.create_input(project=project, task=task, source="extra", save=True)
+    assert extra.input_id == 4
+
+    # project ids assigned by hand push the counter forward
+    manual = db.create_project(title="Manual", save=False)
+    manual.project_id = 100
+    db.save_project(manual)
+    assert db.create_project(title="Next").project_id == 101
+
+    # web users get negative ids
+    first = db.create_user_with_password(username="first", password_hash="x")
+    second = db.create_user_with_password(username="second", password_hash="x")
+    assert (first.user_id, second.user_id) == (-1, -2)
+
+
+def test_indexes(monkeypatch):
+    db = models.Database.setup(mongo_url=None)
+    assert db.find_unindexed_queries() == []
+    # only a prefix of an index helps: (task_id, solved, input_id) does not serve a query by solved and source
+    shapes = [
+        models.QueryShape("trans_inputs", ("solved", "source"), "by_inner_keys"),
+        models.QueryShape(
+            "trans_inputs", ("task_id", "source", "meta"), "mostly_unindexed"
+        ),
+        models.QueryShape("trans_inputs", ("task_id", "solved", "source"), "by_prefix"),
+        models.QueryShape(
+            "trans_tasks", ("task_id", "prompt", "meta"), "by_unique_key"
+        ),
+    ]
+    monkeypatch.setattr(models, "QUERY_SHAPES", shapes)
+    assert [shape.method for shape in db.find_unindexed_queries()] == [
+        "by_inner_keys",
+        "mostly_unindexed",
+    ]
+    monkeypatch.undo()
+    index_keys = [
+        index["key"] for index in db.trans_inputs.index_information().values()
+    ]
+    assert [("task_id", 1), ("solved", 1), ("input_id", 1)] in index_keys
+    # creating the indexes is idempotent
+    db.ensure_indexes()
+
+
+def test_task_scheduler():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Scheduling")
+    tasks = [db.create_task(project=project) for _ in range(4)]
+    user = models.UserState(user_id=1, curr_proj_id=project.project_id)
+
+    tasks[0].completions = 2
+    tasks[1].completions = 1
+    tasks[1].completion_stats = {models.InputStatus.NO_TRANSLATION: 3}
+    tasks[2].completions = 1
+    tasks[2].completion_stats = {models.InputStatus.PARTIALLY_ACCEPTED: 1}
+    tasks[3].completed = True
+    for task in tasks:
+        db.save_task(task)
+
+    def pick(prioritize_type):
+        task = db.get_new_task(user=user, prioritize_type=prioritize_type)
+        return task.task_id if task else None
+
+    assert pick(models.PrioritizeType.LEAST_COMPLETIONS) in {
+        tasks[1].task_id,
+        tasks[2].task_id,
+    }
+    assert pick(models.PrioritizeType.LEAST_COMPLETE) == tasks[1].task_id
+    assert pick(models.PrioritizeType.MOST_COMPLETE) == tasks[0].task_id
+    assert pick(models.PrioritizeType.RANDOM) != tasks[3].task_id
+
+    # the tasks that the user has already touched are avoided
+    db.add_user_task_link(user_id=1, task=tasks[1])
+    assert pick(models.PrioritizeType.LEAST_COMPLETE) == tasks[2].task_id
+
+    # the tasks completed or leased by another process are checked against the database and skipped
+    db.trans_tasks.update_one(
+        {"task_id": tasks[2].task_id}, {"$set": {"completed": True}}
+    )
+    db.trans_tasks.update_one(
+        {"task_id": tasks[0].task_id},
+        {"$set": {"locked_by": 2, "locked_until": time.time() + 60}},
+    )
+    assert pick(models.PrioritizeType.MOST_COMPLETE) is None
+    assert db.task_scheduler.count(project.project_id) == 2
+    assert db.task_scheduler.count_unlocked(project.project_id) == 1
+
+
+def test_task_ids_with_work_for_user():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Eligibility")
+    tasks = [db.create_task(project=project) for _ in range(4)]
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}", save=True)
+        for i, task in enumerate(tasks)
+    ]
+    # task 0: an input without translations
+    # task 1: a pending translation by another user
+    # task 2: a pending translation by the user themselves
+    # task 3: a pending translation already labeled by the user
+    own = db.create_translation(user_id=1, trans_input=inputs[2], text="own")
+    other = db.create_translation(user_id=2, trans_input=inputs[1], text="other")
+    labeled = db.create_translation(user_id=2, trans_input=inputs[3], text="seen")
+    db.add_translations([own, other, labeled])
+    db.save_label(db.create_label(user_id=1, trans_result=labeled))
+    # task 4: the user's own translation and another one, labeled only by someone else
+    extra_task = db.create_task(project=project)
+    extra = db.create_input(project=project, task=extra_task, source="x", save=True)
+    mixed = db.create_translation(user_id=3, trans_input=extra, text="mixed")
+    db.add_translations(
+        [db.create_translation(user_id=1, trans_input=extra, text="mine"), mixed]
+    )
+    db.save_label(db.create_label(user_id=2, trans_result=mixed))
+
+    expected = {tasks[0].task_id, tasks[1].task_id, extra_task.task_id}
+    assert db.get_task_ids_with_work_for_user(project.project_id, 1) == expected
+    # the aggregation pipeline gives the same result as the Python implementation
+    db.is_mock = False
+    assert db.get_task_ids_with_work_for_user(project.project_id, 1) == expected
+
+
+def test_task_leases():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Leases")
+    first, second = [db.create_task(project=project) for _ in range(2)]
+    user = models.UserState(user_id=1, curr_proj_id=project.project_id)
+    assert db.has_free_tasks(project.project_id)
+
+    # only one user can hold a task
+    assert db.claim_task(first, user_id=1)
+    assert not db.claim_task(db.get_task(first.task_id), user_id=2)
+    assert db.get_task(first.task_id).locked_by == 1
+
+    # the free tasks are preferred
+    for _ in range(5):
+        assert db.get_new_task(user=user).task_id == second.task_id
+
+    # claiming another task releases the previous lease
+    assert db.claim_task(second, user_id=1)
+    assert db.get_task(first.task_id).locked_by is None
+    assert db.get_new_task(user=user).task_id == first.task_id
+
+    # expired leases count as free
+    assert db.claim_task(first, user_id=2, lease_seconds=-1)
+    assert db.claim_task(db.get_task(first.task_id), user_id=3)
+    db.release_task(second, user_id=1)
+    assert db.has_free_tasks(project.project_id)
+
+    # when all the tasks are locked, they are shared, even if this process has not seen a lease yet
+    shared_project = db.create_project(title="Shared")
+    claimed, leased = [db.create_task(project=shared_project) for _ in range(2)]
+    assert db.claim_task(claimed, user_id=1)
+    db.trans_tasks.update_one(
+        {"task_id": leased.task_id},
+        {"$set": {"locked_by": 3, "locked_until": time.time() + 60}},
+    )
+    other = models.UserState(user_id=2, curr_proj_id=shared_project.project_id)
+    for prioritize_type in models.PrioritizeType.all():
+        task = db.get_new_task(user=other, prioritize_type=prioritize_type)
+        assert task is not None and task.locked_by in {1, 3}
+
+
+def test_rebuild_task_statuses():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Statuses")
+    task, empty_task = db.create_task(project=project), db.create_task(project=project)
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(3)
+    ]
+    db.add_inputs(inputs)
+    system = db.create_translation(user_id=models.NO_USER, trans_input=inputs[0])
+    approved = db.create_translation(user_id=1, trans_input=inputs[1])
+    approved.n_approvals = 1
+    rejected = db.create_translation(user_id=1, trans_input=inputs[2])
+    rejected.status = models.TransStatus.REJECTED
+    db.add_translations([system, approved, rejected])
+
+    db.update_all_task_statuses(tasks_per_job=1)
+    assert db.get_task(task.task_id).completion_stats == {
+        models.InputStatus.UNCHECKED_SYSTEM_TRANSLATION: 1,
+        models.InputStatus.PARTIALLY_ACCEPTED: 1,
+        models.InputStatus.NO_TRANSLATION: 1,
+    }
+    assert db.get_task(empty_task.task_id).completion_stats == {}
+    assert (
+        db.get_input(inputs[1].input_id).input_status
+        == models.InputStatus.PARTIALLY_ACCEPTED
+    )
+
+    # the tasks whose statuses have not changed are not rewritten
+    version = db.get_task(task.task_id).version
+    db.update_all_task_statuses(tasks_per_job=1)
+    assert db.get_task(task.task_id).version == version
+
+    # the task cached in the session gets the new stats and version, so it can be saved afterwards
+    with db.session():
+        cached = db.get_task(task.task_id)
+        db.trans_results.update_one(
+            {"translation_id": rejected.translation_id},
+            {"$set": {"status": models.TransStatus.UNCHECKED}},
+        )
+        db.update_task_status(task=cached)
+        assert db.get_task(task.task_id) is cached
+        assert (
+            cached.completion_stats
+            == db.trans_tasks.find_one({"task_id": task.task_id})["completion_stats"]
+        )
+        assert cached.version == version + 1
+        cached.completions += 1
+        db.save_task(cached)
+    assert db.get_task(task.task_id).completions == 1
+
+
+def test_incremental_task_statuses():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Events")
+    task = db.create_task(project=project)
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(2)
+    ]
+    db.add_inputs(inputs)
+
+    # the first event computes the task stats from scratch
+    translation = db.create_translation(user_id=1, trans_input=inputs[0], text="x")
+    db.save_translation(translation)
+    db.events.publish(events.TranslationSaved(translation=translation))
+    assert db.get_task(task.task_id).completion_stats == {
+        models.InputStatus.UNCHECKED_USER_TRANSLATION: 1,
+        models.InputStatus.NO_TRANSLATION: 1,
+    }
+
+    # the next events only apply the changes
+    label = db.create_label(user_id=2, trans_result=translation)
+    translation.status = models.TransStatus.ACCEPTED
+    db.save_translation(translation)
+    db.events.publish(
+        events.LabelFinalized(
+            label=label,
+            translation=translation,
+            old_status=models.TransStatus.UNCHECKED,
+        )
+    )
+    expected = {
+        models.InputStatus.UNCHECKED_USER_TRANSLATION: 0,
+        models.InputStatus.ACCEPTED: 1,
+        models.InputStatus.NO_TRANSLATION: 1,
+    }
+    assert db.get_task(task.task_id).completion_stats == expected
+    assert (
+        db.get_new_task(
+            user=models.UserState(user_id=3, curr_proj_id=project.project_id),
+            prioritize_type=models.PrioritizeType.LEAST_COMPLETE,
+        ).completion_stats
+        == expected
+    )
+
+    # when two processes handle the same change, its delta is applied only once
+    other = db.create_translation(user_id=1, trans_input=inputs[1], text="y")
+    with db.session():
+        stale_input = db.get_input(inputs[1].input_id)
+        db.save_translation(other)
+        another_process = models.Database(db.mongo_db)
+        another_process.refresh_input_status(input_id=inputs[1].input_id)
+        db.refresh_input_status(input_id=inputs[1].input_id)
+        assert stale_input.input_status == models.InputStatus.UNCHECKED_USER_TRANSLATION
+    expected[models.InputStatus.NO_TRANSLATION] = 0
+    expected[models.InputStatus.UNCHECKED_USER_TRANSLATION] = 1
+    assert db.get_task(task.task_id).completion_stats == expected
+
+
+def test_unsolved_inputs_cursor():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Cursor")
+    task = db.create_task(project=project)
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(5)
+    ]
+    inputs[2].solved = True
+    db.add_inputs(inputs)
+    unsolved_ids = [inputs[i].input_id for i in [0, 1, 3, 4]]
+
+    assert [
+        inp.input_id for inp in db.iter_unsolved_inputs(task=task, batch_size=2)
+    ] == unsolved_ids
+    assert [
+        inp.input_id
+        for inp in db.iter_unsolved_inputs(task=task, after_id=inputs[1].input_id)
+    ] == unsolved_ids[2:]
+    assert db.get_next_unsolved_input(task=task).input_id == unsolved_ids[0]
+    assert (
+        db.get_next_unsolved_input(task=task, prev_sent_id=inputs[1].input_id).input_id
+        == inputs[3].input_id
+    )
+    assert (
+        db.get_next_unsolved_input(task=task, prev_sent_id=inputs[4].input_id) is None
+    )
+    assert db.count_unsolved_inputs_for_task(task=task) == 4
+
+
+def test_task_working_set():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Working set")
+    task = db.create_task(project=project)
+    inputs = [
+        db.create_input(project=project, task=task, source=f"text {i}")
+        for i in range(3)
+    ]
+    db.add_inputs(inputs)
+    mine = db.create_translation(user_id=1, trans_input=inputs[0])
+    other = db.create_translation(user_id=2, trans_input=inputs[1])
+    db.add_translations([mine, other])
+    db.save_label(db.create_label(user_id=1, trans_result=other))
+
+    working_set = db.load_task_working_set(task=task, user_id=1, max_inputs=2)
+    assert working_set.project.project_id == project.project_id
+    assert [inp.input_id for inp in working_set.inputs] == [
+        inputs[0].input_id,
+        inputs[1].input_id,
+    ]
+    assert not working_set.exhausted
+    assert [t.translation_id for t in working_set.translations[inputs[0].input_id]] == [
+        mine.translation_id
+    ]
+    assert working_set.scored_translation_ids == {other.translation_id}
+
+    rest = db.load_task_working_set(
+        task=task, user_id=1, after_id=inputs[1].input_id, max_inputs=2
+    )
+    assert [inp.input_id for inp in rest.inputs] == [inputs[2].input_id]
+    assert rest.exhausted
+    assert rest.translations == {inputs[2].input_id: []}
+
+
+def test_session():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Session")
+    task = db.create_task(project=project)
+
+    with db.session() as session:
+        loaded = db.get_task(task.task_id)
+        assert db.get_task(task.task_id) is loaded
+        assert session.n_loads == 1 and session.n_hits == 1
+
+        # the changes are deferred, and repeated saves are written once
+        loaded.completions = 1
+        db.save_task(loaded)
+        loaded.completions = 2
+        db.save_task(loaded)
+        assert db.trans_tasks.find_one({"task_id": task.task_id})["completions"] == 0
+
+        # other queries see the pending changes
+        assert (
+            db.get_incomplete_tasks_for_project(project.project_id)[0].completions == 2
+        )
+        assert session.n_flushes == 1
+
+        project.overlap = 5
+        db.save_project(project)
+    assert db.get_project(project.project_id).overlap == 5
+    assert db.get_project(project.project_id) is not db.get_project(project.project_id)
+
+
+def test_dirty_fields():
+    db = models.Database.setup(mongo_url=None)
+    db.save_user(models.UserState(user_id=1, username="alice", src_langs=["en"]))
+    user = db.get_user(1)
+    assert user.changed_fields() == {}
+
+    user.state_id = "some_state"
+    user.src_langs.append("fr")
+    assert user.changed_fields() == {
+        "state_id": "some_state",
+        "src_langs": ["en", "fr"],
+    }
+
+    # only the changed fields are written, so a concurrent change of the other fields is preserved
+    db.mongo_users.update_one({"user_id": 1}, {"$set": {"username": "bob"}})
+    db.save_user(user)
+    assert user.changed_fields() == {}
+    stored = db.get_user(1)
+    assert stored.username == "bob"
+    assert stored.src_langs == ["en", "fr"] and stored.state_id == "some_state"
+
+
+def test_project_cache():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Cached")
+    assert [p.title for p in db.get_projects(active=True)] == ["Cached"]
+    assert db.get_project(project.project_id).title == "Cached"
+    assert db.project_cache.stats["misses"] == 2
+
+    assert [p.title for p in db.get_projects(active=True)] == ["Cached"]
+    assert db.get_project(project.project_id).title == "Cached"
+    assert db.project_cache.stats["hits"] == 2
+    exported = metrics.REGISTRY.render()
+    assert 'bot_cache_requests_total{cache="projects",result="hit"}' in exported
+
+    # a missing project is looked up again, rather than cached as missing
+    assert db.get_project(project.project_id + 1) is None
+    assert db.get_project(project.project_id + 1) is None
+    assert db.project_cache.stats["misses"] == 4
+
+    project.is_active = False
+    db.save_project(project)
+    assert db.get_projects(active=True) == []
+    assert db.get_project(project.project_id).is_active is False
+
+
+def test_message_log():
+    db = models.Database.setup(mongo_url=None)
+    writer = db.message_log
+    writer.batch_size = 1000
+    writer.flush_seconds = 60
+    for i in range(5):
+        writer.log({"user_id": 1, "text": str(i)})
+    writer.flush()
+    assert writer.depth == 0
+    assert db.mongo_messages.count_documents({"user_id": 1}) == 5
+    assert writer.stats["written"] == 5
+
+
+def test_optimistic_concurrency():
+    db = models.Database.setup(mongo_url=None)
+    db.save_user(models.UserState(user_id=1, n_labels=1))
+    first, second = db.get_user(1), db.get_user(1)
+
+    # the counters are incremented atomically, and the changes of different fields are merged
+    first.n_labels += 1
+    first.state_id = "first_state"
+    db.save_user(first)
+    second.n_labels += 1
+    second.contact = "second_contact"
+    db.save_user(second)
+    stored = db.get_user(1)
+    assert stored.n_labels == 3
+    assert (stored.state_id, stored.contact) == ("first_state", "second_contact")
+    assert stored.version == 2
+
+    # the concurrent changes of the same field are not overwritten silently
+    first.state_id = "another_state"
+    second.state_id = "yet_another_state"
+    db.save_user(first)
+    with pytest.raises(models.ConcurrentModificationError):
+        db.save_user(second)
+
+    # a new entity whose document has been created meanwhile does not overwrite it
+    duplicate = models.UserState(user_id=1, n_labels=0, contact="duplicate")
+    with pytest.raises(models.ConcurrentModificationError):
+        db.save_user(duplicate)
+    stored = db.get_user(1)
+    assert (stored.state_id, stored.contact) == ("another_state", "second_contact")
+
+    # but if it agrees with the stored values, it is saved on top of them like a loaded entity
+    duplicate = models.UserState(
+        user_id=1, n_labels=1, state_id="another_state", contact="second_contact"
+    )
+    db.save_user(duplicate)
+    stored = db.get_user(1)
+    assert stored.n_labels == 4
+    assert stored.version == duplicate.version == 3
+
+
+def test_translation_verdict():
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Verdicts")
+    task = db.create_task(project=project)
+    inp = db.create_input(project=project, task=task, source="text", save=True)
+    res = db.create_translation(user_id=1, trans_input=inp, text="translation")
+    db.save_translation(res)
+    stale = db.get_translation(res.translation_id)
+
+    before = db.apply_translation_verdict(res=res, accepted=True, overlap=2)
+    assert before.n_approvals == 0 and res.n_approvals == 1
+    assert res.status == models.TransStatus.UNCHECKED
+    db.apply_translation_verdict(res=stale, accepted=True, overlap=2)
+    assert stale.n_approvals == 2 and stale.status == models.TransStatus.ACCEPTED
+
+    assert db.mark_input_solved(inp)
+    assert not db.mark_input_solved(inp)
+    assert inp.solved
+
+    db.trans_results.delete_one({"translation_id": res.translation_id})
+    with pytest.raises(models.DocumentNotFoundError):
+        db.apply_translation_verdict(res=res, accepted=False, overlap=2)
+
+
+def test_query_accounting(caplog):
+    db = models.Database.setup(mongo_url=None)
+    project = db.create_project(title="Queries")
+    task = db.create_task(project=project)
+    db.add_inputs(
+        [db.create_input(project=project, task=task, source=f"{i}") for i in range(5)]
+    )
+
+    with query_log.track() as stats:
+        assert len(list(db.trans_inputs.find({"task_id": task.task_id}).limit(3))) == 3
+        # a cursor that is not read to the end still counts as a query
+        next(db.trans_inputs.find({"task_id": task.task_id}))
+        db.trans_tasks.find_one({"task_id": task.task_id})
+    assert (stats.n_queries, stats.n_documents) == (3, 5)
+    assert stats.n_bytes > 0
+    assert stats.operations[("trans_inputs", "find")] == 2
+
+    # outside of a message, nothing is attributed
+    db.trans_tasks.find_one({"task_id": task.task_id})
+    assert stats.n_queries == 3
+
+    slow = query_log.InstrumentedCollection(db.mongo_db.trans_inputs, slow_seconds=0)
+    with caplog.at_level("WARNING", logger="query_log"):
+        list(slow.find({"task_id": task.task_id, "input_id": {"$in": [1, 2]}}))
+    assert "{'task_id': '?', 'input_id': {'$in': '?'}}" in caplog.text
+    assert "test_models.py" in caplog.text
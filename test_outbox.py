@@ -0,0 +1,50 @@
+from telebot.apihelper import ApiTelegramException  # type: ignore
+
+from dialogue_management import FakeBot
+from outbox import Outbox, RateLimiter, TokenBucket
+
+
+class FlakyBot(FakeBot):
+    """A fake bot that fails the first attempts to send a message"""
+
+    def __init__(self, errors):
+        super().__init__()
+        self.errors = list(errors)
+
+    def send_message(self, user_id, text, reply_markup=None, parse_mode=None):
+        if self.errors:
+            error_code, description = self.errors.pop(0)
+            raise ApiTelegramException(
+                "sendMessage",
+                None,
+                {
+                    "error_code": error_code,
+                    "description": description,
+                    "parameters": {"retry_after": 0},
+                },
+            )
+        return super().send_message(user_id, text, reply_markup, parse_mode)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, capacity=1)
+    assert bucket.wait_time(now=bucket.updated) == 0
+    bucket.consume(now=bucket.updated)
+    assert bucket.wait_time(now=bucket.updated) == 0.5
+    assert bucket.wait_time(now=bucket.updated + 0.5) == 0
+
+
+def test_outbox_retries():
+    bot = FlakyBot(errors=[(429, "Too Many Requests"), (429, "Too Many Requests")])
+    outbox = Outbox(bot=bot, limiter=RateLimiter(global_rate=1000, chat_rate=1000))
+    assert outbox.send_now(1, "hello").text == "hello"
+
+    sent, failed = [], []
+    bot.errors = [(429, "Too Many Requests"), (403, "Forbidden: bot was blocked")]
+    for chat_id in [2, 3, 4]:
+        outbox.enqueue(
+            chat_id, f"hi {chat_id}", on_sent=sent.append, on_error=failed.append
+        )
+    outbox.join()
+    assert sorted(result.user_id for result in sent) == [2, 4]
+    assert len(failed) == 1 and failed[0].error_code == 403
@@ -130,5 +130,9 @@ RESP_TASK_LOST = (
     "Простите, задание потерялось. Нажмите /help для выхода в основное меню."
 )
 
+RESP_TASK_TAKEN = (
+    "Пока вы думали, это задание взял кто-то другой. Давайте попробуем другое!"
+)
+
 RESP_NOTHING_TO_SKIP = """Я запутался, на каком вы были моменте. Чтобы взять новую задачу, нажмите /task. Чтобы продолжить текущую, нажмите /resume.
 Нажмите /help, если хотите посмотреть полный список команд."""
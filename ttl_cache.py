@@ -0,0 +1,54 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import metrics
+
+
+class TTLCache:
+    """
+    A small thread-safe cache, in which each value expires `ttl_seconds` after it was loaded.
+    It is meant for the data that rarely changes, and whose changes made by other processes may appear with a delay.
+    The None values are not cached, so that a missing document is found as soon as it is created.
+    The hits and misses are counted in `metrics.CACHE_REQUESTS` under the name of the cache.
+    """
+
+    def __init__(self, name: str, ttl_seconds: float):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self._hit_counter = metrics.CACHE_REQUESTS.labels(name, "hit")
+        self._miss_counter = metrics.CACHE_REQUESTS.labels(name, "miss")
+        self._values: Dict[Hashable, Tuple[float, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            found = self._values.get(key)
+            if found is not None and found[0] > now:
+                self.hits += 1
+                self._hit_counter.inc()
+                return found[1]
+            self.misses += 1
+        self._miss_counter.inc()
+        # the loader runs outside of the lock; at worst, two threads load the same value at once
+        value = loader()
+        if value is None:
+            return None
+        with self._lock:
+            self._values[key] = (now + self.ttl_seconds, value)
+        return value
+
+    def invalidate(self, key: Optional[Hashable] = None) -> None:
+        """Forget the value for the key, or all the values if the key is not given"""
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._values)}
@@ -1,5 +1,5 @@
-from app import DB, server, BASE_URL
-from flask import Flask, request, session, render_template
+from app import get_db, BASE_URL
+from flask import Blueprint, Flask, request, session, render_template
 from flask_babel import Babel, _  # noqa
 from flask_babel import lazy_gettext as _l  # noqa
 from flask_bcrypt import Bcrypt
@@ -25,14 +25,13 @@ from models import UserState, FlaskUser
 ##############
 
 
-server.secret_key = os.urandom(32)
-bcrypt = Bcrypt(server)
+views = Blueprint("views", __name__)
+bcrypt = Bcrypt()
 # pw_hash = bcrypt.generate_password_hash('hunter2').decode(‘utf-8’)
 # bcrypt.check_password_hash(pw_hash, 'hunter2') # returns True
 
 login_manager = LoginManager()
-login_manager.init_app(server)
-login_manager.login_view = "view_login"
+login_manager.login_view = "views.view_login"
 login_manager.login_message = None
 
 
@@ -41,7 +40,7 @@ def load_user(userid):
     if isinstance(userid, str) and userid.lstrip("-").isnumeric():
         userid = int(userid)
 
-    user_state = DB.find_user_account(user_id=userid)
+    user_state = get_db().find_user_account(user_id=userid)
     print(f"for user_id {userid} (of type {type(userid)}), found the user state {user_state} when loading a user")
     if user_state is None:
         return None  # according to flask-login documentation, this is what is required
@@ -68,24 +67,32 @@ def get_flask_locale():
     return request.accept_languages.best_match(APP_LANGS)
 
 
-babel = Babel(
-    server,
-    locale_selector=get_flask_locale,
-    default_translation_directories="interface_translations",
-)
+babel = Babel()
 
 
-@server.context_processor
+@views.app_context_processor
 def inject_flask_locale():
     return dict(flask_locale=get_flask_locale())
 
 
+def init_views(server: Flask) -> None:
+    """Attach the website to the application; its secret key should be already set"""
+    bcrypt.init_app(server)
+    login_manager.init_app(server)
+    babel.init_app(
+        server,
+        locale_selector=get_flask_locale,
+        default_translation_directories="interface_translations",
+    )
+    server.register_blueprint(views)
+
+
 ##############
 # The base views
 ##############
 
 
-@server.route("/")
+@views.route("/")
 def view_home():
     return render_template("home.html")
 
@@ -95,9 +102,9 @@ def view_home():
 ##############
 
 
-@server.route("/projects")
+@views.route("/projects")
 def view_projects():
-    projects_list = DB.get_projects()
+    projects_list = get_db().get_projects()
     return render_template("projects.html", projects_list=projects_list)
 
 ##############
@@ -143,7 +150,7 @@ class RegistrationForm(FlaskForm):
         )
         if not initial_validation:
             return False
-        existing_account = DB.find_user_account(username=self.username.data)
+        existing_account = get_db().find_user_account(username=self.username.data)
         if existing_account:
             self.username.append(_l("Username already registered."))
             return False
@@ -158,14 +165,14 @@ class LoginForm(FlaskForm):
     password = PasswordField(_l("Password"), validators=[DataRequired()])
 
 
-@server.route("/login", methods=["GET", "POST"])
+@views.route("/login", methods=["GET", "POST"])
 def view_login():
     if current_user.is_authenticated:
         flash("You are already logged in.", "info")
         return redirect("/")
     form = LoginForm(request.form)
     if form.validate_on_submit():
-        account = DB.find_user_account(username=form.username.data)
+        account = get_db().find_user_account(username=form.username.data)
         if (
             account
             and account.password_hash
@@ -208,7 +215,7 @@ def string_generator(data_incoming):
     return string_cat
 
 
-@server.route("/telegram-login-result")
+@views.route("/telegram-login-result")
 def telegram_login_result():
     tg_data = {
         "id": request.args.get("id", None),
@@ -229,14 +236,14 @@ def telegram_login_result():
     if hmac_string == tg_data["hash"] and tg_data["id"] is not None:
         tg_id = int(tg_data["id"])
         # TODO: fix this lookup
-        account = DB.find_user_account(tg_id=tg_id)
+        account = get_db().find_user_account(tg_id=tg_id)
         if account is None:
             flash(
                 f"Telegram-based account for id {tg_id} was not found; creating a new one!",
                 "info",
             )
             # TODO: implement this creation
-            account = DB.create_user_with_telegram_data(
+            account = get_db().create_user_with_telegram_data(
                 tg_id=tg_id,
                 tg_username=tg_data["username"],
                 first_name=tg_data["first_name"],
@@ -266,7 +273,7 @@ def telegram_login_result():
     return redirect("/login")
 
 
-@server.route("/register", methods=["GET", "POST"])
+@views.route("/register", methods=["GET", "POST"])
 def view_register():
     if current_user.is_authenticated:
         flash("You are already registered.", "info")
@@ -279,13 +286,13 @@ def view_register():
             flash(f"The username {username} is too short; please choose at least 4 characters!")
             return render_template("register.html", form=form, current_user=current_user)
 
-        other = DB.find_user_account(username=username)
+        other = get_db().find_user_account(username=username)
         if other:
             flash(f"Account with the name {username} already exists!")
             return render_template("register.html", form=form, current_user=current_user)
 
         pw_hash = bcrypt.generate_password_hash(form.password.data).decode("utf-8")
-        account = DB.create_user_with_password(
+        account = get_db().create_user_with_password(
             username=username, password_hash=pw_hash
         )
         user = FlaskUser.from_account(account)
@@ -297,7 +304,7 @@ def view_register():
     return render_template("register.html", form=form, current_user=current_user)
 
 
-@server.route("/logout")
+@views.route("/logout")
 @login_required
 def logout_page():
     logout_user()
@@ -0,0 +1,9 @@
+"""
+The entry point for a WSGI server, e.g. `gunicorn wsgi:app` (the settings are in gunicorn.conf.py).
+Creating the app does not connect to the database or to Telegram, so it can be preloaded before the fork:
+each worker process creates its own clients on the first request.
+"""
+
+from app import create_app
+
+app = create_app()